@@ -0,0 +1,115 @@
+"""
+Bookkeeping for the artifacts cached under a data_path (the pickled corpora
+and stem map, and the count stores), so each is rebuilt when, and only when,
+what it was built from changes.
+
+Every artifact is recorded in data_path/artifacts.json with a key: a hash of
+the content of its inputs and of the parameters it was built with. The
+corpus is keyed by the content of the text files (a file's sha1 is only
+recomputed when its mtime or size changes) and by how it is split; a count
+store by the corpus key and its order. An artifact whose recorded key is not
+the key it would be built with now is stale.
+"""
+import hashlib
+import json
+import os
+
+
+def content_key(*parts):
+    """ Returns a hash of parts, which must be JSON serializable """
+    return hashlib.sha1(json.dumps(parts, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def file_record(filename):
+    """ Returns what identifies the contents of a file: its mtime, size and sha1 """
+    stat = os.stat(filename)
+    sha1 = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(2 ** 20), b''):
+            sha1.update(block)
+    return {'mtime': stat.st_mtime, 'size': stat.st_size, 'sha1': sha1.hexdigest()}
+
+
+class ArtifactStore(object):
+    """
+    The index of the artifacts under data_path:
+        {'sources': {basename: {mtime, size, sha1}}, 'artifacts': {basename: key}}
+    It is re-read for every lookup, so processes sharing a data_path see
+    each other's builds
+    """
+
+    def __init__(self, data_path):
+        self.data_path = data_path
+
+    def filename(self):
+        return os.path.join(self.data_path, 'artifacts.json')
+
+    def load_index(self):
+        try:
+            with open(self.filename()) as f:
+                index = json.load(f)
+        except (IOError, ValueError):
+            index = {}
+        index.setdefault('sources', {})
+        index.setdefault('artifacts', {})
+        return index
+
+    def _dump_index(self, index):
+        """ Writes the index, replacing it atomically """
+        tmp_filename = '{}.{}.tmp'.format(self.filename(), os.getpid())
+        with open(tmp_filename, 'w') as f:
+            json.dump(index, f, indent=1, sort_keys=True)
+        os.replace(tmp_filename, self.filename())
+
+    def sources_key(self, filenames):
+        """
+        Returns a key of the names and contents of the source files
+        filenames, or None if there are none
+        """
+        if not filenames:
+            return None
+        index = self.load_index()
+        sources = {}
+        changed = False
+        for filename in filenames:
+            name = os.path.basename(filename)
+            record = index['sources'].get(name)
+            stat = os.stat(filename)
+            if record is None or (record['mtime'], record['size']) != (stat.st_mtime, stat.st_size):
+                record = file_record(filename)
+                changed = True
+            sources[name] = record
+        if changed or len(sources) != len(index['sources']):
+            index['sources'] = sources
+            self._dump_index(index)
+        return content_key({name: record['sha1'] for name, record in sources.items()})
+
+    def key(self, filename):
+        """ Returns the key filename was recorded with, or None """
+        return self.load_index()['artifacts'].get(os.path.basename(filename))
+
+    def is_fresh(self, filename, key):
+        """
+        Whether the artifact filename exists and was built with key. A key
+        of None means there is nothing to check against (e.g. the sources
+        are not there), so any artifact that exists will do
+        """
+        if not os.path.exists(filename):
+            return False
+        return key is None or self.key(filename) == key
+
+    def record(self, keys):
+        """ Records {filename: key} for artifacts that were just built; None keys are skipped """
+        keys = {os.path.basename(f): key for f, key in keys.items() if key is not None}
+        if not keys:
+            return
+        index = self.load_index()
+        index['artifacts'].update(keys)
+        self._dump_index(index)
+
+    def forget(self, filenames):
+        """ Drops the records of artifacts that were deleted """
+        index = self.load_index()
+        for filename in filenames:
+            index['artifacts'].pop(os.path.basename(filename), None)
+        self._dump_index(index)
@@ -0,0 +1,271 @@
+"""
+Benchmarks the hot paths (corpus building, counting, loading, probability
+lookups, perplexity and unscrambling) on synthetic corpora of several sizes,
+so timings are reproducible and don't depend on the real corpus.
+
+    python benchmark.py --sizes 100000 1000000 --ns 1 2 3 4 5
+    python benchmark.py --save_baseline
+    python benchmark.py --baseline output_data/benchmark_baseline.json
+
+Results are written as JSON. Against a baseline, every benchmark that got
+slower by more than --tolerance is reported as a regression and the exit
+status is 1.
+"""
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import time
+from multiprocessing import cpu_count
+
+import numpy as np
+
+from language_model import NGramLanguageModel
+from ngram import NGramCounts
+from preprocessing import CorpusBuilder
+from probability import PROBABILITY_GENERATORS
+from sweep import SWEEP_PARAMETERS
+
+PUNCTUATION = [('.', '.'), ('!', '!'), ('?', '?')]
+SUFFIXES = ['', 's', 'ed', 'ing']
+
+
+def generate_corpus(data_path, num_tokens, vocabulary_size=4000, num_files=4,
+                    mean_sentence_length=12, seed=42):
+    """
+    Writes a synthetic corpus of about num_tokens words to
+    data_path/wordLemPoS, in the same tab separated word, lemma, pos format
+    as the real corpus. Words follow a Zipf distribution over
+    vocabulary_size words, which share lemmas through a few suffixes, so
+    both the stemmed and unstemmed corpora are realistic to count.
+    Returns the number of sentences written
+    """
+    text_dir = os.path.join(data_path, 'wordLemPoS')
+    if os.path.exists(text_dir):
+        shutil.rmtree(text_dir)
+    os.makedirs(text_dir)
+
+    rng = np.random.RandomState(seed)
+    lemmas = ['w{}'.format(i) for i in range(-(-vocabulary_size // len(SUFFIXES)))]
+    words = [(lemma + suffix, lemma) for lemma in lemmas for suffix in SUFFIXES][:vocabulary_size]
+    ranks = np.arange(1, len(words) + 1)
+    probabilities = 1 / ranks / (1 / ranks).sum()
+
+    num_sentences = 0
+    tokens_per_file = -(-num_tokens // num_files)
+    for f in range(num_files):
+        lengths = rng.poisson(mean_sentence_length - 1, size=tokens_per_file // mean_sentence_length + 1) + 1
+        tokens = rng.choice(len(words), size=lengths.sum(), p=probabilities)
+        ends = np.cumsum(lengths)
+        with open(os.path.join(text_dir, 'wlp_synthetic_{}.txt'.format(f)), 'w') as out:
+            out.write('##{}\t\tfo\n'.format(f))
+            start = 0
+            for end in ends:
+                for token in tokens[start:end]:
+                    word, lemma = words[token]
+                    out.write('{}\t{}\tnn1\n'.format(word, lemma))
+                out.write('{}\t\t{}\n'.format(*PUNCTUATION[end % len(PUNCTUATION)]))
+                start = end
+        num_sentences += len(ends)
+    return num_sentences
+
+
+def time_call(func, repeat=3):
+    """ Calls func repeat times, returns (result of the last call, list of seconds taken) """
+    times = []
+    result = None
+    for _ in range(repeat):
+        start = time.time()
+        result = func()
+        times.append(time.time() - start)
+    return result, times
+
+
+def _record(results, benchmark, size, n, times, **extra):
+    result = {
+        'benchmark': benchmark,
+        'size': size,
+        'n': n,
+        'best': min(times),
+        'median': float(np.median(times)),
+        'repeat': len(times),
+    }
+    result.update(extra)
+    results.append(result)
+    print("{:<18} size={:<9} n={:<4} best {:.4f}s  median {:.4f}s".format(
+        benchmark, size, n if n is not None else '-', result['best'], result['median']))
+
+
+def run_benchmarks(sizes=(100000,), ns=(1, 2, 3, 4, 5), repeat=3, work_dir='benchmark_data',
+                   smoothing='laplace', processes=1, lookups=1000, unscramble_sentences=5,
+                   unscramble_words=6):
+    """
+    Times each stage for every corpus size and model order
+    Returns a list of result dicts
+    """
+    results = []
+    for size in sizes:
+        data_path = os.path.join(work_dir, 'size_{}'.format(size))
+        generate_corpus(data_path, size)
+        corpus_builder = CorpusBuilder(data_path=data_path, processes=processes)
+
+        _, times = time_call(corpus_builder._build_corpus, repeat)
+        _record(results, 'build_corpus', size, None, times)
+
+        test_corpus = corpus_builder.load_test_corpus()
+        test_text = [' '.join(s) for s in test_corpus]
+        # The first few words of some test sentences, shuffled
+        rng = random.Random(42)
+        scrambled = []
+        for s in test_corpus[:unscramble_sentences]:
+            words = list(s[:unscramble_words])
+            rng.shuffle(words)
+            scrambled.append(' '.join(words))
+
+        for n in ns:
+            try:
+                ngram_counts = NGramCounts(n, corpus_builder=corpus_builder)
+            except ValueError as e:
+                # Too many words to pack n of them into one key
+                print("Skipping n={} for size={}: {}".format(n, size, e))
+                continue
+            _, times = time_call(ngram_counts.build_counts, repeat)
+            _record(results, 'build_counts', size, n, times, ngrams=len(ngram_counts.get_table(n)))
+
+            _, times = time_call(ngram_counts.load_counts, repeat)
+            _record(results, 'load_counts', size, n, times)
+
+            def build_probabilities():
+                language_model = NGramLanguageModel(
+                    n=n,
+                    probability_generator=PROBABILITY_GENERATORS[smoothing],
+                    ngram_counts=ngram_counts,
+                )
+                # Orders are only generated on first use: time generating them all
+                generator = language_model.probability_generator
+                for k in range(1, n + 1):
+                    generator.contexts[k]
+                return language_model
+            language_model, times = time_call(build_probabilities, repeat)
+            _record(results, 'probabilities', size, n, times)
+
+            generator = language_model.probability_generator
+            table = ngram_counts.get_table(n)
+            ids = table.ids()[np.random.RandomState(42).randint(len(table), size=lookups)]
+            histories = [generator.vocabulary.decode(row[:-1]) for row in ids]
+
+            def get_probabilities():
+                for history in histories:
+                    generator.get_probabilities(history, n)
+            # Not timing anything still built on the first lookup
+            get_probabilities()
+            _, times = time_call(get_probabilities, repeat)
+            _record(results, 'get_probabilities', size, n, times, lookups=lookups)
+
+            _, times = time_call(lambda: language_model.perplexity(test_text), repeat)
+            _record(results, 'perplexity', size, n, times, sentences=len(test_text))
+
+            def unscramble():
+                for sentence in scrambled:
+                    language_model.cache.clear()
+                    language_model.unscramble(sentence)
+            _, times = time_call(unscramble, repeat)
+            _record(results, 'unscramble', size, n, times, sentences=len(scrambled))
+    return results
+
+
+def compare(results, baseline, tolerance=0.25):
+    """
+    Compares the best time of every benchmark in results with the same
+    (benchmark, size, n) in baseline
+    Returns a list of (result, baseline seconds, ratio) for regressions, i.e.
+    results more than tolerance slower than the baseline
+    """
+    baseline_times = {
+        (b['benchmark'], b['size'], b['n']): b['best']
+        for b in baseline['results']
+    }
+    regressions = []
+    for result in results:
+        key = (result['benchmark'], result['size'], result['n'])
+        if key not in baseline_times:
+            continue
+        ratio = result['best'] / baseline_times[key] if baseline_times[key] else float('inf')
+        print("{:<18} size={:<9} n={:<4} {:.4f}s vs {:.4f}s ({:+.0%})".format(
+            result['benchmark'], result['size'], result['n'] if result['n'] is not None else '-',
+            result['best'], baseline_times[key], ratio - 1))
+        if ratio > 1 + tolerance:
+            regressions.append((result, baseline_times[key], ratio))
+    return regressions
+
+
+def environment():
+    """ Describes the machine the benchmarks ran on """
+    return {
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'cpus': cpu_count(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Benchmark the language model on synthetic corpora')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100000, 1000000],
+                        help='Corpus sizes to benchmark, in tokens')
+    parser.add_argument('--ns', type=int, nargs='+', default=[1, 2, 3, 4, 5],
+                        help='n-gram models to benchmark')
+    parser.add_argument('--repeat', type=int, default=3, help='Times to run each benchmark')
+    parser.add_argument('--smoothing', choices=sorted(SWEEP_PARAMETERS), default='laplace')
+    parser.add_argument('--processes', type=int, default=1,
+                        help='Processes to build corpora and counts with (default 1, for stable timings)')
+    parser.add_argument('--work_dir', default='benchmark_data',
+                        help='Where synthetic corpora and their counts are written')
+    parser.add_argument('--output', default='output_data/benchmark.json')
+    parser.add_argument('--baseline', help='Results file to compare against')
+    parser.add_argument('--save_baseline', action='store_true',
+                        help='Also save the results as output_data/benchmark_baseline.json')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='Fraction slower than the baseline that counts as a regression')
+    args = parser.parse_args()
+
+    results = run_benchmarks(
+        sizes=args.sizes,
+        ns=args.ns,
+        repeat=args.repeat,
+        work_dir=args.work_dir,
+        smoothing=args.smoothing,
+        processes=args.processes,
+    )
+    report = {
+        'environment': environment(),
+        'parameters': {k: v for k, v in vars(args).items() if k not in ('baseline', 'save_baseline')},
+        'results': results,
+    }
+
+    outputs = [args.output]
+    if args.save_baseline:
+        outputs.append(os.path.join(os.path.dirname(args.output), 'benchmark_baseline.json'))
+    for output in outputs:
+        output_dir = os.path.dirname(output)
+        if output_dir and not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print("Wrote {}".format(output))
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        print("\nCompared with {}:".format(args.baseline))
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print("\n{} regression(s) beyond {:.0%}:".format(len(regressions), args.tolerance))
+            for result, seconds, ratio in regressions:
+                print("  {benchmark} size={size} n={n}".format(**result))
+            sys.exit(1)
@@ -0,0 +1,246 @@
+"""
+Compact models for low-memory deployment: the log probabilities of a full
+model's n-grams, pruned and quantized, saved as one .npz file that
+CompactProbabilityGenerator scores from with the usual API.
+
+    python compact.py 3:unstemmed:kneser_ney:D=0.75 --cutoff 2 --bits 8
+    python compact.py 3:unstemmed:katz --entropy 1e-8 --bits 16
+    python main.py -n 3 -evaluate TEST_CORPUS compact --model data/compact.npz
+
+Pruning (unigrams are always kept):
+  * count cutoff drops n-grams seen fewer than --cutoff times
+  * entropy pruning drops n-grams whose removal costs the model less than
+    --entropy, measured as P(h, w) * (log Pr(w | h) - log Pr'(w | h)) where
+    Pr' is what the pruned model gives instead (weighted difference pruning,
+    a cheap approximation of Stolcke's relative entropy criterion)
+
+Quantization replaces each order's log probabilities (and backoff weights)
+with 8 or 16 bit codes into a codebook of bin means, over equal-population
+bins.
+
+Models that back off (Kneser-Ney, Katz) keep a backoff weight per history,
+recomputed from what is kept after pruning and quantization so every
+distribution still sums to one. Kneser-Ney interpolates with continuation
+counts rather than backing off, so its compact model is an approximation
+even unpruned. For the other models a pruned n-gram gets the probability
+the full model gives an unseen n-gram of its order.
+
+The report compares the memory taken by the arrays the full and compact
+models score from, and their perplexity on the test set.
+"""
+import os
+
+import numpy as np
+
+from language_model import NGramLanguageModel
+from ngram import NGramCounts, find_keys
+from preprocessing import CorpusBuilder
+from probability import MIN_MASS, PROBABILITY_GENERATORS, CompactProbabilityGenerator
+from store import write_compact
+from vocabulary import key_dtype, history_keys as histories_of
+
+
+def quantize(values, bits=None):
+    """
+    Returns (codes, codebook) such that codebook[codes] approximates values,
+    with codes of the given number of bits (up to 16). Codes split the
+    finite values into equal-population bins and decode to the mean of their
+    bin; -inf gets a code of its own. With bits=None values are returned
+    unchanged as float64 and the codebook is None
+    """
+    values = np.asarray(values, dtype=np.float64)
+    if bits is None:
+        return values, None
+    if not 1 <= bits <= 16:
+        raise ValueError("Can only quantize to between 1 and 16 bits, not {}".format(bits))
+
+    finite = np.isfinite(values)
+    levels = 2 ** bits - (0 if finite.all() else 1)
+    if finite.any():
+        edges = np.unique(np.percentile(values[finite], np.linspace(0, 100, levels + 1)[1:-1]))
+    else:
+        edges = np.zeros(0)
+    codes = np.searchsorted(edges, values, side='right')
+    sums = np.bincount(codes[finite], weights=values[finite], minlength=len(edges) + 1)
+    sizes = np.bincount(codes[finite], minlength=len(edges) + 1)
+    codebook = sums / np.maximum(sizes, 1)
+    if not finite.all():
+        codes[~finite] = len(codebook)
+        codebook = np.append(codebook, -np.inf)
+    return codes.astype(np.uint8 if bits <= 8 else np.uint16), codebook
+
+
+def backoff_weights(keys, n, bits, log_probs, lower_log_probs):
+    """
+    Returns (history keys, log backoff weights) for a sorted array of keys of
+    n-grams of order n, where each weight spreads the mass left over by the n-grams kept
+    after a history over the lower order probabilities of the words not kept:
+        log (1 - sum of Pr(w | h)) - log (1 - sum of Pr(w | h'))
+    """
+    if not len(keys):
+        return np.zeros(0, dtype=key_dtype(n - 1, bits)), np.zeros(0)
+    history_keys, starts = np.unique(histories_of(keys, n, bits), return_index=True)
+    left = 1 - np.add.reduceat(np.exp(log_probs), starts)
+    lower_left = 1 - np.add.reduceat(np.exp(lower_log_probs), starts)
+    return history_keys, np.log(np.maximum(left, MIN_MASS)) - np.log(np.maximum(lower_left, MIN_MASS))
+
+
+def _describe(cutoff, threshold, bits):
+    parts = []
+    if cutoff:
+        parts.append('count cutoff {}'.format(cutoff))
+    if threshold is not None:
+        parts.append('entropy threshold {}'.format(threshold))
+    parts.append('{} bit'.format(bits) if bits else 'unquantized')
+    return ', '.join(parts)
+
+
+def compact(generator, cutoff=None, threshold=None, bits=None):
+    """
+    Prunes and quantizes the model of a probability generator, order by
+    order from the unigrams up, so each order's pruning and backoff weights
+    are measured against the compact lower orders it will back off to.
+    Returns the compact model data, for CompactProbabilityGenerator or
+    store.write_compact
+    """
+    counts = generator.counts
+    vocabulary = counts.vocabulary
+    backoff = generator.backs_off
+    data = {
+        'meta': {
+            'n': counts.n,
+            'vocabulary': vocabulary.fingerprint(),
+            'backoff': backoff,
+            'floor': [],
+            'source': str(generator),
+            'compaction': _describe(cutoff, threshold, bits),
+        },
+        'orders': {},
+    }
+    lower = None
+    for k in range(1, counts.n + 1):
+        table = counts.get_table(k)
+        ids = table.ids()
+        log_probs = generator.log_probability_batch(ids, k)
+        # What the full model gives an n-gram of unknown words
+        floor = generator.log_probability_batch(np.zeros((1, k), dtype=np.int32), k)[0]
+        data['meta']['floor'].append(float(floor))
+
+        keep = np.ones(len(table), dtype=bool)
+        if k > 1 and backoff:
+            lower_log_probs = lower.log_probability_batch(ids[:, 1:], k - 1)
+        if k > 1 and cutoff:
+            keep &= table.counts >= cutoff
+        if k > 1 and threshold is not None:
+            if backoff:
+                # Weights of the histories as they stand after the cutoff
+                history_keys, log_weights = backoff_weights(
+                    table.keys[keep], k, vocabulary.bits, log_probs[keep], lower_log_probs[keep])
+                positions = find_keys(history_keys, table.history_keys())
+                fallback = np.where(positions >= 0, log_weights[positions], 0) + lower_log_probs
+            else:
+                fallback = floor
+            with np.errstate(invalid='ignore'):
+                loss = table.counts / table.counts.sum() * (log_probs - fallback)
+            keep &= ~(loss < threshold)
+
+        order = {'keys': np.array(table.keys[keep])}
+        order['values'], order['codebook'] = quantize(log_probs[keep], bits)
+        if k > 1 and backoff:
+            stored = order['values'] if order['codebook'] is None else order['codebook'][order['values']]
+            history_keys, log_weights = backoff_weights(
+                order['keys'], k, vocabulary.bits, stored, lower_log_probs[keep])
+            order['history_keys'] = history_keys
+            order['history_values'], order['history_codebook'] = quantize(log_weights, bits)
+        data['orders'][k] = order
+        lower = CompactProbabilityGenerator(counts, data=data)
+    return data
+
+
+def array_bytes(obj, seen=None):
+    """
+    Returns the total size of the numpy arrays reachable from obj, through
+    dicts, lists, tuples and object attributes, counting each array once
+    """
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes
+    if isinstance(obj, dict):
+        children = obj.values()
+    elif isinstance(obj, (list, tuple)):
+        children = obj
+    elif hasattr(obj, '__dict__'):
+        children = vars(obj).values()
+    else:
+        return 0
+    return sum(array_bytes(child, seen) for child in children)
+
+
+def report(language_model, filename, cutoff=None, threshold=None, bits=None):
+    """
+    Writes the compact version of language_model to filename, then prints
+    the memory and test set perplexity of both
+    Returns (full bytes, compact bytes, full perplexity, compact perplexity)
+    """
+    generator = language_model.probability_generator
+    write_compact(filename, compact(generator, cutoff, threshold, bits))
+
+    compact_model = NGramLanguageModel(
+        n=language_model.n,
+        probability_generator=CompactProbabilityGenerator,
+        ngram_counts=language_model.ngram_counts,
+        filename=filename,
+    )
+    compact_generator = compact_model.probability_generator
+    full_bytes = array_bytes(generator)
+    compact_bytes = array_bytes(compact_generator.data['orders'])
+    text = language_model._load_test_text('TEST_CORPUS')
+    full_perplexity = language_model.perplexity(text)
+    compact_perplexity = compact_model.perplexity(text)
+
+    n = language_model.n
+    print(str(language_model))
+    print(str(compact_generator))
+    print("{:<10} {:>12} {:>12} {:>14}".format('', '{}-grams'.format(n), 'MB', 'perplexity'))
+    print("{:<10} {:>12} {:>12.2f} {:>14.4f}".format(
+        'full', len(generator.counts.get_table(n)), full_bytes / 2 ** 20, full_perplexity))
+    print("{:<10} {:>12} {:>12.2f} {:>14.4f}".format(
+        'compact', len(compact_generator.tables[n]), compact_bytes / 2 ** 20, compact_perplexity))
+    print("Memory saved: {:.2f} MB ({:.1%}); perplexity change: {:+.2%}".format(
+        (full_bytes - compact_bytes) / 2 ** 20,
+        1 - compact_bytes / full_bytes,
+        compact_perplexity / full_perplexity - 1,
+    ))
+    print("Wrote {} ({:.2f} MB)".format(filename, os.path.getsize(filename) / 2 ** 20))
+    return full_bytes, compact_bytes, full_perplexity, compact_perplexity
+
+
+if __name__ == '__main__':
+    import argparse
+    from server import parse_model_spec
+
+    parser = argparse.ArgumentParser(description='Prune and quantize a model, and report what it costs')
+    parser.add_argument('model', help="Model spec 'n:corpus:smoothing[:name=value,...]', as for server.py")
+    parser.add_argument('--cutoff', type=int, help='Drop n-grams (above unigrams) seen fewer times than this')
+    parser.add_argument('--entropy', type=float, dest='threshold',
+                        help='Drop n-grams whose removal costs less than this')
+    parser.add_argument('--bits', type=int, choices=[8, 16], help='Quantize log probabilities to 8 or 16 bits')
+    parser.add_argument('--data_path', default='data')
+    parser.add_argument('--output', help='Compact model file (default DATA_PATH/compact_<model>.npz)')
+    args = parser.parse_args()
+
+    n, stemmed, smoothing, parameters = parse_model_spec(args.model)
+    corpus_builder = CorpusBuilder(data_path=args.data_path, stemmed=stemmed)
+    language_model = NGramLanguageModel(
+        n=n,
+        probability_generator=PROBABILITY_GENERATORS[smoothing],
+        ngram_counts=NGramCounts(n, corpus_builder=corpus_builder),
+        **parameters
+    )
+    output = args.output or os.path.join(
+        args.data_path, 'compact_{}.npz'.format(args.model.replace(':', '_').replace(',', '_').replace('=', '')))
+    report(language_model, output, args.cutoff, args.threshold, args.bits)
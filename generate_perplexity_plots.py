@@ -1,31 +1,44 @@
+import csv
+import sys
+from collections import defaultdict
 import matplotlib.pyplot as plt
 import numpy as np
 
-perp_vs_d = [
-    (0.1, 366360),
-    (0.2, 327327),
-    (0.3, 308762),
-    (0.4, 298142),
-    (0.5, 291996),
-]
-
-d, perplexity = zip(*perp_vs_d)
-plt.scatter(d, perplexity)
-plt.plot(d, perplexity)
+# Results of: python main.py -evaluate TEST_CORPUS sweep
+results_file = sys.argv[1] if len(sys.argv) > 1 else 'output_data/perplexity_sweep.csv'
+
+
+def load_sweep(smoothing):
+    """ Returns {(n, stemmed): [(parameter value, perplexity)]} for one smoothing """
+    curves = defaultdict(list)
+    with open(results_file) as f:
+        for row in csv.DictReader(f):
+            if row['smoothing'] == smoothing:
+                model = (int(row['n']), row['stemmed'] == 'True')
+                curves[model].append((float(row['value']), float(row['perplexity'])))
+    return {model: sorted(points) for model, points in curves.items()}
+
+
+def label(model):
+    n, stemmed = model
+    return '{}-gram, {}'.format(n, 'stemmed' if stemmed else 'unstemmed')
+
+
+perp_vs_d = load_sweep('abs_dis')
+for model, points in sorted(perp_vs_d.items()):
+    d, perplexity = zip(*points)
+    plt.scatter(d, perplexity)
+    plt.plot(d, perplexity, label=label(model))
+plt.legend()
 plt.title('Perplexity vs. D for Absolute Discounting')
 plt.show()
 
-perp_vs_k = [
-    (1, 43156208),
-    (2, 68445717),
-    (3, 88325944),
-    (4, 105059050),
-    (5, 119654173),
-]
-
-k, perplexity = zip(*perp_vs_k)
-plt.scatter(k, perplexity)
-plt.plot(k, perplexity)
+perp_vs_k = load_sweep('laplace')
+for model, points in sorted(perp_vs_k.items()):
+    k, perplexity = zip(*points)
+    plt.scatter(k, perplexity)
+    plt.plot(k, perplexity, label=label(model))
+plt.legend()
 plt.ticklabel_format(style='plain')
 plt.title('Perplexity vs. k for Laplace Smoothing')
-plt.show()
\ No newline at end of file
+plt.show()
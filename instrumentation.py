@@ -0,0 +1,173 @@
+"""
+Opt-in timing of the stages of the pipeline (corpus load, count load,
+probability generation, lookup, scoring, ...).
+
+Functions are marked with @timed('stage') and blocks with
+`with stage('stage'):`. Until enable() is called both cost one global flag
+check, so they are safe to leave on hot paths. Once enabled, every stage
+records its call count, total (inclusive) and self (exclusive) wall time,
+and the process' peak resident memory when it finishes, and the nesting of
+stages is kept as flame-graph stacks (see write_folded).
+
+Only the current process is measured: work done in pool workers shows up as
+time spent in the stage that waited for it.
+"""
+import cProfile
+import functools
+import json
+import os
+import sys
+import time
+from collections import defaultdict
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, so memory high-water marks aren't recorded
+    resource = None
+
+_enabled = False
+_stats = {}
+_stack = []
+_folded = defaultdict(float)
+
+
+def enable():
+    """ Starts recording, discarding anything recorded before """
+    global _enabled
+    _stats.clear()
+    _folded.clear()
+    del _stack[:]
+    _enabled = True
+
+
+def disable():
+    global _enabled
+    _enabled = False
+
+
+def is_enabled():
+    return _enabled
+
+
+def peak_memory():
+    """ Returns the peak resident memory of this process so far, in bytes (or None) """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+class _Stage(object):
+    """ Context manager timing one stage, when enabled """
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        if not _enabled:
+            self.start = None
+            return self
+        # Seconds spent in stages nested inside this one
+        self.children = 0.0
+        _stack.append(self)
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.start is None:
+            return False
+        elapsed = time.time() - self.start
+        _stack.pop()
+        if _stack:
+            _stack[-1].children += elapsed
+
+        stats = _stats.get(self.name)
+        if stats is None:
+            stats = _stats[self.name] = {'calls': 0, 'seconds': 0.0, 'self_seconds': 0.0, 'peak_memory': None}
+        self_seconds = elapsed - self.children
+        stats['self_seconds'] += self_seconds
+        # A stage inside itself (e.g. an overridden method calling super) is one call
+        if not any(s.name == self.name for s in _stack):
+            stats['calls'] += 1
+            stats['seconds'] += elapsed
+        stats['peak_memory'] = peak_memory()
+
+        path = ';'.join([s.name for s in _stack] + [self.name])
+        _folded[path] += self_seconds
+        return False
+
+
+def stage(name):
+    """ Returns a context manager that records the enclosed block as stage name """
+    return _Stage(name)
+
+
+def timed(name):
+    """ Decorator recording every call of the function as stage name """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+            with _Stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def stats():
+    """ Returns {stage: {calls, seconds, self_seconds, peak_memory}} recorded so far """
+    return {name: dict(s) for name, s in _stats.items()}
+
+
+def report():
+    """ Returns the recorded stages as a table, slowest first """
+    lines = ['{:<24} {:>10} {:>12} {:>12} {:>12}'.format('stage', 'calls', 'total (s)', 'self (s)', 'peak MB')]
+    for name, s in sorted(_stats.items(), key=lambda item: -item[1]['seconds']):
+        peak = '{:.1f}'.format(s['peak_memory'] / 2 ** 20) if s['peak_memory'] is not None else '-'
+        lines.append('{:<24} {:>10} {:>12.4f} {:>12.4f} {:>12}'.format(
+            name, s['calls'], s['seconds'], s['self_seconds'], peak))
+    return '\n'.join(lines)
+
+
+def write_json(filename):
+    with open(filename, 'w') as f:
+        json.dump(stats(), f, indent=2)
+
+
+def write_folded(filename):
+    """
+    Writes the stage stacks in the folded format read by flamegraph.pl and
+    speedscope: one 'outer;inner;stage microseconds' line per stack
+    """
+    with open(filename, 'w') as f:
+        for path, seconds in sorted(_folded.items()):
+            f.write('{} {}\n'.format(path, int(round(seconds * 1e6))))
+
+
+def profile_call(prefix, func, *args, **kwargs):
+    """
+    Calls func(*args, **kwargs) with stage timing and cProfile enabled, then
+    prints the stage report and writes prefix.json (stage stats),
+    prefix.folded (flame graph stacks) and prefix.pstats (cProfile, for
+    pstats or snakeviz). Returns what func returned
+    """
+    enable()
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        profiler.disable()
+        disable()
+
+        output_dir = os.path.dirname(prefix)
+        if output_dir and not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+        profiler.dump_stats(prefix + '.pstats')
+        write_json(prefix + '.json')
+        write_folded(prefix + '.folded')
+        print(report())
+        print("Profile written to {0}.pstats, {0}.json and {0}.folded".format(prefix))
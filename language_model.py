@@ -1,12 +1,17 @@
 import math
+import time
 import numpy as np
-from itertools import permutations
+from numpy.lib.stride_tricks import as_strided
 
+from cache import LRUCache
+from instrumentation import stage, timed
 from preprocessing import CorpusBuilder
 from ngram import NGramCounts
 from probability import LaplaceProbabilityGenerator
 from probability import RawProbabilityGenerator
-from utils import window, START_SYMBOL, END_SYMBOL
+from sampler import Sampler
+from search import order_words
+from vocabulary import EncodedText
 
 
 class LanguageModel(object):
@@ -17,24 +22,38 @@ class LanguageModel(object):
     def evaluate(self):
         raise NotImplementedError
 
-    def unscramble(self, text):
-        self.cache = {}  # cache may get quite large if not cleared
+    def _check_counts(self):
+        """ Brings anything derived from the counts up to date with them """
+        pass
+
+    @timed('unscramble')
+    def unscramble(self, text, beam_width=None, max_expansions=None, timeout=None):
+        """
+        Returns the ordering of the words in text that the model finds most
+        likely, and its log probability. The search is exact unless
+        beam_width or max_expansions is given (see search.order_words).
+        If it takes longer than timeout seconds, search.SearchTimeout is raised
+        """
+        self._check_counts()
         if self.ngram_counts.corpus_builder.stemmed:
             unstemmed_words = np.array(text.split())
-            words = np.array(self.ngram_counts.corpus_builder.stem(text)[0].split())
+            words = self.ngram_counts.corpus_builder.stem(text)[0].split()
         else:
-            words = np.array(text.split())
-            unstemmed_words = words
+            words = text.split()
+            unstemmed_words = np.array(words)
 
-        best_sentence_indices, best_log_prob = [], float('-inf')
-        for p in permutations(range(len(words))):
-            p = list(p)
-            sentence = ' '.join(words[p])
-            prob = self.text_log_prob(sentence)
-            if prob >= best_log_prob:
-                best_sentence_indices, best_log_prob = p, prob
+        best_sentence_indices, best_log_prob = order_words(
+            words,
+            self.word_log_prob,
+            self.n,
+            beam_width=beam_width,
+            max_expansions=max_expansions,
+            deadline=time.time() + timeout if timeout is not None else None,
+        )
+        return ' '.join(list(unstemmed_words[best_sentence_indices])), best_log_prob
 
-        return ' '.join(list(unstemmed_words[best_sentence_indices]))
+    def word_log_prob(self, history, word):
+        raise NotImplementedError
 
     def text_log_prob(self, text):
         raise NotImplementedError
@@ -45,15 +64,52 @@ class NGramLanguageModel(LanguageModel):
     def __init__(self,
                  n=3,
                  probability_generator=RawProbabilityGenerator,
+                 cache_size=2 ** 20,
                  **kwargs):
+        """
+        cache_size bounds the number of word probabilities kept in the LRU
+        cache shared by every call; see self.cache.stats()
+        An already loaded NGramCounts can be shared between models by passing
+        it as ngram_counts
+        """
         self.n = n
         corpus_builder = kwargs.pop('corpus_builder', None)
-        self.ngram_counts = NGramCounts(self.n, corpus_builder=corpus_builder)
-        self.probability_generator = probability_generator(
-            self.ngram_counts,
+        self.ngram_counts = kwargs.pop('ngram_counts', None)
+        if self.ngram_counts is None:
+            self.ngram_counts = NGramCounts(self.n, corpus_builder=corpus_builder)
+
+        # Arguments that build this model again, e.g. in another process
+        self.config = dict(
+            n=n,
+            probability_generator=probability_generator,
+            cache_size=cache_size,
+            corpus_builder=self.ngram_counts.corpus_builder,
             **kwargs
         )
-        self.cache = {}
+        self.probability_generator_kwargs = kwargs
+        with stage('probability_generation'):
+            self.probability_generator = probability_generator(
+                self.ngram_counts,
+                **kwargs
+            )
+        self.cache = LRUCache(cache_size)
+        # {(temperature, top_k): Sampler}, built on first use
+        self.samplers = {}
+
+    def _check_counts(self):
+        """
+        Regenerates the probabilities (and empties the cache) if the counts
+        were updated since they were generated (see NGramCounts.update_counts)
+        """
+        if self.probability_generator.generation == self.ngram_counts.generation:
+            return
+        with stage('probability_generation'):
+            self.probability_generator = type(self.probability_generator)(
+                self.ngram_counts,
+                **self.probability_generator_kwargs
+            )
+        self.cache.clear()
+        self.samplers.clear()
 
     def __str__(self):
         gram = "{}-gram".format(self.n)
@@ -66,91 +122,178 @@ class NGramLanguageModel(LanguageModel):
         test_text = self._load_test_text(test_text_file)
         return self.perplexity(test_text)
 
+    @timed('test_text_load')
     def _load_test_text(self, test_text_file):
         """
-        Takes the filename of a text corpus to be evaluated and returns the loaded text as sentences
-        If the filename is None, returns the test set from the train/test corpus split
+        Takes the filename of a text corpus to be evaluated and returns its
+        sentences, already tokenized (and stemmed, for a stemmed model) to
+        word ids as a vocabulary.EncodedText
+        If the filename is TEST_CORPUS, returns the test set from the train/test corpus split
         """
-
+        corpus_builder = self.ngram_counts.corpus_builder
+        vocabulary = self.ngram_counts.vocabulary
         if test_text_file == 'TEST_CORPUS':
-            corpus_builder = self.ngram_counts.corpus_builder 
-            train_corpus, test_corpus = corpus_builder.load_corpus()
-            sentences = [" ".join(s) for s in test_corpus]
-            return sentences
+            # Already split into words, and stemmed for a stemmed corpus
+            return vocabulary.encode_sentences(corpus_builder.load_test_corpus())
         else:
             with open(test_text_file, 'r') as f:
                 text = f.read().strip()
-            sentences = text.split('.')
+            return corpus_builder.encode(text.split('.'), vocabulary)
 
-            # If using a stemmed model, need to stem test input
-            if self.ngram_counts.corpus_builder.stemmed:
-                sentences = self.ngram_counts.corpus_builder.stem(sentences)
+    @timed('sampling')
+    def sample(self, num_sentences=1, seed=None, temperature=1.0, top_k=None, max_length=50):
+        """
+        Returns num_sentences sentences drawn at random from the model, in
+        one vectorized batch (see sampler.Sampler). The same seed gives the
+        same sentences. The cumulative distributions for each temperature and
+        top_k are built on first use and kept
+        """
+        self._check_counts()
+        key = (temperature, top_k)
+        if key not in self.samplers:
+            with stage('sampler_build'):
+                self.samplers[key] = Sampler(self.probability_generator, self.n, temperature, top_k)
+        return self.samplers[key].sample(num_sentences, seed, max_length)
 
-            return sentences
+    def encode(self, text):
+        """
+        Returns text, a sentence or list of sentences of words as the model
+        counts them (i.e. already stemmed for a stemmed model), as a
+        vocabulary.EncodedText. EncodedText is returned as it is, so scoring
+        methods take either; it must have been encoded since the counts
+        were last updated
+        """
+        if isinstance(text, EncodedText):
+            return text
+        if isinstance(text, str):
+            text = [text]
+        return self.ngram_counts.vocabulary.encode_sentences(text)
 
+    @timed('perplexity')
     def perplexity(self, text):
         """
         Computes the perplexity of a piece of text as:
             (prod(1/Pr(w|words before))^(1/N)
-        Takes either a string or a list of strings (sentences)
+        Takes a string, a list of strings (sentences) or an EncodedText
         """
-
-        if isinstance(text, str):
-            text = [text]
-
-        running_log_prob = 0
+        text = self.encode(text)
 
         # Text length = number of words + start and end symbol for each sentence
-        text_len = sum([len(s.split()) + 2 for s in text])
-        # print(text_len)
+        text_len = text.lengths.sum()
 
-        for i, sentence in enumerate(text):
-            sentence_log_prob = self.text_log_prob(sentence)
-            running_log_prob += sentence_log_prob
-            # print(i, running_log_prob)
+        running_log_prob = self.score_batch(text).sum()
 
         log_perplexity = - 1 / text_len * running_log_prob
         perplexity = math.exp(log_perplexity)
         return perplexity
 
+    @timed('perplexity')
+    def perplexity_sweep(self, text, **parameters):
+        """
+        Computes perplexity(text) for many values of the probability
+        generator's smoothing parameter at once, e.g.
+        perplexity_sweep(text, k=[1, 2, 3]) for a Laplace model. Every value
+        is evaluated in one vectorized call per order, and no table is copied.
+        Returns an array with one perplexity per value
+        """
+        self._check_counts()
+        text = self.encode(text)
+
+        text_len = text.lengths.sum()
+
+        running_log_prob = 0
+        for log_probs in self._score_ngrams(self._gather_ngrams(text), **parameters):
+            running_log_prob = running_log_prob + log_probs.sum(axis=-1)
+
+        with np.errstate(over='ignore'):
+            return np.exp(- 1 / text_len * np.asarray(running_log_prob))
+
+    @timed('scoring')
+    def score_batch(self, sentences):
+        """
+        Returns an array of text_log_prob for each sentence (a list of
+        strings, or an EncodedText), computed with array operations
+        (see _gather_ngrams)
+        """
+        self._check_counts()
+        sentences = self.encode(sentences)
+        lengths = sentences.lengths
+        log_probs = np.empty(lengths.sum())
+        gathered = self._gather_ngrams(sentences)
+        for (k, ends, ngrams), order_log_probs in zip(gathered, self._score_ngrams(gathered)):
+            log_probs[ends] = order_log_probs
+
+        sentence_ids = np.repeat(np.arange(len(lengths)), lengths)
+        return np.bincount(sentence_ids, weights=log_probs, minlength=len(lengths))
+
+    def _gather_ngrams(self, text):
+        """
+        Gathers the n-gram ending at each token of an EncodedText with stride
+        tricks, grouped by the model order that scores it, so each order can
+        be looked up in one batch
+        Returns [(order, token positions, (m, order) ids)]
+        """
+        ids, lengths = text
+        if not len(lengths):
+            return []
+
+        # For first N - 1 words of each sentence, have to use a lower order model
+        starts = np.cumsum(lengths) - lengths
+        positions = np.arange(len(ids)) - np.repeat(starts, lengths)
+        token_orders = np.minimum(positions + 1, self.n)
+
+        orders = []
+        for k in range(1, self.n + 1):
+            ends = np.flatnonzero(token_orders == k)
+            if not len(ends):
+                continue
+            # Row i of windows is the k ids starting at ids[i]
+            windows = as_strided(ids, shape=(len(ids) - k + 1, k), strides=(ids.strides[0],) * 2)
+            orders.append((k, ends, windows[ends - k + 1]))
+        return orders
+
+    def _score_ngrams(self, gathered, **parameters):
+        """
+        Returns the log probabilities of the n-grams of every order gathered
+        by _gather_ngrams, looked up together
+        """
+        return self.probability_generator.log_probability_batches(
+            [(k, ngrams) for k, ends, ngrams in gathered], **parameters)
+
+    @timed('scoring')
     def text_log_prob(self, text):
         """
         Returns the probability of the text as generated by:
             Prod( Pr(w_k | w_k - 1, ..., w_k - (n - 1)) )
         """
+        return float(self.score_batch([text])[0])
+
+    def word_log_prob(self, history, word):
+        """
+        Returns log Pr(word | history), using the model of order
+        len(history) + 1
+        """
+        n = len(history) + 1
+        cache_key = tuple(history) + (word, n)
+        probability = self.cache.get(cache_key)
+        if probability is None:
+            probability = self.probability_generator.get_probability(
+                history,
+                word,
+                n=n,
+            )
+            self.cache.put(cache_key, probability)
 
-        text = [START_SYMBOL] + text.split() + [END_SYMBOL]
-        running_prob = 0
-        for w in window(text, self.n, left_nulls=True):
-            # for first N - 1 words, have to use a lower order model
-            n = self.n - len([a for a in w if a is None])
-            w = [a for a in w if a is not None]
-            cache_key = tuple(w + [n])
-            if cache_key in self.cache:
-                probability = self.cache[cache_key]
-            else:
-                probability = self.probability_generator.get_probabilities(
-                    w,
-                    n=n,
-                )
-                indices = [k for k in probability.keys()]
-                probability = probability[indices[0]] if indices else 0
-                self.cache[cache_key] = probability
-
-            if probability == 0:
-                return float('-inf')
-
-            running_prob += math.log(probability)
-            # print(w, n, probability, running_prob)
-        # print(text, running_prob)
-        return running_prob
+        if probability == 0:
+            return float('-inf')
+        return math.log(probability)
 
 if __name__ == '__main__':
     cb = CorpusBuilder(stemmed=True)
     ng = NGramLanguageModel(probability_generator=LaplaceProbabilityGenerator, corpus_builder=cb)
     # print(ng.probability_generator.probs.keys())
     # ng.text_log_prob('What you only need to ask')
-    print(ng.unscramble('needed You only'))
+    print(ng.unscramble('needed You only')[0])
     # print(ng.perplexity('you only need What to ask'))
     # print(ng.perplexity('What you only need to ask'))
     # print(ng.evaluate())
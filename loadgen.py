@@ -0,0 +1,171 @@
+"""
+Load generator for server.py: sends requests from several threads at once
+and reports throughput and latency percentiles.
+
+    python loadgen.py 3:unstemmed:laplace:k=1 sentences.txt --requests 2000 --concurrency 16
+"""
+import http.client
+import json
+import socket
+import threading
+import time
+import numpy as np
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    """ HTTPConnection over a Unix socket """
+
+    def __init__(self, socket_path, timeout=None):
+        super().__init__('localhost', timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not None:
+            self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+class ScoringClient(object):
+    """ Client for one server.py connection; not shared between threads """
+
+    def __init__(self, host='127.0.0.1', port=8000, socket_path=None, timeout=60):
+        if socket_path:
+            self.connection = UnixHTTPConnection(socket_path, timeout=timeout)
+        else:
+            self.connection = http.client.HTTPConnection(host, port, timeout=timeout)
+
+    def request(self, endpoint, **body):
+        """ POSTs body to /endpoint, returns the decoded response """
+        self.connection.request(
+            'POST',
+            '/' + endpoint,
+            body=json.dumps(body).encode('utf-8'),
+            headers={'Content-Type': 'application/json'},
+        )
+        response = self.connection.getresponse()
+        result = json.loads(response.read().decode('utf-8'))
+        if response.status != 200:
+            raise RuntimeError("{} {}: {}".format(response.status, endpoint, result.get('error')))
+        return result
+
+    def perplexity(self, model, text):
+        return self.request('perplexity', model=model, text=text)['perplexity']
+
+    def text_log_prob(self, model, text):
+        return self.request('text_log_prob', model=model, text=text)['log_prob']
+
+    def unscramble(self, model, text, beam_width=None):
+        result = self.request('unscramble', model=model, text=text, beam_width=beam_width)
+        return result['sentence'], result['log_prob']
+
+    def close(self):
+        self.connection.close()
+
+
+def load_test(model, sentences, endpoint='text_log_prob', requests=1000, concurrency=8,
+              host='127.0.0.1', port=8000, socket_path=None, beam_width=None):
+    """
+    Sends requests requests (cycling through sentences, one per request) from
+    concurrency threads, each with its own keep-alive connection.
+    Returns a dict of throughput (requests/second) and latency percentiles (seconds)
+    """
+    latencies = []
+    errors = []
+    next_request = iter(range(requests))
+    lock = threading.Lock()
+
+    def worker():
+        client = ScoringClient(host, port, socket_path)
+        try:
+            while True:
+                with lock:
+                    i = next(next_request, None)
+                if i is None:
+                    return
+                sentence = sentences[i % len(sentences)]
+                kwargs = {'beam_width': beam_width} if endpoint == 'unscramble' else {}
+                start = time.time()
+                try:
+                    client.request(endpoint, model=model, text=sentence, **kwargs)
+                except Exception as e:
+                    with lock:
+                        errors.append(str(e))
+                    client.close()
+                    client = ScoringClient(host, port, socket_path)
+                    continue
+                latency = time.time() - start
+                with lock:
+                    latencies.append(latency)
+        finally:
+            client.close()
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+
+    latencies = np.array(latencies)
+    results = {
+        'endpoint': endpoint,
+        'requests': requests,
+        'concurrency': concurrency,
+        'errors': len(errors),
+        'first_error': errors[0] if errors else None,
+        'seconds': elapsed,
+        'throughput': len(latencies) / elapsed,
+    }
+    if len(latencies):
+        results.update({
+            'mean_latency': latencies.mean(),
+            'p50_latency': np.percentile(latencies, 50),
+            'p99_latency': np.percentile(latencies, 99),
+            'max_latency': latencies.max(),
+        })
+    return results
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Measure throughput and latency of server.py')
+    parser.add_argument('model', help='Model spec the server has loaded')
+    parser.add_argument('file', help="Text file of sentences to send, split on '.'")
+    parser.add_argument(
+        '--endpoint',
+        choices=['perplexity', 'text_log_prob', 'unscramble'],
+        default='text_log_prob',
+    )
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--beam_width', type=int, help='Beam width for unscramble requests')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--socket', help='Connect to this Unix socket instead of host:port')
+    args = parser.parse_args()
+
+    with open(args.file) as f:
+        sentences = [s.strip() for s in f.read().split('.') if s.strip()]
+
+    results = load_test(
+        args.model,
+        sentences,
+        endpoint=args.endpoint,
+        requests=args.requests,
+        concurrency=args.concurrency,
+        host=args.host,
+        port=args.port,
+        socket_path=args.socket,
+        beam_width=args.beam_width,
+    )
+    print("{requests} {endpoint} requests, {concurrency} at a time: {errors} errors".format(**results))
+    if results['first_error']:
+        print("First error: {}".format(results['first_error']))
+    print("Throughput: {:.1f} requests/second".format(results['throughput']))
+    if 'p99_latency' in results:
+        print("Latency: mean {:.2f} ms, p50 {:.2f} ms, p99 {:.2f} ms, max {:.2f} ms".format(
+            *(1000 * results[k] for k in ('mean_latency', 'p50_latency', 'p99_latency', 'max_latency'))
+        ))
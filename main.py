@@ -1,48 +1,105 @@
+import instrumentation
 from language_model import NGramLanguageModel
+from ngram import NGramCounts
 from preprocessing import CorpusBuilder
-from probability import AbsoluteDiscountProbabilityGenerator
-from probability import LaplaceProbabilityGenerator
-from probability import RawProbabilityGenerator
-
-
-PROBABILITY_GENERATORS = {
-    'raw': RawProbabilityGenerator,
-    'laplace': LaplaceProbabilityGenerator,
-    'abs_dis': AbsoluteDiscountProbabilityGenerator,
-}
+from probability import PROBABILITY_GENERATORS
+from streaming import stream_perplexity
+from sweep import SWEEP_PARAMETERS, sweep
+from unscramble import unscramble_lines
+from vocabulary import KeyWidthError
 
 
 def main(n=1,
          evaluate=None,
          unscramble=None,
+         sample=None,
          probability_generator=None,
          stemmed=False,
          unstemmed=True,
+         search='exact',
+         beam_width=None,
+         processes=None,
+         timeout=None,
+         max_expansions=None,
+         update=False,
+         seed=None,
+         temperature=1.0,
+         top_k=None,
+         max_length=50,
+         stream=False,
+         chunk_size=2 ** 22,
          **probability_generator_kwargs):
 
+    if probability_generator == 'sweep':
+        if not evaluate:
+            raise ValueError("sweep needs a file to evaluate on (-evaluate)")
+        sweep(evaluate, processes=processes, **probability_generator_kwargs)
+        return
+
     stemmed = unstemmed or stemmed
     cb = CorpusBuilder(stemmed=stemmed)
     probability_generator_kwargs['corpus_builder'] = cb
+    if update:
+        ngram_counts = NGramCounts(n, corpus_builder=cb)
+        ngram_counts.update_counts()
+        probability_generator_kwargs['ngram_counts'] = ngram_counts
     language_model = NGramLanguageModel(
         n=n,
         probability_generator=PROBABILITY_GENERATORS[probability_generator],
         **probability_generator_kwargs
     )
     print(str(language_model))
-    if evaluate:
+    if evaluate and stream and evaluate != 'TEST_CORPUS':
+        # The last progress reported covers the whole file
+        for progress in stream_perplexity(language_model, evaluate, chunk_size, processes):
+            print("{sentences} sentences, {tokens} tokens: perplexity {perplexity:.4f} "
+                  "({tokens_per_second:.0f} tokens/s)".format(**progress))
+        print("Perplexity: {}".format(progress['perplexity']))
+    elif evaluate:
         perplexity = language_model.evaluate(evaluate)
         print("Perplexity: {}".format(perplexity))
     elif unscramble:
+        # One scrambled sentence per line
         with open(unscramble) as f:
-            text = f.read().strip()
-        unscrambled = language_model.unscramble(text)
-        unscrambled_perplexity = language_model.perplexity(unscrambled)
-        scrambled_perplexity = language_model.perplexity(text)
-        print("Original Text: {}".format(text))
-        print("Unscrambled sentence: {}".format(unscrambled))
-        print("Original perplexity: {0}; Unscrambled perplexity: {1}".format(scrambled_perplexity, unscrambled_perplexity))
-        print(language_model.text_log_prob(text))
-        print(language_model.text_log_prob(unscrambled))
+            lines = [line.strip() for line in f if line.strip()]
+        if search == 'exact':
+            beam_width = None
+        if len(lines) == 1:
+            processes = 1
+        results = unscramble_lines(
+            language_model,
+            lines,
+            processes=processes,
+            beam_width=beam_width,
+            max_expansions=max_expansions,
+            timeout=timeout,
+        )
+        for result in results:
+            if result['index']:
+                print()
+            print("Original Text: {}".format(result['text']))
+            if result['status'] == 'timeout':
+                print("Timed out after {:.1f} seconds".format(result['seconds']))
+            elif result['status'] == 'error':
+                print("Failed: {}".format(result['error']))
+            else:
+                print("Unscrambled sentence: {}".format(result['sentence']))
+                print("Original perplexity: {0}; Unscrambled perplexity: {1}".format(result['text_perplexity'], result['perplexity']))
+                print("Original log probability: {0}; Unscrambled log probability: {1}".format(result['text_log_prob'], result['log_prob']))
+
+    elif sample:
+        sentences = language_model.sample(
+            sample,
+            seed=seed,
+            temperature=temperature,
+            top_k=top_k,
+            max_length=max_length,
+        )
+        for sentence in sentences:
+            print(sentence)
+
+    if instrumentation.is_enabled():
+        print("Word probability cache: {}".format(language_model.cache.stats()))
 
 if __name__ == '__main__':
     import argparse
@@ -58,6 +115,12 @@ if __name__ == '__main__':
         help=evaluate_help,
     )
     evaluate_unscramble.add_argument('-unscramble', metavar='file')
+    evaluate_unscramble.add_argument(
+        '-sample',
+        metavar='N',
+        type=int,
+        help='Print N sentences drawn at random from the model',
+    )
 
     stemmed_unstemmed = parser.add_mutually_exclusive_group()
     stemmed_unstemmed.add_argument(
@@ -102,6 +165,97 @@ if __name__ == '__main__':
         default=1,
     )
 
+    def positive_float(string):
+        try:
+            val = float(string)
+            if val > 0:
+                return val
+        except ValueError:
+            pass
+        message = "{} must be a positive number.".format(string)
+        raise argparse.ArgumentTypeError(message)
+
+    parser.add_argument(
+        '--search',
+        help='Search used to unscramble: exact dynamic programming or beam search',
+        choices=['exact', 'beam'],
+        default='exact',
+    )
+    parser.add_argument(
+        '--beam_width',
+        help='Number of partial sentences kept per word by beam search',
+        type=nonnegative_int,
+        default=100,
+    )
+    parser.add_argument(
+        '--max_expansions',
+        help='Most probability lookups the search may make per sentence',
+        type=nonnegative_int,
+    )
+    parser.add_argument(
+        '--timeout',
+        help='Seconds to give up unscrambling a sentence after',
+        type=positive_float,
+    )
+    parser.add_argument(
+        '--processes',
+        help='Number of processes to unscramble sentences, score --stream chunks or '
+             'evaluate sweep models with (default: one per CPU)',
+        type=nonnegative_int,
+    )
+    parser.add_argument(
+        '--seed',
+        help='Random seed for -sample',
+        type=int,
+    )
+    parser.add_argument(
+        '--temperature',
+        help='Above 1 flattens, below 1 sharpens the distributions -sample draws from',
+        type=positive_float,
+        default=1.0,
+    )
+    parser.add_argument(
+        '--top_k',
+        help='Only let -sample draw from the K most probable next words',
+        metavar='K',
+        type=nonnegative_int,
+    )
+    parser.add_argument(
+        '--max_length',
+        help='Most words in a sentence drawn by -sample',
+        type=nonnegative_int,
+        default=50,
+    )
+    parser.add_argument(
+        '--stream',
+        help='Evaluate the file a chunk at a time, reporting the running perplexity \
+            (across --processes processes)',
+        action='store_true',
+    )
+    parser.add_argument(
+        '--chunk_size',
+        help='Characters read at a time by --stream',
+        type=nonnegative_int,
+        default=2 ** 22,
+    )
+    parser.add_argument(
+        '--update',
+        help='First add corpus files that are new or changed to the stored counts',
+        action='store_true',
+    )
+    parser.add_argument(
+        '--profile',
+        help='Time each stage and write PREFIX.json, PREFIX.folded (flame graph) \
+            and PREFIX.pstats (cProfile)',
+        action='store_true',
+    )
+    parser.add_argument(
+        '--profile_output',
+        help='PREFIX of the files written by --profile',
+        metavar='PREFIX',
+        default='output_data/profile',
+    )
+
     subparsers = parser.add_subparsers(
         dest='probability_generator',
         help='options for language models',
@@ -134,5 +288,96 @@ if __name__ == '__main__':
         default=0.3,
     )
 
-    args = parser.parse_args()
-    main(**vars(args))
+    kneser_ney_parser = subparsers.add_parser(
+        'kneser_ney',
+        help='Interpolated Kneser-Ney Probability Model',
+    )
+    kneser_ney_parser.add_argument(
+        '-D',
+        '--D',
+        type=between_zero_and_one,
+        help='Amount to discount every count by',
+        required=False,
+        default=0.75,
+    )
+
+    katz_parser = subparsers.add_parser(
+        'katz',
+        help='Katz Backoff Probability Model',
+    )
+    katz_parser.add_argument(
+        '-K',
+        '--K',
+        type=nonnegative_int,
+        help='Counts up to K are discounted with Good-Turing estimates',
+        required=False,
+        default=5,
+    )
+
+    compact_parser = subparsers.add_parser(
+        'compact',
+        help='Pruned/quantized model written by compact.py',
+    )
+    compact_parser.add_argument(
+        '--model',
+        dest='filename',
+        metavar='file',
+        help='Compact model file',
+        required=True,
+    )
+
+    sweep_parser = subparsers.add_parser(
+        'sweep',
+        help='Evaluate a grid of models, writing the perplexities to output_data/',
+    )
+    sweep_parser.add_argument(
+        '--ns',
+        type=nonnegative_int,
+        nargs='+',
+        default=[1, 2, 3],
+        help='n-gram models to evaluate',
+    )
+    sweep_parser.add_argument(
+        '--smoothings',
+        choices=sorted(SWEEP_PARAMETERS),
+        nargs='+',
+        default=sorted(SWEEP_PARAMETERS),
+        help='Probability models to evaluate',
+    )
+    sweep_parser.add_argument(
+        '--ks',
+        type=nonnegative_int,
+        nargs='+',
+        default=[1, 2, 3, 4, 5],
+        help='Values of k to evaluate Laplace models with',
+    )
+    sweep_parser.add_argument(
+        '--Ds',
+        type=between_zero_and_one,
+        nargs='+',
+        default=[0.1, 0.2, 0.3, 0.4, 0.5],
+        help='Values of D to evaluate Absolute Discount models with',
+    )
+    sweep_parser.add_argument(
+        '--corpora',
+        choices=['stemmed', 'unstemmed'],
+        nargs='+',
+        default=['unstemmed'],
+        help='Corpora to build models from',
+    )
+    sweep_parser.add_argument(
+        '--output',
+        default='output_data/perplexity_sweep',
+        help='Results are written to OUTPUT.csv and OUTPUT.json',
+    )
+
+    args = vars(parser.parse_args())
+    profile, profile_output = args.pop('profile'), args.pop('profile_output')
+    try:
+        if profile:
+            instrumentation.profile_call(profile_output, main, **args)
+        else:
+            main(**args)
+    except KeyWidthError as e:
+        # n-grams too long to pack into a key for the vocabulary of the corpus
+        parser.error(str(e))
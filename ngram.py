@@ -1,82 +1,611 @@
-import os, pickle
+import glob
+import os
+import shutil
+import tempfile
+from multiprocessing import cpu_count
 import pandas as pd
 import numpy as np
-from collections import defaultdict
+from artifacts import content_key
 from preprocessing import CorpusBuilder
-from utils import window, START_SYMBOL, END_SYMBOL
+from instrumentation import timed
+from utils import parallel_map, PerOrder, START_SYMBOL, END_SYMBOL
+from store import convert_pickle, read_counts, write_counts
+from vocabulary import Vocabulary, check_key_width, key_dtype, pack, unpack, history_keys, last_ids
+
+
+def find_keys(sorted_keys, keys):
+    """ Returns the position of each key in the sorted_keys array, or -1 if it is missing """
+    keys = np.asarray(keys, dtype=sorted_keys.dtype)
+    if not len(sorted_keys):
+        return np.full(keys.shape, -1, dtype=np.int64)
+    positions = np.minimum(np.searchsorted(sorted_keys, keys), len(sorted_keys) - 1)
+    return np.where(sorted_keys[positions] == keys, positions, -1)
+
+
+def count_ngrams(ids, lengths, n, bits, orders=None):
+    """
+    Counts the n-grams of every order 1..n (or just of orders) in a set of
+    sentences, given as a flat array of word ids and the length of each sentence
+    Returns {order: (sorted keys, counts)}; n-grams never span sentences
+    """
+    sentence_ids = np.repeat(np.arange(len(lengths)), lengths)
+    counts = {}
+    for i in (range(1, n + 1) if orders is None else orders):
+        m = len(ids) - i + 1
+        if m <= 0:
+            counts[i] = (np.zeros(0, dtype=key_dtype(i, bits)), np.zeros(0, dtype=np.int64))
+            continue
+
+        # Keep only windows that start and end in the same sentence
+        valid = sentence_ids[:m] == sentence_ids[i-1:]
+        windows = np.column_stack([ids[j:j+m][valid] for j in range(i)])
+        keys, key_counts = np.unique(pack(windows, bits), return_counts=True)
+        counts[i] = (keys, key_counts.astype(np.int64))
+    return counts
+
+
+def merge_counts(parts):
+    """ Merges several (sorted keys, counts) parts into one, summing the counts of shared keys """
+    dtype = parts[0][0].dtype if parts else np.uint64
+    parts = [part for part in parts if len(part[0])]
+    if not parts:
+        return np.zeros(0, dtype=dtype), np.zeros(0, dtype=np.int64)
+    if len(parts) == 1:
+        return parts[0]
+    keys, inverse = np.unique(np.concatenate([k for k, c in parts]), return_inverse=True)
+    counts = np.zeros(len(keys), dtype=np.int64)
+    np.add.at(counts, inverse, np.concatenate([c for k, c in parts]))
+    return keys, counts
+
+
+def merge_runs(runs, output_prefix, block_size=2 ** 20):
+    """
+    External k-way merge of sorted (keys, counts) runs, usually memory maps
+    of spilled partial counts. Reads block_size keys of each run at a time
+    and appends the merged result to output_prefix + '.keys'/'.counts', so
+    memory stays bounded however large the runs are.
+    Returns (keys, counts) memory maps of the merged output
+    """
+    positions = [0] * len(runs)
+    dtype = runs[0][0].dtype
+    with open(output_prefix + '.keys', 'wb') as keys_file, open(output_prefix + '.counts', 'wb') as counts_file:
+        while True:
+            active = [r for r, (keys, _) in enumerate(runs) if positions[r] < len(keys)]
+            if not active:
+                break
+
+            # Everything up to the smallest last key of a partially read run
+            # can be merged now: no run holds smaller keys beyond its block
+            ends = {r: min(positions[r] + block_size, len(runs[r][0])) for r in active}
+            partial = [runs[r][0][ends[r] - 1:ends[r]] for r in active if ends[r] < len(runs[r][0])]
+            threshold = np.sort(np.concatenate(partial))[0] if partial else None
+
+            blocks = []
+            for r in active:
+                keys, counts = runs[r]
+                block = np.asarray(keys[positions[r]:ends[r]])
+                take = len(block) if threshold is None else np.searchsorted(block, threshold, side='right')
+                blocks.append((block[:take], np.asarray(counts[positions[r]:positions[r] + take])))
+                positions[r] += take
+
+            merged_keys, merged_counts = merge_counts(blocks)
+            merged_keys.astype(dtype).tofile(keys_file)
+            merged_counts.astype(np.int64).tofile(counts_file)
+
+    return _load_run(output_prefix, dtype)
+
+
+def _spill_run(counts, output_prefix):
+    keys, key_counts = counts
+    keys.tofile(output_prefix + '.keys')
+    key_counts.astype(np.int64).tofile(output_prefix + '.counts')
+    return _load_run(output_prefix, keys.dtype)
+
+
+def _load_run(prefix, dtype):
+    """ Memory maps a (keys, counts) run of keys of dtype written by _spill_run or merge_runs """
+    if not os.path.getsize(prefix + '.keys'):
+        return np.zeros(0, dtype=dtype), np.zeros(0, dtype=np.int64)
+    return (
+        np.memmap(prefix + '.keys', dtype=dtype, mode='r'),
+        np.memmap(prefix + '.counts', dtype=np.int64, mode='r'),
+    )
+
+
+_worker_vocabulary = None
+
+
+def _init_count_worker(words):
+    global _worker_vocabulary
+    _worker_vocabulary = Vocabulary(words)
+
+
+def _encode_sentences(vocabulary, sentences, add=False):
+    """ Returns (flat array of ids, sentence lengths) for sentences wrapped in START/END """
+    ids = [
+        vocabulary.encode([START_SYMBOL] + s + [END_SYMBOL], add=add)
+        for s in sentences
+    ]
+    lengths = [len(s) for s in ids]
+    ids = np.concatenate(ids) if ids else np.zeros(0, dtype=np.int32)
+    return ids, lengths
+
+
+def _count_shard(shard):
+    """ Encodes a shard of sentences with the worker's vocabulary and counts its n-grams of some orders """
+    sentences, orders = shard
+    ids, lengths = _encode_sentences(_worker_vocabulary, sentences)
+    return count_ngrams(ids, lengths, max(orders), _worker_vocabulary.bits, orders)
+
+
+def apply_delta(filename, added, removed):
+    """
+    Updates the count store filename in place: adds the counts of the
+    added sentences to every order it holds and subtracts those of the
+    removed ones. New words get new ids, in the same order for every store;
+    if the vocabulary outgrows the bits per id, the stored keys are repacked.
+    """
+    data = read_counts(filename)
+    orders = sorted(data['counts'])
+    vocabulary = Vocabulary(data['words'])
+    old_bits = vocabulary.bits
+    added_ids, added_lengths = _encode_sentences(vocabulary, added, add=True)
+    removed_ids, removed_lengths = _encode_sentences(vocabulary, removed, add=True)
+    bits = vocabulary.bits
+    added_counts = count_ngrams(added_ids, added_lengths, max(orders), bits, orders)
+    removed_counts = count_ngrams(removed_ids, removed_lengths, max(orders), bits, orders)
+
+    counts = {}
+    for i in orders:
+        keys, key_counts = data['counts'][i]
+        if bits != old_bits:
+            # Packing with more bits keeps the keys in the same order
+            keys = pack(unpack(keys, i, old_bits), bits)
+        removed_keys, removed_key_counts = removed_counts[i]
+        keys, key_counts = merge_counts([
+            (keys, key_counts),
+            added_counts[i],
+            (removed_keys, -removed_key_counts),
+        ])
+        seen = key_counts > 0
+        counts[i] = (np.asarray(keys)[seen], np.asarray(key_counts)[seen])
+    write_counts(filename, {'words': vocabulary.words, 'counts': counts})
+
+
+def _version_filename(filename):
+    """ Returns the file recording which corpus version a count store was counted from """
+    return os.path.splitext(filename)[0] + '.version'
+
+
+def _read_version(filename):
+    try:
+        with open(_version_filename(filename)) as f:
+            return int(f.read())
+    except (IOError, ValueError):
+        return None
+
+
+def _write_version(filename, version):
+    if version is None:
+        if os.path.exists(_version_filename(filename)):
+            os.remove(_version_filename(filename))
+        return
+    with open(_version_filename(filename), 'w') as f:
+        f.write(str(version))
+
+
+def _count_key(corpus_key, n, stemmed):
+    """ Returns the artifact key of the store of order n counted from the corpus with corpus_key """
+    if corpus_key is None:
+        return None
+    return content_key('counts', corpus_key, {'order': n, 'stemmed': stemmed})
+
+
+class NGramTable(object):
+    """
+    All n-grams of a single order, stored as a sorted array of packed keys
+    (uint64, or WIDE_KEY for long n-grams, see vocabulary.pack) with a
+    parallel array of counts
+    """
+
+    def __init__(self, n, bits, keys, counts):
+        self.n = n
+        self.bits = bits
+        self.keys = keys
+        self.counts = counts
+
+    def __len__(self):
+        return len(self.keys)
+
+    def key(self, ids):
+        """ Packs a single n-gram of ids into its key """
+        return pack(np.asarray(ids).reshape(1, -1), self.bits)[0]
+
+    def find(self, keys):
+        """ Returns the position of each key in the table, or -1 if it is missing """
+        return find_keys(self.keys, keys)
+
+    def prefix_span(self, ids):
+        """
+        Returns the (start, end) positions of all n-grams that begin with the
+        given (possibly shorter than n) sequence of ids
+        """
+        if not len(ids):
+            return 0, len(self.keys)
+        # The first and last keys the n-grams could have: ids padded with
+        # the smallest and the largest id
+        padding = self.n - len(ids)
+        low = self.key(list(ids) + [0] * padding)
+        high = self.key(list(ids) + [(1 << self.bits) - 1] * padding)
+        return (
+            int(np.searchsorted(self.keys, low, side='left')),
+            int(np.searchsorted(self.keys, high, side='right')),
+        )
+
+    def counts_of(self, keys):
+        """ Returns the count of each key, 0 for n-grams not in the table """
+        positions = self.find(keys)
+        counts = np.zeros(len(positions), dtype=np.int64)
+        found = positions >= 0
+        counts[found] = self.counts[positions[found]]
+        return counts
+
+    def ids(self):
+        """ Returns an (m, n) array of the word ids of every n-gram """
+        return unpack(self.keys, self.n, self.bits)
+
+    def history_keys(self):
+        """ Returns the packed key of every n-gram's first n-1 words """
+        return history_keys(self.keys, self.n, self.bits)
+
+    def history_groups(self):
+        """
+        Returns (history keys, offsets): keys are sorted, so the n-grams
+        sharing the i-th distinct history are at [offsets[i], offsets[i+1])
+        """
+        history_keys = self.history_keys()
+        if len(history_keys):
+            boundaries = np.flatnonzero(history_keys[1:] != history_keys[:-1]) + 1
+            starts = np.concatenate([[0], boundaries])
+        else:
+            starts = np.zeros(0, dtype=np.int64)
+        return history_keys[starts], np.append(starts, len(history_keys)).astype(np.int64)
+
+    def last_ids(self):
+        """ Returns the id of every n-gram's last word """
+        return last_ids(self.keys, self.n, self.bits)
+
+    def total(self):
+        return int(self.counts.sum())
+
+    def to_frame(self, vocabulary):
+        """ Returns the table as a DataFrame of | word1 | ... | wordn | count | """
+        words = np.array(vocabulary.words, dtype=object)
+        ids = self.ids()
+        frame = pd.DataFrame({'word' + str(i+1): words[ids[:, i]] for i in range(self.n)})
+        frame['count'] = self.counts
+        return frame
+
 
 class NGramCounts(object):
-    def __init__(self, n, corpus_builder=None):
+    def __init__(self, n, corpus_builder=None, chunk_size=10 ** 7):
+        """
+        chunk_size is the number of tokens counted in memory at a time when
+        building counts from a streamed corpus
+        """
         self.n = n
+        self.chunk_size = chunk_size
 
         # Default CorpusBuilder
         if corpus_builder is None:
             corpus_builder = CorpusBuilder()
 
         self.corpus_builder = corpus_builder
-        self.counts = {}
+        self.vocabulary = None
+        self.tables = {}
+        # {n: (keys, counts)} of the loaded store, see _set_counts
+        self._arrays = {}
+        # Increased every time counts are (re)loaded, so anything computed
+        # from them can tell it is out of date
+        self.generation = 0
 
         # set counts data
         self.load_counts()
 
-    def get_counts(self, n=None):
+    def get_table(self, n=None):
         if n is None:
             n = self.n
 
-        return self.counts[n]
+        return self.tables[n]
+
+    def get_counts(self, n=None):
+        """ Returns the counts of order n as a | word1 | ... | wordn | count | DataFrame """
+        return self.get_table(n).to_frame(self.vocabulary)
+
+    def count_batch(self, keys, n=None):
+        """ Returns the count of each packed key of order n, 0 for unseen n-grams """
+        return self.get_table(n).counts_of(keys)
 
-    def build_counts(self):
+    def count_batches(self, requests):
         """
-        Calculates n-gram counts for all n-grams <= n.
-        The lower-order counts will be necessary for some models.
-        Pickles and stores resulting dict
+        Looks up [(order, packed keys)] at once (sharded counts answer them
+        all in one round trip, see sharding.py)
+        Returns [counts], 0 for unseen n-grams
         """
-        for i in range(1, self.n + 1):
-            self.counts[i] = self._build_counts(i)
-        pickle.dump(dict(self.counts), open(self.filename(), 'wb'))
+        return [self.count_batch(keys, n) for n, keys in requests]
+
+    def total(self, n=None):
+        """ Total count of the n-grams of order n """
+        return self.get_table(n).total()
+
+    def size(self, n=None):
+        """ Number of distinct n-grams of order n """
+        return len(self.get_table(n))
 
-    def _build_counts(self, n):
+    @timed('count_build')
+    def build_counts(self, orders=None):
         """
-        Calculates n-gram counts for a specific n
-        Stores them in a pandas DataFrame as:
-            | word1 | word2 | ... | wordn | count |
+        Calculates n-gram counts for all n-grams <= n (or just of orders).
+        The lower-order counts will be necessary for some models.
+        Counts all orders in one pass over shards of the corpus in parallel
+        and stores the merged tables, each order in its own store
         """
-        # Generate a dictionary of {n-gram tuple: count}
-        counts = defaultdict(int)
+        if orders is None:
+            orders = range(1, self.n + 1)
+        if self.corpus_builder.streaming:
+            self._build_streamed_counts(orders)
+            return
 
-        # Reload corpus every time so that it doesn't need to permanently stay in memory
         train_corpus, test_corpus = self.corpus_builder.load_corpus()
-        for s in train_corpus:
+        corpus_key = self.corpus_builder.corpus_key()
+
+        # Assign ids up front so every shard encodes words identically
+        self.vocabulary, orders = self._assign_ids(orders, lambda: train_corpus)
+
+        processes = self.corpus_builder.processes or cpu_count()
+        shard_size = max(1, -(-len(train_corpus) // processes))
+        shards = [
+            (train_corpus[i:i + shard_size], orders)
+            for i in range(0, len(train_corpus), shard_size)
+        ]
+        parts = parallel_map(
+            _count_shard,
+            shards,
+            self.corpus_builder.processes,
+            initializer=_init_count_worker,
+            initargs=(self.vocabulary.words,),
+        )
 
-            # Add special start and end symbols
-            s = [START_SYMBOL] + s + [END_SYMBOL]
+        bits = self.vocabulary.bits
+        self.tables = {}
+        for i in orders:
+            keys, counts = merge_counts([part[i] for part in parts])
+            self.tables[i] = NGramTable(i, bits, keys, counts)
+        self._dump_counts(orders, corpus_key)
 
-            for n_gram in window(s, n):
-                counts[tuple(n_gram)] += 1
+    def _assign_ids(self, orders, sentences):
+        """
+        Returns (vocabulary, orders) to count orders with, given a function
+        returning an iterable of the train sentences. The stores of the
+        other orders up to n are kept, so the ids are theirs, with any new
+        words added; if there are any, the kept stores are out of step and
+        every order is counted afresh instead
+        """
+        orders = sorted(orders)
+        kept = [k for k in range(1, self.n + 1) if k not in orders]
+        if kept:
+            vocabulary = Vocabulary(read_counts(self.filename(kept[0]))['words'])
+            size = len(vocabulary)
+            for s in sentences():
+                for w in s:
+                    vocabulary.add(w)
+            if len(vocabulary) == size:
+                check_key_width(self.n, vocabulary.bits)
+                return vocabulary, orders
+
+        vocabulary = Vocabulary()
+        for s in sentences():
+            for w in s:
+                vocabulary.add(w)
+        # Before anything is counted, rather than when the keys are packed
+        check_key_width(self.n, vocabulary.bits)
+        return vocabulary, list(range(1, self.n + 1))
+
+    def _build_streamed_counts(self, orders):
+        """
+        Builds counts for a streamed corpus with bounded memory: sentences are
+        counted chunk_size tokens at a time, each chunk's sorted counts are
+        spilled to disk, and the spilled runs are combined with an external
+        k-way merge
+        """
+        corpus_builder = self.corpus_builder
+        corpus_key = corpus_builder.corpus_key()
 
-        # Converts to a list of dictionaries [{'word1': <word1>, ..., 'wordn': <wordn>, 'count': <count>}]
-        lst_of_dicts = []
-        for k, v in counts.items():
-            d = {'word' + str(i+1): w for i, w in enumerate(k)}
-            d['count'] = v
-            lst_of_dicts.append(d)
+        # First pass assigns ids, so every chunk is packed with the same bits
+        self.vocabulary, orders = self._assign_ids(orders, corpus_builder.iter_sentences)
+        num_sentences = sum(1 for _ in corpus_builder.iter_sentences())
+        bits = self.vocabulary.bits
 
-        # Converts list of dicts to a dataframe
-        return pd.DataFrame(lst_of_dicts)
+        spill_dir = tempfile.mkdtemp(dir=corpus_builder.data_path)
+        try:
+            runs = {i: [] for i in orders}
 
+            def spill(ids, lengths):
+                counts = count_ngrams(np.concatenate(ids), lengths, max(orders), bits, orders)
+                for i in runs:
+                    prefix = os.path.join(spill_dir, '%d_%d' % (i, len(runs[i])))
+                    runs[i].append(_spill_run(counts[i], prefix))
+
+            ids, lengths, tokens = [], [], 0
+            for s in corpus_builder.stream_train_corpus(num_sentences):
+                ids.append(self.vocabulary.encode([START_SYMBOL] + s + [END_SYMBOL]))
+                lengths.append(len(ids[-1]))
+                tokens += lengths[-1]
+                if tokens >= self.chunk_size:
+                    spill(ids, lengths)
+                    ids, lengths, tokens = [], [], 0
+            if ids:
+                spill(ids, lengths)
+
+            self.tables = {}
+            for i in orders:
+                keys, counts = merge_runs(runs[i], os.path.join(spill_dir, '%d_merged' % i))
+                self.tables[i] = NGramTable(i, bits, keys, counts)
+            self._dump_counts(orders, corpus_key)
+        finally:
+            # The tables map spill files, which are about to be removed
+            self.tables = {}
+            shutil.rmtree(spill_dir)
+
+    @timed('count_update')
+    def update_counts(self):
+        """
+        Adds the corpus files that are new or changed since the counts were
+        built, without recounting the rest of the corpus: only the sentences
+        added and removed by CorpusBuilder.update_corpus are counted, and
+        merged into the stored counts.
+
+        Every count store of the stemmed and unstemmed corpora is updated
+        with the same change, so none is left behind. Stores that were
+        already out of date with the corpus are deleted, and rebuilt when
+        next loaded. Language models using these counts regenerate their
+        probabilities on their next use.
+        """
+        corpus_builder = self.corpus_builder
+        delta = corpus_builder.update_corpus()
+        version = corpus_builder.corpus_version()
+        corpus_key = corpus_builder.corpus_key()
+        updated, deleted = {}, []
+        for stemmed in (False, True):
+            pattern = '%s/*gram_counts_%s.ngrams' % (corpus_builder.data_path, corpus_builder.suffix(stemmed))
+            for filename in glob.glob(pattern):
+                n = int(os.path.basename(filename).split('gram')[0])
+                stored_version = _read_version(filename)
+                if stored_version == version:
+                    continue
+                if delta is not None and stored_version == delta['from_version']:
+                    apply_delta(filename, delta['added'][stemmed], delta['removed'][stemmed])
+                    _write_version(filename, version)
+                    updated[filename] = _count_key(corpus_key, n, stemmed)
+                else:
+                    os.remove(filename)
+                    _write_version(filename, None)
+                    deleted.append(filename)
+        corpus_builder.artifacts.record(updated)
+        corpus_builder.artifacts.forget(deleted)
+        self.load_counts()
+
+    def _dump_counts(self, orders, corpus_key):
+        """ Writes the table of each of orders to its own store, recording what it was counted from """
+        version = self.corpus_builder.corpus_version()
+        keys = {}
+        for n in orders:
+            table = self.tables[n]
+            write_counts(self.filename(n), {'words': self.vocabulary.words, 'counts': {n: (table.keys, table.counts)}})
+            _write_version(self.filename(n), version)
+            keys[self.filename(n)] = _count_key(corpus_key, n, self.corpus_builder.stemmed)
+        self.corpus_builder.artifacts.record(keys)
+
+    def _set_counts(self, data):
+        """
+        Takes counts data with the arrays of every order memory-mapped. A
+        table is only set up, and its pages only read, once it is used
+        """
+        self.vocabulary = Vocabulary(data['words'])
+        self._arrays = data['counts']
+        self.tables = PerOrder(self._make_table, orders=set(self._arrays))
+        self.generation += 1
+
+    def _make_table(self, n):
+        keys, counts = self._arrays[n]
+        return NGramTable(n, self.vocabulary.bits, keys, counts)
+
+    def stale_orders(self):
+        """
+        Returns the orders up to n whose store is missing, or was counted
+        from another corpus than the text files make now (see
+        CorpusBuilder.corpus_key). Stores counted before their keys were
+        recorded, or converted from count pickles, are taken as they are if
+        they were counted from the current version of the stored corpus
+        """
+        corpus_builder = self.corpus_builder
+        corpus_key = corpus_builder.corpus_key()
+        version = corpus_builder.corpus_version()
+        stale, adopted = [], {}
+        self._convert_pickles()
+        for n in range(1, self.n + 1):
+            filename = self.filename(n)
+            key = _count_key(corpus_key, n, corpus_builder.stemmed)
+            if corpus_builder.artifacts.is_fresh(filename, key):
+                continue
+            if os.path.exists(filename) and corpus_builder.artifacts.key(filename) is None \
+                    and version is not None and _read_version(filename) == version:
+                adopted[filename] = key
+                continue
+            stale.append(n)
+        corpus_builder.artifacts.record(adopted)
+        return stale
+
+    def _convert_pickles(self):
+        """
+        Converts the count pickles of earlier versions, which hold every
+        order up to their own, to stores of the orders that have none. They
+        were counted from the corpus pickled alongside them, so they are
+        marked as counted from the version it was kept as, if it was
+        """
+        corpus_builder = self.corpus_builder
+        pattern = '%s/*gram_counts_%s.pickle' % (corpus_builder.data_path, corpus_builder.suffix())
+        pickles = sorted(glob.glob(pattern), key=lambda f: -int(os.path.basename(f).split('gram')[0]))
+        for pickle_filename in pickles:
+            n = min(self.n, int(os.path.basename(pickle_filename).split('gram')[0]))
+            if all(os.path.exists(self.filename(i)) for i in range(1, n + 1)):
+                continue
+            for filename in convert_pickle(pickle_filename):
+                _write_version(filename, corpus_builder.legacy_version())
+
+    @timed('count_load')
     def load_counts(self, update=False):
-        if update or not os.path.exists(self.filename()):
+        """
+        Loads counts from the memory-mapped binary stores, one per order and
+        shared by the counts of every n. If the text files changed since the
+        corpus was stored, it is first brought up to date with update_counts;
+        orders whose store is then missing or stale are counted, and only
+        those. Count pickles of earlier versions are converted.
+        """
+        corpus_builder = self.corpus_builder
+        if update:
             self.build_counts()
-        self.counts = pickle.load(open(self.filename(), 'rb'))
+        else:
+            if not corpus_builder.streaming and corpus_builder.is_stale():
+                self.update_counts()
+                return
+            stale = self.stale_orders()
+            if stale:
+                self.build_counts(stale)
 
-    def filename(self):
-        suffix = 'stemmed' if self.corpus_builder.stemmed else 'unstemmed'
-        return '%s/%dgram_counts_%s.pickle' % (self.corpus_builder.data_path, self.n, suffix)
+        stores = {n: read_counts(self.filename(n)) for n in range(1, self.n + 1)}
+        words = stores[1]['words']
+        mismatched = [n for n in stores if stores[n]['words'] != words]
+        if mismatched:
+            # Counted with other ids, e.g. by an earlier version: count them again
+            self.build_counts(mismatched)
+            stores = {n: read_counts(self.filename(n)) for n in range(1, self.n + 1)}
+            words = stores[1]['words']
+        self._set_counts({'words': words, 'counts': {n: stores[n]['counts'][n] for n in stores}})
+
+    def filename(self, n=None):
+        """ Returns the filename of the count store of order n (by default, the highest) """
+        if n is None:
+            n = self.n
+        return '%s/%dgram_counts_%s.ngrams' % (self.corpus_builder.data_path, n, self.corpus_builder.suffix())
 
     def lexicon_to_csv(self, output_file):
-        unigram_counts = self.get_counts(n=1)
+        unigrams = self.get_table(n=1)
+        order = np.argsort(-unigrams.counts, kind='mergesort')
+        words = self.vocabulary.decode(unigrams.last_ids()[order])
+        lexicon = pd.DataFrame({'count': unigrams.counts[order], 'word1': words})
         with open(output_file, 'w') as f:
-            f.write(unigram_counts.sort('count', ascending=False).to_csv(index=False))
+            f.write(lexicon.to_csv(index=False))
 
 if __name__ == '__main__':
     NGramCounts(1, corpus_builder=CorpusBuilder(stemmed=True)).lexicon_to_csv('stemmed_lexicon.csv')
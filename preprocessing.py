@@ -3,45 +3,407 @@ import csv
 import glob
 import os
 import pickle
+import random
+from collections import Counter
+import numpy as np
 from sklearn.cross_validation import train_test_split
+from artifacts import ArtifactStore, content_key, file_record
+from instrumentation import timed
+from utils import parallel_map
+
+# How sentences are held out for the test corpus; part of the corpus key
+TEST_SIZE = 100
+SPLIT_SEED = 42
+
+
+def _iter_file(filename, stem_map=None):
+    """
+    Lazily reads one tab separated file of: word, lemma, pos
+    Filters NUL bytes and unwanted symbols
+    Splits it into sentences based on punctuation ('.', '!', '?')
+    Yields (unstemmed sentence, stemmed sentence), adding {word: stem} to
+    stem_map if one is given
+    """
+    with open(filename, 'r') as f:
+        r = csv.DictReader((x.replace('\0', '') for x in f), dialect='excel-tab', quoting=csv.QUOTE_NONE, fieldnames=['word', 'lemma', 'pos'])
+
+        sentence, stemmed_sentence = [], []
+        for row in r:
+            if '#' in row['word'] or '@' in row['word']:
+                continue
+            if stem_map is not None and row['lemma'] != '':
+                stem_map[row['word']] = row['lemma']
+            if '.' in row['pos'] or '!' in row['pos'] or '?' in row['pos']:
+                yield sentence, stemmed_sentence
+                sentence, stemmed_sentence = [], []
+            else:
+                sentence.append(row['word'])
+                if row['lemma'] != '':
+                    stemmed_sentence.append(row['lemma'])
+
+
+def _parse_file(filename):
+    """
+    Parses one corpus file (see _iter_file)
+    Returns (unstemmed sentences, stemmed sentences, {word: stem})
+    """
+    stem_map = {}
+    sentences, stemmed_sentences = [], []
+    for sentence, stemmed_sentence in _iter_file(filename, stem_map):
+        sentences.append(sentence)
+        stemmed_sentences.append(stemmed_sentence)
+    return sentences, stemmed_sentences, stem_map
+
 
 class CorpusBuilder(object):
-    def __init__(self, data_path='data', stemmed=False):
+    def __init__(self, data_path='data', stemmed=False, processes=None, streaming=False):
+        """
+        With streaming=True the corpus is never held in memory: sentences are
+        read lazily from the text files (see stream_train_corpus), so corpora
+        larger than RAM can be used. Streamed corpora have their own held-out
+        test set and their own cache files.
+        """
         self.data_path = data_path
         self.text_dir = self.data_path + '/wordLemPoS'
         self.stemmed = stemmed
         self.stem_map = None
+        self.processes = processes
+        self.streaming = streaming
+        self.artifacts = ArtifactStore(data_path)
 
+    def textfiles(self):
+        return sorted(glob.glob(self.text_dir + '/*.txt'))
+
+    def _parse_files(self, filenames=None):
+        """
+        Parses every corpus file (or just filenames), in parallel across
+        processes. Files are processed in sorted order, so results are
+        deterministic.
+        """
+        if filenames is None:
+            filenames = self.textfiles()
+        return parallel_map(_parse_file, filenames, self.processes)
+
+    @timed('corpus_build')
     def _build_corpus(self):
         """
-        Reads in a text corpus stored as a tab separated file of: word, lemma, pos
-        Filters NUL bytes and unwanted symbols
-        Splits corpus into sentences based on punctuation ('.', '!', '?')
-        Pickles full list of sentences
-        """
-
-        textfiles = glob.glob(self.text_dir + '/*.txt')
-        sentences = []
-        for filename in textfiles:
-            with open(filename, 'r') as f:
-                r = csv.DictReader((x.replace('\0', '') for x in f), dialect='excel-tab', quoting=csv.QUOTE_NONE, fieldnames=['word', 'lemma', 'pos'])
-
-                sentence = []
-                for row in r:
-                    if '#' in row['word'] or '@' in row['word']:
-                        continue
-                    elif '.' in row['pos'] or '!' in row['pos'] or '?' in row['pos']:
-                        sentences.append(sentence)
-                        sentence = []
-                    elif self.stemmed:
-                        if row['lemma'] != '':
-                            sentence.append(row['lemma'])
-                    else:
-                        sentence.append(row['word'])
-
-        train_sentences, test_sentences = train_test_split(sentences, test_size=100, random_state=42)
-        pickle.dump(train_sentences, open(self.filename(), 'wb'))
+        Parses the corpus in a single pass that builds both the stemmed and
+        unstemmed sentences and the stem map
+        Pickles the train/test split of both corpora and the stem map, and
+        the manifest of which file each sentence came from (see update_corpus)
+        """
+        filenames = self.textfiles()
+        keys = self._keys()
+        sentences, stemmed_sentences, stem_map, file_indices = [], [], {}, []
+        for i, parsed in enumerate(self._parse_files(filenames)):
+            file_sentences, file_stemmed_sentences, file_stem_map = parsed
+            sentences.extend(file_sentences)
+            stemmed_sentences.extend(file_stemmed_sentences)
+            stem_map.update(file_stem_map)
+            file_indices.extend([i] * len(file_sentences))
+
+        # Both corpora have the same sentence boundaries, so split them
+        # identically. Corpora pickled before the manifest existed keep their
+        # split, so their test corpus and the counts of them stay good
+        split = self._legacy_split({False: sentences, True: stemmed_sentences})
+        if split is None:
+            split = train_test_split(range(len(sentences)), test_size=TEST_SIZE, random_state=SPLIT_SEED)
+        train_indices, test_indices = split
+        train = {
+            stemmed: [corpus[i] for i in train_indices]
+            for stemmed, corpus in ((False, sentences), (True, stemmed_sentences))
+        }
+        legacy = self._kept_legacy_corpora(train)
+        for stemmed, corpus in ((False, sentences), (True, stemmed_sentences)):
+            pickle.dump(train[stemmed], open(self.filename(stemmed), 'wb'))
+            pickle.dump([corpus[i] for i in test_indices], open(self.test_filename(stemmed), 'wb'))
+        pickle.dump(stem_map, open(self.stem_map_filename(), 'wb'))
+
+        file_indices = np.array(file_indices, dtype=np.int64)
+        train_files = file_indices[np.asarray(train_indices, dtype=np.int64)]
+        test_files = file_indices[np.asarray(test_indices, dtype=np.int64)]
+        files = {}
+        for i, filename in enumerate(filenames):
+            record = file_record(filename)
+            record['train'] = np.flatnonzero(train_files == i)
+            record['test'] = np.flatnonzero(test_files == i)
+            files[os.path.basename(filename)] = record
+        version = self.corpus_version()
+        version = version + 1 if version else 1
+        self._dump_manifest({
+            'version': version, 'files': files, 'split': self._split(),
+            'legacy': {'version': version, 'stemmed': legacy},
+        })
+        self._record(keys)
+
+    def _legacy_split(self, corpora):
+        """
+        Returns the (train indices, test indices) into corpora ({stemmed:
+        sentences}) that make the train and test corpus pickled by a version
+        from before the manifest existed, or None if there is no such corpus
+        or it does not have the same sentences
+        """
+        if os.path.exists(self.manifest_filename()):
+            return None
+        pickled = [s for s in (False, True) if os.path.exists(self.filename(s)) and os.path.exists(self.test_filename(s))]
+        if not pickled:
+            return None
+        stemmed = pickled[0]
+        positions = {}
+        for i, sentence in enumerate(corpora[stemmed]):
+            positions.setdefault(tuple(sentence), []).append(i)
+        split = []
+        for filename in (self.filename(stemmed), self.test_filename(stemmed)):
+            indices = []
+            for sentence in pickle.load(open(filename, 'rb')):
+                matches = positions.get(tuple(sentence))
+                if not matches:
+                    return None
+                indices.append(matches.pop())
+            split.append(indices)
+        if any(positions.values()):
+            return None
+        return split[0], split[1]
+
+    def _kept_legacy_corpora(self, train):
+        """
+        Returns the corpora (False for unstemmed, True for stemmed) whose
+        train sentences, as pickled by a version from before the manifest
+        existed, are the same as in train: {stemmed: train sentences}
+        """
+        if os.path.exists(self.manifest_filename()):
+            return []
+        return [
+            stemmed for stemmed in sorted(train)
+            if os.path.exists(self.filename(stemmed)) and pickle.load(open(self.filename(stemmed), 'rb')) == train[stemmed]
+        ]
+
+    @timed('corpus_update')
+    def update_corpus(self):
+        """
+        Brings the pickled corpora up to date with the text files, parsing
+        only the files that were added or changed since they were included
+        (files are compared by mtime and size, then by sha1).
+
+        Sentences of new and changed files all go to the train corpora, and
+        the sentences of changed and deleted files are taken out of them,
+        so the held-out test corpora never change. A changed file's
+        sentences that were held out stay held out.
+
+        Returns None if nothing changed, otherwise the change to both
+        corpora as {'from_version', 'to_version', 'added': {stemmed:
+        sentences}, 'removed': {stemmed: sentences}}
+        """
+        if self.streaming:
+            raise ValueError("A streamed corpus is not stored, so it can't be updated")
+        if not os.path.exists(self.manifest_filename()):
+            # Nothing to update from: build everything once
+            self._build_corpus()
+            return None
+
+        keys = self._keys()
+        manifest = self.load_manifest()
+        filenames = {os.path.basename(f): f for f in self.textfiles()}
+        changed = []
+        for name, filename in sorted(filenames.items()):
+            record = manifest['files'].get(name)
+            if record is None:
+                changed.append(name)
+                continue
+            stat = os.stat(filename)
+            if (stat.st_mtime, stat.st_size) == (record['mtime'], record['size']):
+                continue
+            current = file_record(filename)
+            if current['sha1'] != record['sha1']:
+                changed.append(name)
+            else:
+                record['mtime'] = current['mtime']
+        deleted = [name for name in manifest['files'] if name not in filenames]
+        if not changed and not deleted:
+            self._dump_manifest(manifest)
+            self._record(keys)
+            return None
+
+        train = {stemmed: pickle.load(open(self.filename(stemmed), 'rb')) for stemmed in (False, True)}
+        test = pickle.load(open(self.test_filename(False), 'rb'))
+
+        # Take out the train sentences of changed and deleted files
+        retired = [name for name in changed + deleted if name in manifest['files']]
+        drop = np.sort(np.concatenate(
+            [manifest['files'][name]['train'] for name in retired] + [np.zeros(0, dtype=np.int64)]
+        ))
+        removed = {stemmed: [corpus[i] for i in drop] for stemmed, corpus in train.items()}
+        keep = np.ones(len(train[False]), dtype=bool)
+        keep[drop] = False
+        train = {stemmed: [s for s, k in zip(corpus, keep) if k] for stemmed, corpus in train.items()}
+        for name in deleted:
+            del manifest['files'][name]
+        for record in manifest['files'].values():
+            record['train'] = record['train'] - np.searchsorted(drop, record['train'])
+
+        # Add the sentences of new and changed files
+        added = {False: [], True: []}
+        stem_map = pickle.load(open(self.stem_map_filename(), 'rb'))
+        parsed = self._parse_files([filenames[name] for name in changed])
+        for name, (file_sentences, file_stemmed_sentences, file_stem_map) in zip(changed, parsed):
+            stem_map.update(file_stem_map)
+            old_record = manifest['files'].get(name)
+            test_positions = old_record['test'] if old_record else np.zeros(0, dtype=np.int64)
+            held_out = Counter(tuple(test[i]) for i in test_positions)
+
+            positions = []
+            for sentence, stemmed_sentence in zip(file_sentences, file_stemmed_sentences):
+                if held_out[tuple(sentence)] > 0:
+                    held_out[tuple(sentence)] -= 1
+                    continue
+                positions.append(len(train[False]))
+                for stemmed, s in ((False, sentence), (True, stemmed_sentence)):
+                    train[stemmed].append(s)
+                    added[stemmed].append(s)
+
+            record = file_record(filenames[name])
+            record['train'] = np.array(positions, dtype=np.int64)
+            record['test'] = test_positions
+            manifest['files'][name] = record
+
+        for stemmed, corpus in train.items():
+            pickle.dump(corpus, open(self.filename(stemmed), 'wb'))
+        pickle.dump(stem_map, open(self.stem_map_filename(), 'wb'))
+        self.stem_map = None
+
+        from_version = manifest['version']
+        manifest['version'] += 1
+        self._dump_manifest(manifest)
+        self._record(keys)
+        return {
+            'from_version': from_version,
+            'to_version': manifest['version'],
+            'added': added,
+            'removed': removed,
+        }
+
+    def load_manifest(self):
+        """
+        Returns the manifest of the stored corpora:
+        {'version': int, 'files': {basename: {mtime, size, sha1, train, test}},
+         'split': parameters of the train/test split,
+         'legacy': {'version': int, 'stemmed': [bool]}}
+        where train and test are the positions of the file's sentences in
+        the train and test corpora, and legacy records which corpora were
+        the same as pickled before there was a manifest (see legacy_version)
+        """
+        return pickle.load(open(self.manifest_filename(), 'rb'))
+
+    def _dump_manifest(self, manifest):
+        pickle.dump(manifest, open(self.manifest_filename(), 'wb'))
+
+    def corpus_version(self):
+        """ Returns the version of the stored corpora, increased by every update, or None """
+        if self.streaming or not os.path.exists(self.manifest_filename()):
+            return None
+        return self.load_manifest()['version']
+
+    def legacy_version(self, stemmed=None):
+        """
+        Returns the corpus version whose train corpus is the same as the one
+        pickled before the manifest existed, or None if it is not: counts
+        pickled alongside that corpus were counted from this version
+        """
+        if stemmed is None:
+            stemmed = self.stemmed
+        if self.streaming or not os.path.exists(self.manifest_filename()):
+            return None
+        legacy = self.load_manifest().get('legacy')
+        if legacy is None or stemmed not in legacy['stemmed']:
+            return None
+        return legacy['version']
+
+    def corpus_key(self):
+        """
+        Returns the key of the corpus (see artifacts.py): a hash of the
+        contents of the text files and of how they are split into train and
+        test sets, or None if there are no text files to check against
+        """
+        return self._keys()[0]
+
+    def _keys(self):
+        """ Returns (key of the corpus, key of the stem map), both None if there are no text files """
+        sources = self.artifacts.sources_key(self.textfiles())
+        if sources is None:
+            return None, None
+        return content_key('corpus', sources, self._split()), content_key('stem_map', sources)
+
+    def _split(self):
+        """ Returns the parameters of the train/test split """
+        return {'test_size': TEST_SIZE, 'seed': SPLIT_SEED, 'streaming': self.streaming}
+
+    def _corpus_filenames(self):
+        """ Returns the files built from the text files along with the corpora """
+        if self.streaming:
+            return [self.test_filename()]
+        return [
+            self.filename(False), self.test_filename(False),
+            self.filename(True), self.test_filename(True),
+            self.manifest_filename(),
+        ]
+
+    def _record(self, keys, corpus=True, stem_map=True):
+        """ Records the corpus files and/or stem map as built from the text files with keys """
+        corpus_key, stem_map_key = keys
+        records = {}
+        if corpus:
+            records.update((filename, corpus_key) for filename in self._corpus_filenames())
+        if stem_map:
+            records[self.stem_map_filename()] = stem_map_key
+        self.artifacts.record(records)
+
+    def is_stale(self):
+        """
+        Whether the stored corpora or stem map are missing, or were built
+        from other text files than there are now
+        """
+        corpus_key, stem_map_key = self._keys()
+        fresh = all(self.artifacts.is_fresh(f, corpus_key) for f in self._corpus_filenames())
+        return not (fresh and self.artifacts.is_fresh(self.stem_map_filename(), stem_map_key))
+
+    def _refresh(self):
+        """
+        Brings the stored corpora and stem map up to date with the text
+        files if they are stale: with update_corpus, which keeps the test
+        corpora, unless there is nothing to update
+        """
+        if not self.is_stale():
+            return
+        stored = all(os.path.exists(f) for f in self._corpus_filenames() + [self.stem_map_filename()])
+        # Manifests from before the split was recorded were split the same way
+        if stored and self.load_manifest().get('split', self._split()) == self._split():
+            self.update_corpus()
+        else:
+            self._build_corpus()
+
+    def iter_sentences(self):
+        """ Lazily yields every sentence of the corpus, train and test """
+        for filename in self.textfiles():
+            for sentence, stemmed_sentence in _iter_file(filename):
+                yield stemmed_sentence if self.stemmed else sentence
+
+    def stream_train_corpus(self, num_sentences, test_size=TEST_SIZE):
+        """
+        Lazily yields the train sentences of a streamed corpus of
+        num_sentences sentences (as counted by a pass over iter_sentences).
+        The held-out test sentences are chosen reproducibly, kept in memory
+        and pickled once the stream is exhausted.
+        """
+        keys = self._keys()
+        test_indices = set(random.Random(SPLIT_SEED).sample(range(num_sentences), min(test_size, num_sentences)))
+        test_sentences = []
+        for i, sentence in enumerate(self.iter_sentences()):
+            if i in test_indices:
+                test_sentences.append(sentence)
+            else:
+                yield sentence
         pickle.dump(test_sentences, open(self.test_filename(), 'wb'))
+        self._record(keys, stem_map=False)
 
     def stem(self, text):
         """ Returns the stem of the word as defined by the corpus, or the word if not in the stem_map """
@@ -51,56 +413,102 @@ class CorpusBuilder(object):
         if isinstance(text, str):
             text = [text]
 
-        stemmed_text = []
-        for sentence in text:
-            stemmed_sentence = []
-            for word in sentence.split():
-                stemmed_word = self.stem_map[word] if word in self.stem_map else word
-                stemmed_sentence.append(stemmed_word)
-            stemmed_text.append(" ".join(stemmed_sentence))
-        return stemmed_text
+        get = self.stem_map.get
+        return [" ".join(map(get, words, words)) for words in (sentence.split() for sentence in text)]
+
+    def encode(self, text, vocabulary, stem=None):
+        """
+        Tokenizes text (a string or list of sentences) straight to the ids of
+        vocabulary, stemming as part of the lookup when stem is True (by
+        default, if this is the stemmed corpus). Returns a vocabulary.EncodedText
+        """
+        if stem is None:
+            stem = self.stemmed
+        if isinstance(text, str):
+            text = [text]
+        if stem and self.stem_map is None:
+            self.stem_map = self.load_stem_map()
+        return vocabulary.encode_sentences(text, self.stem_map if stem else None)
 
     def _build_stem_map(self):
         """ Builds and pickles a dictionary of {word: stem} using the corpus """
+        if not self.streaming:
+            self._build_corpus()
+            return
+
+        keys = self._keys()
         stem_map = {}
-        textfiles = glob.glob(self.text_dir + '/*.txt')
-        for filename in textfiles:
-            with open(filename, 'r') as f:
-                r = csv.DictReader((x.replace('\0', '') for x in f), dialect='excel-tab', quoting=csv.QUOTE_NONE, fieldnames=['word', 'lemma', 'pos'])
-
-                for row in r:
-                    if '#' in row['word'] or '@' in row['word']:
-                        continue
-                    elif row['lemma'] != '':
-                        stem_map[row['word']] = row['lemma']
+        for filename in self.textfiles():
+            for _ in _iter_file(filename, stem_map):
+                pass
         pickle.dump(stem_map, open(self.stem_map_filename(), 'wb'))
+        self._record(keys, corpus=False)
 
+    @timed('corpus_load')
     def load_stem_map(self, update=False):
-        """ Returns the mapping of {word: stem} built from the corpus. Loads from pickle if available """
-        if update or not (os.path.exists(self.stem_map_filename())):
+        """
+        Returns the mapping of {word: stem} built from the corpus. Loads from
+        pickle if available and up to date with the text files
+        """
+        if update:
+            self._build_stem_map()
+        elif not self.streaming:
+            self._refresh()
+        elif not self.artifacts.is_fresh(self.stem_map_filename(), self._keys()[1]):
             self._build_stem_map()
         return pickle.load(open(self.stem_map_filename(), 'rb'))
 
+    @timed('corpus_load')
     def load_corpus(self, update=False):
-        """ Returns train, test corpus as a list of sentences. Loads from pickle if available. """
-        if update or not (os.path.exists(self.filename()) and os.path.exists(self.test_filename())):
+        """
+        Returns train, test corpus as a list of sentences. Loads from pickle
+        if available and up to date with the text files
+        """
+        if self.streaming:
+            raise ValueError("A streamed corpus is not held in memory, use stream_train_corpus")
+        if update:
             self._build_corpus()
+        else:
+            self._refresh()
         return pickle.load(open(self.filename(), 'rb')), pickle.load(open(self.test_filename(), 'rb'))
 
-    def test_filename(self):
+    @timed('corpus_load')
+    def load_test_corpus(self):
+        """ Returns only the test corpus, without unpickling the much larger train corpus """
+        if not self.streaming:
+            self._refresh()
+        elif not self.artifacts.is_fresh(self.test_filename(), self.corpus_key()):
+            num_sentences = sum(1 for _ in self.iter_sentences())
+            for _ in self.stream_train_corpus(num_sentences):
+                pass
+        return pickle.load(open(self.test_filename(), 'rb'))
+
+    def test_filename(self, stemmed=None):
         """ Returns filename of the pickled test corpus """
-        return self.filename().split('.')[0] + '_test.pickle'
+        return os.path.splitext(self.filename(stemmed))[0] + '_test.pickle'
 
-    def filename(self):
+    def filename(self, stemmed=None):
         """ Returns filename of the pickled corpus """
-        suffix = 'stemmed' if self.stemmed else 'unstemmed'
-        filename = '%s/corpus_%s.pickle' % (self.data_path, suffix)
+        filename = '%s/corpus_%s.pickle' % (self.data_path, self.suffix(stemmed))
         return filename
 
+    def suffix(self, stemmed=None):
+        """ Returns the suffix that identifies this corpus in cache filenames """
+        if stemmed is None:
+            stemmed = self.stemmed
+        suffix = 'stemmed' if stemmed else 'unstemmed'
+        if self.streaming:
+            suffix += '_streamed'
+        return suffix
+
     def stem_map_filename(self):
         """ Returns filename of the pickled dictionary {word: stem} """
         return self.data_path + '/stem_map.pickle'
 
+    def manifest_filename(self):
+        """ Returns filename of the pickled manifest of corpus files (shared by both corpora) """
+        return self.data_path + '/corpus_manifest.pickle'
+
 if __name__ == '__main__':
     cb = CorpusBuilder()
     train, test = cb.load_corpus()
@@ -1,23 +1,170 @@
+import math
 import pandas as pd
 import numpy as np
-import scipy.misc
-from ngram import NGramCounts
-from utils import window
+from instrumentation import timed
+from ngram import NGramCounts, NGramTable, find_keys
+from store import read_compact
+from utils import window, PerOrder
+from vocabulary import pack, unpack, suffix_keys
+
+# Probability mass left over for backing off is never taken as less than
+# this, so an unseen n-gram always gets some probability
+MIN_MASS = 1e-12
+
+
+class ContextIndex(object):
+    """
+    Maps each history (w1, ..., wn-1) to the ids of all of the words that can
+    follow it. Stored CSR-style: continuations of the i-th history in
+    history_keys live at [offsets[i], offsets[i+1]) in the
+    words/probabilities/rows arrays, sorted by descending probability.
+    """
+
+    def __init__(self, table, probabilities):
+        self.bits = table.bits
+        self.history_keys, self.offsets = table.history_groups()
+
+        # Most probable continuation first within each history
+        codes = np.repeat(np.arange(len(self.history_keys)), np.diff(self.offsets))
+        self.rows = np.lexsort((-probabilities, codes))
+        self.words = table.last_ids()[self.rows]
+        self.probabilities = probabilities[self.rows]
+
+    def span(self, history_ids):
+        """ Returns the (start, end) offsets of the continuations of a history of ids """
+        history_key = pack(np.asarray(history_ids).reshape(1, -1), self.bits)[0]
+        i = np.searchsorted(self.history_keys, history_key)
+        if i == len(self.history_keys) or self.history_keys[i] != history_key:
+            return 0, 0
+        return self.offsets[i], self.offsets[i+1]
+
+    def continuations(self, history_ids, k=None):
+        """ Returns (word ids, probabilities) that can follow history, most probable first """
+        start, end = self.span(history_ids)
+        if k is not None:
+            end = min(end, start + k)
+        return self.words[start:end], self.probabilities[start:end]
 
 
 class ProbabilityGenerator(object):
+    """
+    Base class for probability models over an NGramCounts. self.probs[n] is
+    an array of probabilities parallel to the keys of counts.get_table(n).
+
+    Nothing is computed for an order until it is used: self.probs,
+    self.contexts and any per-order state of a subclass are utils.PerOrder
+    dicts, and lookups compute probabilities from the counts rather than
+    reading them from self.probs.
+    """
+    # Whether an unseen n-gram falls back to the next lower order (see compact.py)
+    backs_off = False
+    # Whether log_probability_batch only smooths the n-grams' own counts, so
+    # the counts of several orders can be looked up at once (see log_probability_batches)
+    smooths_counts = True
 
     def __init__(self, counts):
         self.counts = counts
-        self.probs = {}
+        self.vocabulary = counts.vocabulary
+        # The counts these probabilities were generated from (see NGramCounts.generation)
+        self.generation = counts.generation
+        self.probs = PerOrder(self._order_probabilities)
+        self.contexts = PerOrder(self._build_index)
         self._generate_probabilities()
 
     def _generate_probabilities(self):
-        raise NotImplementedError
+        """ Sets up anything the model needs for every order up front """
+        pass
+
+    def _order_probabilities(self, n):
+        """ Returns the probability of every n-gram of order n, parallel to counts.get_table(n) """
+        return np.exp(self.log_probability_batch(self.counts.get_table(n).ids(), n))
 
-    def get_probability(self, state, action):
+    def _span_probabilities(self, n, start, end):
+        """ Returns the probabilities of the n-grams at [start, end) of counts.get_table(n) """
+        table = self.counts.get_table(n)
+        return np.exp(self.log_probability_batch(unpack(table.keys[start:end], n, table.bits), n))
+
+    def _build_index(self, n):
+        """ Builds the history -> continuations index of order n """
+        return ContextIndex(self.counts.get_table(n), self._order_probabilities(n))
+
+    def _log_total(self, n):
+        """ Log of the total count of the n-grams of order n """
+        return _log(self.counts.total(n))
+
+    def log_smooth(self, counts, n, **parameters):
+        """
+        Returns the log probabilities of n-grams with the given array of counts
+        (0 for unseen n-grams). Subclasses accept their smoothing parameter as
+        a keyword: passing an array of P values returns a (P, len(counts))
+        array, evaluating every value in one vectorized call.
+        """
         raise NotImplementedError
 
+    def get_count_batch(self, ids, n=None):
+        """
+        Takes an (m, n) array of word ids, one n-gram per row, and returns
+        their m counts with a single binary search over the sorted keys.
+        Unseen n-grams get 0
+        """
+        if n is None:
+            n = self.counts.n
+        return self.counts.count_batch(pack(ids, self.vocabulary.bits), n)
+
+    @timed('lookup')
+    def get_probability(self, state, action, n=None):
+        """
+        Returns Pr(action | state) for a single n-gram by binary search over
+        the sorted keys
+        e.g. state = ('at', '4:23'), action = 'pm' -> 0.000003
+        """
+        if n is None:
+            n = self.counts.n
+        ids = self.vocabulary.encode(list(state) + [action])
+        return self.get_probability_batch(ids.reshape(1, -1), n=n)[0]
+
+    def get_probability_batch(self, ids, n=None):
+        """ Vectorized get_probability for an (m, n) array of word ids """
+        return np.exp(self.log_probability_batch(ids, n))
+
+    @timed('batch_lookup')
+    def log_probability_batch(self, ids, n=None, **parameters):
+        """
+        Returns log Pr(wn | w1, ..., wn-1) for each row of an (m, n) array of
+        word ids. Accepts the same parameters as log_smooth, so arrays of
+        parameter values give a (P, m) result.
+        """
+        if n is None:
+            n = self.counts.n
+        return self.log_smooth(self.get_count_batch(ids, n), n, **parameters)
+
+    @timed('batch_lookups')
+    def log_probability_batches(self, requests, **parameters):
+        """
+        Returns [log_probability_batch(ids, n)] for [(n, ids)]. Models that
+        only smooth counts look up the counts of every order with one
+        NGramCounts.count_batches call
+        """
+        if not self.smooths_counts:
+            return [self.log_probability_batch(ids, n, **parameters) for n, ids in requests]
+        bits = self.vocabulary.bits
+        counts = self.counts.count_batches([(n, pack(ids, bits)) for n, ids in requests])
+        return [self.log_smooth(c, n, **parameters) for c, (n, ids) in zip(counts, requests)]
+
+    @timed('lookup')
+    def top_k_continuations(self, history, k=None):
+        """
+        Returns the k most probable (word, probability) pairs that follow
+        history, using the model of order len(history) + 1
+        e.g. history = ('at', '4:23'), k = 1 -> [('pm', 0.000003)]
+        """
+        ids, probabilities = self.contexts[len(history) + 1].continuations(
+            self.vocabulary.encode(list(history)),
+            k,
+        )
+        return list(zip(self.vocabulary.decode(ids), probabilities))
+
+    @timed('lookup')
     def get_probabilities(self, state, n=None):
         """
         For a partial state, returns all probabilities that could finish state
@@ -26,31 +173,70 @@ class ProbabilityGenerator(object):
         positions:
             word1 word2 word3  probability
             at    4:23  pm     0.000003
+        The result is indexed by position in the table (see to_frame)
         """
         if n is None:
             n = self.counts.n
-        probs = self.probs[n]
+        ids = self.vocabulary.encode(list(state))
 
-        if len(state) == 1:
-            return probs[probs['word1'] == state[0]]['probability']
-        else:
-            return probs[np.logical_and.reduce(
-                [probs['word' + str(i+1)] == w for i, w in enumerate(state)],
-            )]['probability']
+        # A full history is answered from the context index, most probable first
+        if len(state) == n - 1:
+            context = self.contexts[n]
+            start, end = context.span(ids)
+            return pd.Series(
+                context.probabilities[start:end],
+                index=context.rows[start:end],
+                name='probability',
+            )
+        start, end = self.counts.get_table(n).prefix_span(ids)
+        return pd.Series(
+            self._span_probabilities(n, start, end),
+            index=np.arange(start, end),
+            name='probability',
+        )
+
+    def to_frame(self, n=None):
+        """ Returns the probabilities of order n as a | word1 | ... | wordn | probability | DataFrame """
+        if n is None:
+            n = self.counts.n
+        frame = self.counts.get_counts(n).drop(columns='count')
+        frame['probability'] = self._order_probabilities(n)
+        return frame
+
+
+def _parameter(value):
+    """
+    Returns a smoothing parameter ready to broadcast against an array of
+    counts: scalars stay scalars, sequences become a column
+    """
+    value = np.asarray(value, dtype=float)
+    return value.reshape(-1, 1) if value.ndim else value
+
+
+def possible_ngrams(vocabulary_size, n):
+    """
+    Returns the number of n-grams of distinct words, V! / (V - n)!, as an
+    exact integer (Python ints never overflow, and math.log accepts them)
+    """
+    possible = 1
+    for i in range(n):
+        possible *= max(vocabulary_size - i, 0)
+    return possible
+
+
+def _log(x):
+    return math.log(x) if x > 0 else float('-inf')
 
 
 class RawProbabilityGenerator(ProbabilityGenerator):
 
     def __init__(self, counts):
+        self.log_totals = PerOrder(self._log_total)
         super().__init__(counts)
 
-    def _generate_probabilities(self):
-        for i in range(1, self.counts.n + 1):
-            probs = self.counts.get_counts(i)
-            total = sum(probs['count'].values)
-            probs['probability'] = probs['count'] / total
-            probs = probs.drop('count', 1)
-            self.probs[i] = probs
+    def log_smooth(self, counts, n):
+        with np.errstate(divide='ignore'):
+            return np.log(counts) - self.log_totals[n]
 
     def __str__(self):
         return "Raw Probability Generator (MLE Counts)"
@@ -62,20 +248,18 @@ class LazyProbabilityGenerator(ProbabilityGenerator):
     all of its probabilities up front. By definition, these probability models
     expect to not have a probability of 0. If they encounter such a
     probability, then they will default to the result of a lazy_probability
-    function.
+    function, which log_smooth also uses for unseen n-grams.
     """
 
     def __init__(self, counts):
         super().__init__(counts)
 
+    @timed('lookup')
     def get_probabilities(self, state, n=None):
         if n is None:
             n = self.counts.n
-        probs = self.probs[n]
 
-        prob = probs[np.logical_and.reduce(
-            [probs['word' + str(i+1)] == w for i, w in enumerate(state)],
-        )]['probability']
+        prob = super().get_probabilities(state, n=n)
 
         if not len(prob.values) or prob.values[0] == 0:
             return {0: self.lazy_probability(state, n)}
@@ -90,20 +274,29 @@ class LaplaceProbabilityGenerator(LazyProbabilityGenerator):
 
     def __init__(self, counts, k=1):
         self.k = k
-        self.corpus_size = len(counts.get_counts(1))
-        self.Ns = {}
+        self.corpus_size = counts.size(1)
+        self.log_totals = PerOrder(self._log_total)
+        self.log_possible = PerOrder(self._log_possible)
+        self.Ns = PerOrder(self._normalizer)
         super().__init__(counts)
 
-    def _generate_probabilities(self):
-        for i in range(1, self.counts.n + 1):
-            probs = self.counts.get_counts(i)
-            total_possible_ngrams = \
-                scipy.misc.comb(self.corpus_size, i) * scipy.misc.factorial(i)
-            N = sum(probs['count'].values) + (total_possible_ngrams * self.k)
-            self.Ns[i] = N
-            probs['probability'] = (probs['count'] + self.k) / N
-            probs = probs.drop('count', 1)
-            self.probs[i] = probs
+    def _log_possible(self, n):
+        return _log(possible_ngrams(self.corpus_size, n))
+
+    def _normalizer(self, n):
+        return math.exp(self.log_normalizer(n))
+
+    def log_normalizer(self, n, k=None):
+        """ log N, where N = total count + k * number of possible n-grams """
+        k = self.k if k is None else _parameter(k)
+        with np.errstate(divide='ignore'):
+            return np.logaddexp(self.log_totals[n], np.log(k) + self.log_possible[n])
+
+    def log_smooth(self, counts, n, k=None):
+        log_normalizer = self.log_normalizer(n, k)
+        k = self.k if k is None else _parameter(k)
+        with np.errstate(divide='ignore'):
+            return np.log(counts + k) - log_normalizer
 
     def lazy_probability(self, state, n):
         return self.k / self.Ns[n]
@@ -117,24 +310,33 @@ class AbsoluteDiscountProbabilityGenerator(LazyProbabilityGenerator):
 
     def __init__(self, counts, D=0):
         self.D = D
-        self.corpus_size = len(counts.get_counts(1))
-        self.alphas = {}
+        self.corpus_size = counts.size(1)
+        self.log_totals = PerOrder(self._log_total)
+        self.log_alphas = PerOrder(self._log_alpha)
+        self.alphas = PerOrder(self._alpha)
         super().__init__(counts)
 
-    def _generate_probabilities(self):
-        for i in range(1, self.counts.n + 1):
-            probs = self.counts.get_counts(i)
-            total = sum(probs['count'].values)
-            probs['probability'] = (probs['count'] - self.D) / total
-            total_possible_ngrams = \
-                scipy.misc.comb(self.corpus_size, i) * scipy.misc.factorial(i)
-            # if there are k n-grams with counts of zero, then alpha is 1/k.
-            # Want to distribute D probability mass across these k unseen
-            # elements, so each should get probability (1/k)*D.
-            alpha = 1 / (total_possible_ngrams - len(probs))
-            self.alphas[i] = alpha
-            probs = probs.drop('count', 1)
-            self.probs[i] = probs
+    def _log_alpha(self, n):
+        # if there are k n-grams with counts of zero, then alpha is 1/k.
+        # Want to distribute D probability mass across these k unseen
+        # elements, so each should get probability (1/k)*D.
+        # When every possible n-gram has been seen, k is 0: there is no
+        # unseen n-gram to give mass to, so alpha is 0 rather than infinite
+        unseen = possible_ngrams(self.corpus_size, n) - self.counts.size(n)
+        if unseen <= 0:
+            return float('-inf')
+        return -_log(unseen)
+
+    def _alpha(self, n):
+        with np.errstate(over='ignore'):
+            return np.exp(self.log_alphas[n])
+
+    def log_smooth(self, counts, n, D=None):
+        D = self.D if D is None else _parameter(D)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            seen = np.log(counts - D) - self.log_totals[n]
+            unseen = np.log(D) + self.log_alphas[n]
+        return np.where(counts - D > 0, seen, unseen)
 
     def lazy_probability(self, state, n):
         return self.alphas[n] * self.D
@@ -142,3 +344,346 @@ class AbsoluteDiscountProbabilityGenerator(LazyProbabilityGenerator):
     def __str__(self):
         name = "Absolute Discount Probabilities"
         return "{} with D={}".format(name, self.D)
+
+
+def _group_sums(values, offsets):
+    """ Sums values over each history group of a table (see NGramTable.history_groups) """
+    if len(offsets) < 2:
+        return np.zeros(0, dtype=values.dtype)
+    return np.add.reduceat(values, offsets[:-1])
+
+
+class KneserNeyProbabilityGenerator(ProbabilityGenerator):
+    """
+    Interpolated Kneser-Ney smoothing. Every order discounts its counts by D
+    and interpolates with the next lower order, which uses continuation
+    counts (the number of distinct words that precede an n-gram) instead of
+    raw counts. The unigram level is interpolated with a uniform
+    distribution, so unknown words keep some probability.
+
+    Continuation counts and the per-history totals that make up the
+    interpolation weights are computed once per order, the first time it is
+    used, so a lookup is two binary searches per order.
+    """
+    backs_off = True
+    smooths_counts = False
+
+    def __init__(self, counts, D=0.75):
+        self.D = D
+        self.vocabulary_size = len(counts.get_table(1))
+        # {n: array parallel to counts.get_table(n)}, for n below the model's order
+        self.continuation_counts = PerOrder(self._continuation_counts)
+        # {n: {'keys': sorted history keys, 'total': ..., 'types': ...}}
+        self.histories = PerOrder(self._histories)
+        self.continuation_histories = PerOrder(self._continuation_histories)
+        super().__init__(counts)
+
+    def _continuation_counts(self, i):
+        # N1+(. w1 ... wi) is the number of (i+1)-grams ending in w1 ... wi
+        keys = suffix_keys(self.counts.get_table(i + 1).keys, i + 1, self.vocabulary.bits)
+        suffixes, continuation_counts = np.unique(keys, return_counts=True)
+        table = self.counts.get_table(i)
+        counts = np.zeros(len(table), dtype=np.int64)
+        counts[table.find(suffixes)] = continuation_counts
+        return counts
+
+    def _histories(self, i):
+        table = self.counts.get_table(i)
+        history_keys, offsets = table.history_groups()
+        return {
+            'keys': history_keys,
+            'total': _group_sums(table.counts, offsets),
+            'types': np.diff(offsets),
+        }
+
+    def _continuation_histories(self, i):
+        continuation_counts = self.continuation_counts[i]
+        history_keys, offsets = self.counts.get_table(i).history_groups()
+        return {
+            'keys': history_keys,
+            'total': _group_sums(continuation_counts, offsets),
+            'types': _group_sums((continuation_counts > 0).astype(np.int64), offsets),
+        }
+
+    @timed('batch_lookup')
+    def log_probability_batch(self, ids, n=None, D=None):
+        if n is None:
+            n = self.counts.n
+        D = self.D if D is None else _parameter(D)
+        ids = np.asarray(ids)
+        bits = self.vocabulary.bits
+
+        # Build up from the unigram level, whose lower order is uniform over
+        # the vocabulary plus unknown words
+        probabilities = 1 / (self.vocabulary_size + 1)
+        for i in range(1, n + 1):
+            table = self.counts.get_table(i)
+            ngrams = ids[:, n - i:]
+            # The requested order uses raw counts, lower orders continuation counts
+            if i == n:
+                values, histories = table.counts, self.histories[i]
+            else:
+                values, histories = self.continuation_counts[i], self.continuation_histories[i]
+
+            positions = table.find(pack(ngrams, bits))
+            counts = np.where(positions >= 0, values[positions], 0)
+            if i == 1:
+                history_positions = np.zeros(len(ids), dtype=np.int64)
+            else:
+                history_positions = find_keys(histories['keys'], pack(ngrams[:, :-1], bits))
+            seen = history_positions >= 0
+            total = np.where(seen, histories['total'][history_positions], 0)
+            types = np.where(seen, histories['types'][history_positions], 0)
+
+            with np.errstate(divide='ignore', invalid='ignore'):
+                interpolated = (np.maximum(counts - D, 0) + D * types * probabilities) / total
+            # An unseen history leaves all of the mass to the lower order
+            probabilities = np.where(total > 0, interpolated, probabilities)
+
+        with np.errstate(divide='ignore'):
+            return np.log(probabilities)
+
+    def __str__(self):
+        name = "Interpolated Kneser-Ney Probabilities"
+        return "{} with D={}".format(name, self.D)
+
+
+class KatzBackoffProbabilityGenerator(ProbabilityGenerator):
+    """
+    Katz backoff. Counts up to K are discounted with Good-Turing estimates;
+    an unseen n-gram backs off to the next lower order, scaled by its
+    history's backoff weight alpha so that every distribution sums to one.
+    Unknown words share the probability mass the unigram discount frees up.
+
+    Discounted probabilities of every n-gram and the alpha of every history
+    are computed once per order, the first time it is used, so a lookup is
+    at most two binary searches per order.
+    """
+    backs_off = True
+    smooths_counts = False
+
+    # Discount of counts up to K whose Good-Turing discount is rejected
+    FALLBACK_DISCOUNT = 0.5
+
+    def __init__(self, counts, K=5):
+        self.K = K
+        # {n: {'keys': sorted history keys, 'alpha': backoff weights}}, for n > 1
+        self.backoff = PerOrder(self._backoff_weights)
+        self.unknown_probability = 0
+        super().__init__(counts)
+
+    def good_turing_discounts(self, counts):
+        """
+        Returns the Katz discount d_c for each count c (1 above K):
+            d_c = (c*/c - (K+1) n_K+1 / n_1) / (1 - (K+1) n_K+1 / n_1)
+        where c* = (c+1) n_c+1 / n_c and n_c is the number of n-grams seen c times.
+        Where that can't be computed or comes out outside (0, 1), c is
+        discounted by FALLBACK_DISCOUNT instead, so every count up to K frees
+        up some mass to back off with.
+        """
+        n_c = np.bincount(counts, minlength=self.K + 2).astype(float)
+        discounts = np.ones(len(n_c))
+        common = (self.K + 1) * n_c[self.K + 1] / n_c[1] if n_c[1] else 1
+        for c in range(1, self.K + 1):
+            discount = 0
+            if n_c[c] and common < 1:
+                discount = ((c + 1) * n_c[c + 1] / (c * n_c[c]) - common) / (1 - common)
+            if not 0 < discount < 1:
+                discount = 1 - self.FALLBACK_DISCOUNT / c
+            discounts[c] = discount
+        return discounts[counts]
+
+    def _generate_probabilities(self):
+        self.unknown_probability = max(1 - self.probs[1].sum(), MIN_MASS)
+
+    def _order_probabilities(self, i):
+        """ Discounted Pr(w | h) of every n-gram of order i, i.e. self.probs[i] """
+        table = self.counts.get_table(i)
+        counts = table.counts
+        discounted = self.good_turing_discounts(counts) * counts
+        _, offsets = table.history_groups()
+        totals = np.repeat(_group_sums(counts, offsets), np.diff(offsets))
+        return discounted / totals
+
+    def _build_index(self, n):
+        return ContextIndex(self.counts.get_table(n), self.probs[n])
+
+    def _backoff_weights(self, i):
+        # alpha(h) = (1 - sum of discounted Pr(w | h)) / (1 - sum of Pr(w | h')),
+        # both sums over the words seen after h. A history whose words are
+        # all seen more than K times keeps all of its mass, so both sides
+        # are floored at MIN_MASS: unseen words still get some probability
+        table = self.counts.get_table(i)
+        history_keys, offsets = table.history_groups()
+        lower = np.exp(self.log_probability_batch(table.ids()[:, 1:], i - 1))
+        left = np.maximum(1 - _group_sums(self.probs[i], offsets), MIN_MASS)
+        lower_left = np.maximum(1 - _group_sums(lower, offsets), MIN_MASS)
+        return {
+            'keys': history_keys,
+            'alpha': left / lower_left,
+        }
+
+    @timed('batch_lookup')
+    def log_probability_batch(self, ids, n=None):
+        if n is None:
+            n = self.counts.n
+        ids = np.asarray(ids)
+        bits = self.vocabulary.bits
+
+        log_probs = np.zeros(len(ids))
+        log_weights = np.zeros(len(ids))
+        pending = np.ones(len(ids), dtype=bool)
+        with np.errstate(divide='ignore'):
+            for i in range(n, 0, -1):
+                ngrams = ids[:, n - i:]
+                positions = self.counts.get_table(i).find(pack(ngrams, bits))
+                hit = pending & (positions >= 0)
+                log_probs[hit] = log_weights[hit] + np.log(self.probs[i][positions[hit]])
+                pending &= ~hit
+                if i > 1:
+                    # Back off, scaled by alpha of the history (1 if it was never seen)
+                    backoff = self.backoff[i]
+                    history_positions = find_keys(backoff['keys'], pack(ngrams[:, :-1], bits))
+                    seen = pending & (history_positions >= 0)
+                    log_weights[seen] += np.log(backoff['alpha'][history_positions[seen]])
+
+            log_probs[pending] = log_weights[pending] + np.log(self.unknown_probability)
+        return log_probs
+
+    def __str__(self):
+        name = "Katz Backoff Probabilities"
+        return "{} with K={}".format(name, self.K)
+
+
+def _dequantize(values, codebook, positions):
+    """ Returns the log probabilities stored at positions, looking codes up in codebook """
+    values = values[positions]
+    return values if codebook is None else codebook[values]
+
+
+class CompactProbabilityGenerator(ProbabilityGenerator):
+    """
+    Scores with a compact model written by compact.py: the log probabilities
+    of the n-grams of another model that survived pruning, stored as floats
+    or as 8/16 bit codes into a per-order codebook.
+
+    If the source model backs off (Kneser-Ney, Katz), every history keeps a
+    backoff weight and a missing n-gram backs off to the next lower order,
+    Katz style. Otherwise a missing n-gram gets the probability the source
+    gave unseen n-grams of its order.
+
+    The counts are only used for their vocabulary, so their tables are never
+    paged in.
+    """
+    smooths_counts = False
+
+    def __init__(self, counts, filename=None, data=None):
+        if filename is None and data is None:
+            raise ValueError("A compact model needs a filename or data")
+        self.filename = filename
+        self.data = data
+        # {n: NGramTable whose counts are log probabilities or their codes}
+        self.tables = {}
+        self.codebooks = {}
+        # {n: {'keys': sorted history keys, 'values': log weights or codes, 'codebook'}}
+        self.backoff = {}
+        self.floor = []
+        super().__init__(counts)
+
+    def _generate_probabilities(self):
+        if self.data is None:
+            self.data = read_compact(self.filename)
+        meta = self.data['meta']
+        name = self.filename or 'The compact model'
+        if meta['vocabulary'] != self.vocabulary.fingerprint():
+            raise ValueError("{} was not built from counts with this vocabulary".format(name))
+        if meta['n'] < self.counts.n:
+            raise ValueError("{} only has n-grams up to n={}".format(name, meta['n']))
+
+        self.backs_off = meta['backoff']
+        self.floor = meta['floor']
+        bits = self.vocabulary.bits
+        for i, order in self.data['orders'].items():
+            self.tables[i] = NGramTable(i, bits, order['keys'], order['values'])
+            self.codebooks[i] = order.get('codebook')
+            if 'history_keys' in order:
+                self.backoff[i] = {
+                    'keys': order['history_keys'],
+                    'values': order['history_values'],
+                    'codebook': order.get('history_codebook'),
+                }
+
+    @timed('batch_lookup')
+    def log_probability_batch(self, ids, n=None):
+        if n is None:
+            n = self.counts.n
+        ids = np.asarray(ids)
+        bits = self.vocabulary.bits
+
+        if not self.backs_off:
+            table = self.tables[n]
+            positions = table.find(pack(ids, bits))
+            found = positions >= 0
+            log_probs = np.full(len(ids), self.floor[n - 1])
+            log_probs[found] = _dequantize(table.counts, self.codebooks[n], positions[found])
+            return log_probs
+
+        log_probs = np.zeros(len(ids))
+        log_weights = np.zeros(len(ids))
+        pending = np.ones(len(ids), dtype=bool)
+        for i in range(n, 0, -1):
+            ngrams = ids[:, n - i:]
+            table = self.tables[i]
+            positions = table.find(pack(ngrams, bits))
+            hit = pending & (positions >= 0)
+            log_probs[hit] = log_weights[hit] + _dequantize(table.counts, self.codebooks[i], positions[hit])
+            pending &= ~hit
+            if i > 1:
+                # Back off, scaled by the weight of the history (1 if it has none)
+                backoff = self.backoff[i]
+                history_positions = find_keys(backoff['keys'], pack(ngrams[:, :-1], bits))
+                seen = pending & (history_positions >= 0)
+                log_weights[seen] += _dequantize(backoff['values'], backoff['codebook'], history_positions[seen])
+
+        log_probs[pending] = log_weights[pending] + self.floor[0]
+        return log_probs
+
+    @timed('lookup')
+    def top_k_continuations(self, history, k=None):
+        probabilities = self.get_probabilities(history, len(history) + 1).sort_values(ascending=False)
+        if k is not None:
+            probabilities = probabilities[:k]
+        ids = self.tables[len(history) + 1].last_ids()[probabilities.index]
+        return list(zip(self.vocabulary.decode(ids), probabilities.values))
+
+    @timed('lookup')
+    def get_probabilities(self, state, n=None):
+        """ As ProbabilityGenerator.get_probabilities, indexed by position in the compact table """
+        if n is None:
+            n = self.counts.n
+        table = self.tables[n]
+        start, end = table.prefix_span(self.vocabulary.encode(list(state)))
+        rows = np.arange(start, end)
+        return pd.Series(np.exp(_dequantize(table.counts, self.codebooks[n], rows)), index=rows, name='probability')
+
+    def to_frame(self, n=None):
+        if n is None:
+            n = self.counts.n
+        table = self.tables[n]
+        frame = table.to_frame(self.vocabulary).drop('count', axis=1)
+        frame['probability'] = np.exp(_dequantize(table.counts, self.codebooks[n], np.arange(len(table))))
+        return frame
+
+    def __str__(self):
+        meta = self.data['meta']
+        return "Compact {} ({})".format(meta['source'], meta['compaction'])
+
+
+PROBABILITY_GENERATORS = {
+    'raw': RawProbabilityGenerator,
+    'laplace': LaplaceProbabilityGenerator,
+    'abs_dis': AbsoluteDiscountProbabilityGenerator,
+    'kneser_ney': KneserNeyProbabilityGenerator,
+    'katz': KatzBackoffProbabilityGenerator,
+    'compact': CompactProbabilityGenerator,
+}
@@ -0,0 +1,142 @@
+"""
+Random sentence generation from an n-gram model.
+
+Every word is drawn from the model's distribution over the words seen after
+its history, using the same order as scoring would (so the first words of
+a sentence use the lower orders). A history that was never seen backs off
+to a shorter one. Sentences run from START_SYMBOL to END_SYMBOL, or are cut
+off at max_length words.
+
+The distributions are turned into cumulative arrays once, laid end to end
+for every history of an order, so drawing the next word of a whole batch of
+sentences is one vectorized binary search per order.
+"""
+import numpy as np
+
+from ngram import find_keys
+from probability import ContextIndex
+from vocabulary import START_ID, END_ID, pack
+
+
+class Sampler(object):
+    """
+    Draws sentences from a probability generator. temperature flattens
+    (> 1) or sharpens (< 1) every distribution, and top_k restricts each
+    history to its k most probable continuations.
+    """
+
+    def __init__(self, probability_generator, n=None, temperature=1.0, top_k=None):
+        if temperature <= 0:
+            raise ValueError("temperature must be positive, not {}".format(temperature))
+        self.probability_generator = probability_generator
+        self.vocabulary = probability_generator.vocabulary
+        self.n = probability_generator.counts.n if n is None else n
+        self.temperature = temperature
+        self.top_k = top_k
+        # {order: {'history_keys', 'base', 'cdf', 'last', 'words'}}
+        self.tables = {}
+        for k in range(1, self.n + 1):
+            self.tables[k] = self._cumulative_table(k)
+
+    def _cumulative_table(self, k):
+        """
+        Builds the cumulative distribution of the continuations of every
+        history of order k. Continuations are normalized per history, so the
+        history at position g of history_keys covers (base[g], base[g] + 1] of
+        cdf and a uniform draw u picks the first entry past base[g] + u
+        """
+        table = self.probability_generator.counts.get_table(k)
+        log_probs = self.probability_generator.log_probability_batch(table.ids(), k)
+        # Most probable continuation first within each history
+        index = ContextIndex(table, log_probs)
+
+        starts, sizes = index.offsets[:-1], np.diff(index.offsets)
+        if not len(starts):
+            return None
+
+        # Relative to the most probable continuation, which comes first
+        with np.errstate(invalid='ignore'):
+            log_weights = (index.probabilities - np.repeat(index.probabilities[starts], sizes)) / self.temperature
+        weights = np.where(np.isnan(log_weights), 0, np.exp(log_weights))
+        # START_SYMBOL only ever begins a sentence
+        weights[index.words == START_ID] = 0
+        if self.top_k is not None:
+            rank = np.arange(len(weights)) - np.repeat(starts, sizes)
+            weights[rank >= self.top_k] = 0
+
+        totals = np.add.reduceat(weights, starts)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            weights = np.nan_to_num(weights / np.repeat(totals, sizes))
+        cdf = np.cumsum(weights)
+        base = np.concatenate([[0], cdf])[starts]
+
+        # Last entry of each history that can be drawn, to guard against rounding
+        drawable = np.where(weights > 0, np.arange(len(weights)), -1)
+        last = np.maximum.reduceat(drawable, starts)
+
+        # Histories with nothing left to draw are left out, so they back off
+        keep = last >= 0
+        return {
+            'history_keys': index.history_keys[keep],
+            'base': base[keep],
+            'last': last[keep],
+            'cdf': cdf,
+            'words': index.words,
+        }
+
+    def _draw(self, histories, random_state):
+        """
+        Draws the next word after each row of an (m, h) array of history ids,
+        using the model of order h + 1 and backing off for unseen histories
+        """
+        bits = self.vocabulary.bits
+        h = histories.shape[1]
+        words = np.full(len(histories), END_ID, dtype=np.int32)
+        pending = np.ones(len(histories), dtype=bool)
+        for k in range(h + 1, 0, -1):
+            table = self.tables[k]
+            if table is None:
+                continue
+            rows = np.flatnonzero(pending)
+            groups = find_keys(table['history_keys'], pack(histories[rows, h - (k - 1):], bits))
+            found = groups >= 0
+            rows, groups = rows[found], groups[found]
+            targets = table['base'][groups] + random_state.random_sample(len(rows))
+            positions = np.searchsorted(table['cdf'], targets, side='right')
+            positions = np.minimum(positions, table['last'][groups])
+            words[rows] = table['words'][positions]
+            pending[rows] = False
+            if not pending.any():
+                break
+        return words
+
+    def sample_ids(self, num_sentences, seed=None, max_length=50):
+        """
+        Draws num_sentences sentences at once
+        Returns (ids, lengths): a (num_sentences, max_length + 2) array of
+        ids, each row starting with START_ID and ending at its END_ID, and
+        the length of each row up to and including END_ID
+        """
+        random_state = np.random.RandomState(seed)
+        ids = np.zeros((num_sentences, max_length + 2), dtype=np.int32)
+        ids[:, 0] = START_ID
+        lengths = np.full(num_sentences, max_length + 2, dtype=np.int64)
+        active = np.arange(num_sentences)
+        for t in range(1, max_length + 1):
+            if not len(active):
+                break
+            histories = ids[active, max(0, t - self.n + 1):t]
+            words = self._draw(histories, random_state)
+            ids[active, t] = words
+            ended = words == END_ID
+            lengths[active[ended]] = t + 1
+            active = active[~ended]
+        # Sentences still going at max_length are cut off there
+        ids[active, max_length + 1] = END_ID
+        return ids, lengths
+
+    def sample(self, num_sentences=1, seed=None, max_length=50):
+        """ Returns num_sentences random sentences, as strings of space separated words """
+        ids, lengths = self.sample_ids(num_sentences, seed, max_length)
+        words = np.array(self.vocabulary.words, dtype=object)
+        return [' '.join(words[row[1:length - 1]]) for row, length in zip(ids, lengths)]
@@ -0,0 +1,98 @@
+import time
+from utils import START_SYMBOL, END_SYMBOL
+
+
+class SearchTimeout(Exception):
+    """ Raised when order_words runs past its deadline """
+
+
+def order_words(words, word_log_prob, n, beam_width=None, max_expansions=None, deadline=None):
+    """
+    Finds the ordering of words that maximizes the sum of
+    word_log_prob(history, word) over the sentence, where history is the
+    previous (at most n - 1) words and the sentence is wrapped in
+    START_SYMBOL/END_SYMBOL.
+
+    Because an n-gram model only looks at the last n - 1 words, any two
+    partial orderings that used the same set of words and end in the same
+    n - 1 words can be completed identically, so only the better of them
+    needs to be kept. Searching layer by layer (one more word placed per
+    layer) over states (used-word bitmask, last n - 1 words) is therefore
+    exact, and far cheaper than trying every permutation.
+
+    If beam_width is given, only the beam_width best states of each layer
+    are kept, which is no longer exact but scales to long inputs.
+
+    max_expansions caps the total number of word_log_prob calls. Each layer
+    is pruned to its best states so that the remaining layers fit in what is
+    left of the budget (always keeping at least one state), so the search
+    degrades towards greedy rather than running unbounded. If deadline (a
+    time.time() value) passes during the search, SearchTimeout is raised.
+
+    word_log_prob(history, word) takes a tuple of the preceding (at most
+    n - 1) words and the next word, exactly as text_log_prob scores a
+    sentence, so the returned log probability matches text_log_prob.
+    Returns (list of indices into words, log probability)
+    """
+    # Identical words are interchangeable, so only ever place the first
+    # unused copy of a word. This stops duplicates multiplying the states.
+    first_copy = {}
+    previous_copy = []
+    for i, w in enumerate(words):
+        previous_copy.append(first_copy.get(w))
+        first_copy[w] = i
+
+    def shift(history, w):
+        return (history + (w,))[-(n - 1):] if n > 1 else ()
+
+    # state (mask, history) -> (log prob, previous state, index of last word)
+    start = ((0, shift((), START_SYMBOL)), (word_log_prob((), START_SYMBOL), None, None))
+    layer = dict([start])
+    layers = [layer]
+    expansions = 0
+    for placed in range(len(words)):
+        if max_expansions is not None:
+            # Every state of the remaining layers tries up to remaining words
+            remaining = len(words) - placed
+            layer_width = max(1, (max_expansions - expansions) // (remaining * remaining))
+            if len(layer) > layer_width:
+                best_states = sorted(layer, key=lambda s: layer[s][0], reverse=True)
+                layer = {s: layer[s] for s in best_states[:layer_width]}
+                layers[-1] = layer
+
+        next_layer = {}
+        for (mask, history), (log_prob, _, _) in layer.items():
+            if deadline is not None and time.time() > deadline:
+                raise SearchTimeout("Search ran past its deadline after {} expansions".format(expansions))
+            expansions += len(words) - placed
+            for i, w in enumerate(words):
+                if mask & (1 << i):
+                    continue
+                if previous_copy[i] is not None and not mask & (1 << previous_copy[i]):
+                    continue
+                next_log_prob = log_prob + word_log_prob(history, w)
+                state = (mask | (1 << i), shift(history, w))
+                best = next_layer.get(state)
+                if best is None or next_log_prob > best[0]:
+                    next_layer[state] = (next_log_prob, (mask, history), i)
+
+        if beam_width is not None and len(next_layer) > beam_width:
+            best_states = sorted(next_layer, key=lambda s: next_layer[s][0], reverse=True)
+            next_layer = {s: next_layer[s] for s in best_states[:beam_width]}
+        layer = next_layer
+        layers.append(layer)
+
+    # Close every complete ordering with the end symbol and pick the best
+    best_state, best_log_prob = None, float('-inf')
+    for state, (log_prob, _, _) in layer.items():
+        log_prob += word_log_prob(state[1], END_SYMBOL)
+        if best_state is None or log_prob > best_log_prob:
+            best_state, best_log_prob = state, log_prob
+
+    # Follow the back pointers to recover the ordering
+    indices = []
+    state = best_state
+    for layer in reversed(layers[1:]):
+        _, state, i = layer[state]
+        indices.append(i)
+    return list(reversed(indices)), best_log_prob
@@ -0,0 +1,413 @@
+"""
+Long-running scoring server, so models are loaded once rather than on every
+run of main.py.
+
+Models are named by a spec string 'n:corpus:smoothing[:name=value,...]',
+e.g. '3:unstemmed:laplace:k=1', '2:stemmed:abs_dis:D=0.3' or
+'3:unstemmed:compact:filename=data/compact.npz', and every model
+given on the command line is loaded before the server starts listening.
+Models of the same n and corpus share one NGramCounts.
+
+Endpoints (POST a JSON object, get a JSON object back):
+    /perplexity     {"model": spec, "text": sentence or [sentences]}
+                    -> {"perplexity": float}
+    /text_log_prob  {"model": spec, "text": sentence or [sentences]}
+                    -> {"log_prob": float or [floats]}
+    /unscramble     {"model": spec, "text": sentence, "beam_width": int or null,
+                     "timeout": seconds, "max_expansions": int}
+                    -> {"sentence": str, "log_prob": float}
+and GET /models and /stats. Text is stemmed for stemmed models, as main.py
+does. Unscrambling is always limited by the server's timeout and
+max_expansions; a request can lower them but not lift them.
+
+Concurrent perplexity and text_log_prob requests for the same model are
+micro-batched: they are queued, and one thread per model scores everything
+that arrives within max_wait seconds (up to max_batch sentences) with a
+single vectorized score_batch call.
+"""
+import json
+import math
+import os
+import queue
+import socketserver
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+from language_model import NGramLanguageModel
+from ngram import NGramCounts
+from preprocessing import CorpusBuilder
+from probability import PROBABILITY_GENERATORS
+from search import SearchTimeout
+
+
+def check_text(text, single=False):
+    """
+    Raises ValueError unless text is a sentence (a string) or, unless
+    single, a non-empty list of sentences
+    """
+    if isinstance(text, str):
+        return
+    if single:
+        raise ValueError("text must be a string")
+    if not isinstance(text, list) or not text:
+        raise ValueError("text must be a string or a non-empty list of strings")
+    if not all(isinstance(sentence, str) for sentence in text):
+        raise ValueError("text must be a string or a non-empty list of strings")
+
+
+def parse_model_spec(spec):
+    """
+    Parses 'n:corpus:smoothing[:name=value,...]'
+    Returns (n, stemmed, smoothing, {name: value})
+    """
+    parts = spec.split(':')
+    if len(parts) not in (3, 4):
+        raise ValueError("Model spec {!r} is not n:corpus:smoothing[:name=value,...]".format(spec))
+    n, corpus, smoothing = int(parts[0]), parts[1], parts[2]
+    if corpus not in ('stemmed', 'unstemmed'):
+        raise ValueError("Unknown corpus {!r} in model spec {!r}".format(corpus, spec))
+    if smoothing not in PROBABILITY_GENERATORS:
+        raise ValueError("Unknown smoothing {!r} in model spec {!r}".format(smoothing, spec))
+
+    parameters = {}
+    if len(parts) == 4 and parts[3]:
+        for parameter in parts[3].split(','):
+            name, value = parameter.split('=')
+            for parse in (int, float, str):
+                try:
+                    parameters[name] = parse(value)
+                    break
+                except ValueError:
+                    pass
+    return n, corpus == 'stemmed', smoothing, parameters
+
+
+class MicroBatcher(object):
+    """
+    Collects the sentences of concurrent requests and scores them together.
+    submit() blocks until its sentences have been scored and returns their
+    scores, in order.
+    """
+
+    def __init__(self, score_batch, max_batch=1024, max_wait=0.002):
+        self.score_batch = score_batch
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.requests = queue.Queue()
+        self.batches = 0
+        self.sentences = 0
+        thread = threading.Thread(target=self._run)
+        thread.daemon = True
+        thread.start()
+
+    def submit(self, sentences):
+        request = {'sentences': sentences, 'done': threading.Event()}
+        self.requests.put(request)
+        request['done'].wait()
+        if 'error' in request:
+            raise request['error']
+        return request['scores']
+
+    def _next_batch(self, batch):
+        """
+        Blocks for one request, then takes any more that arrive within
+        max_wait, appending them to batch as they are taken
+        """
+        batch.append(self.requests.get())
+        size = len(batch[0]['sentences'])
+        deadline = time.time() + self.max_wait
+        while size < self.max_batch:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                request = self.requests.get(timeout=timeout)
+            except queue.Empty:
+                break
+            batch.append(request)
+            size += len(request['sentences'])
+
+    def _run(self):
+        while True:
+            # Whatever goes wrong, every request taken gets an answer, and
+            # the thread lives on to serve the next ones
+            batch = []
+            try:
+                self._next_batch(batch)
+                sentences = [s for request in batch for s in request['sentences']]
+                scores = self.score_batch(sentences)
+                start = 0
+                for request in batch:
+                    end = start + len(request['sentences'])
+                    request['scores'] = scores[start:end]
+                    start = end
+                self.batches += 1
+                self.sentences += len(sentences)
+            except Exception as e:
+                for request in batch:
+                    request['error'] = e
+            finally:
+                for request in batch:
+                    request['done'].set()
+
+    def stats(self):
+        return {
+            'batches': self.batches,
+            'sentences': self.sentences,
+            'mean_batch_size': self.sentences / self.batches if self.batches else 0.0,
+        }
+
+
+def _encoded_scorer(model):
+    """
+    Returns a function scoring a list of sentences with model, tokenized
+    (and stemmed, for a stemmed model) as main.py evaluates text
+    """
+    def score_batch(sentences):
+        counts = model.ngram_counts
+        return model.score_batch(counts.corpus_builder.encode(sentences, counts.vocabulary))
+    return score_batch
+
+
+class ModelRegistry(object):
+    """
+    The resident models, by spec string, each with its own MicroBatcher.
+    Unscrambling is limited to timeout seconds and max_expansions lookups
+    per sentence (see search.order_words)
+    """
+
+    def __init__(self, specs, data_path='data', max_batch=1024, max_wait=0.002,
+                 timeout=10.0, max_expansions=10 ** 6):
+        self.timeout = timeout
+        self.max_expansions = max_expansions
+        self.models = {}
+        self.batchers = {}
+        ngram_counts = {}
+        for spec in specs:
+            n, stemmed, smoothing, parameters = parse_model_spec(spec)
+            if (n, stemmed) not in ngram_counts:
+                corpus_builder = CorpusBuilder(data_path=data_path, stemmed=stemmed)
+                ngram_counts[n, stemmed] = NGramCounts(n, corpus_builder=corpus_builder)
+            model = NGramLanguageModel(
+                n=n,
+                probability_generator=PROBABILITY_GENERATORS[smoothing],
+                ngram_counts=ngram_counts[n, stemmed],
+                **parameters
+            )
+            self.models[spec] = model
+            self.batchers[spec] = MicroBatcher(_encoded_scorer(model), max_batch, max_wait)
+
+    def get(self, spec):
+        if spec not in self.models:
+            raise KeyError("Model {!r} is not loaded".format(spec))
+        return self.models[spec], self.batchers[spec]
+
+    def perplexity(self, spec, text):
+        """ Same as NGramLanguageModel.perplexity, scored through the batcher """
+        check_text(text)
+        sentences = [text] if isinstance(text, str) else text
+        _, batcher = self.get(spec)
+        text_len = sum([len(s.split()) + 2 for s in sentences])
+        log_perplexity = - 1 / text_len * sum(batcher.submit(sentences))
+        try:
+            return math.exp(log_perplexity)
+        except OverflowError:
+            return float('inf')
+
+    def text_log_prob(self, spec, text):
+        check_text(text)
+        sentences = [text] if isinstance(text, str) else text
+        _, batcher = self.get(spec)
+        scores = [float(s) for s in batcher.submit(sentences)]
+        return scores[0] if isinstance(text, str) else scores
+
+    def unscramble(self, spec, text, beam_width=None, timeout=None, max_expansions=None):
+        """
+        Unscrambles text with the server's limits, or lower ones if given.
+        Raises search.SearchTimeout if it runs out of time
+        """
+        check_text(text, single=True)
+        model, _ = self.get(spec)
+        return model.unscramble(
+            text,
+            beam_width=beam_width,
+            timeout=_lower_limit(self.timeout, timeout),
+            max_expansions=_lower_limit(self.max_expansions, max_expansions),
+        )
+
+    def stats(self):
+        return {
+            spec: {
+                'model': str(model),
+                'cache': model.cache.stats(),
+                'batching': self.batchers[spec].stats(),
+            }
+            for spec, model in self.models.items()
+        }
+
+
+def _lower_limit(limit, requested):
+    """ Returns the requested limit if it is below limit (where None is no limit) """
+    if requested is None:
+        return limit
+    if isinstance(requested, bool) or not isinstance(requested, (int, float)) or requested <= 0:
+        raise ValueError("Limits must be positive numbers, not {!r}".format(requested))
+    return requested if limit is None else min(limit, requested)
+
+
+class ScoringHandler(BaseHTTPRequestHandler):
+
+    # Keep connections open, so load generators aren't measuring TCP setup,
+    # and send small responses straight away rather than waiting on the ACK
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        registry = self.server.registry
+        if self.path == '/models':
+            self._send(200, {'models': sorted(registry.models)})
+        elif self.path == '/stats':
+            self._send(200, registry.stats())
+        else:
+            self._send(404, {'error': 'Unknown endpoint {}'.format(self.path)})
+
+    def do_POST(self):
+        registry = self.server.registry
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            request = json.loads(self.rfile.read(length).decode('utf-8'))
+            spec, text = request['model'], request['text']
+            if spec not in registry.models:
+                self._send(404, {'error': 'Model {!r} is not loaded'.format(spec)})
+                return
+            if self.path == '/perplexity':
+                response = {'perplexity': registry.perplexity(spec, text)}
+            elif self.path == '/text_log_prob':
+                response = {'log_prob': registry.text_log_prob(spec, text)}
+            elif self.path == '/unscramble':
+                sentence, log_prob = registry.unscramble(
+                    spec,
+                    text,
+                    request.get('beam_width'),
+                    request.get('timeout'),
+                    request.get('max_expansions'),
+                )
+                response = {'sentence': sentence, 'log_prob': log_prob}
+            else:
+                self._send(404, {'error': 'Unknown endpoint {}'.format(self.path)})
+                return
+        except KeyError as e:
+            self._send(400, {'error': 'Missing field {}'.format(e)})
+        except (ValueError, TypeError) as e:
+            self._send(400, {'error': str(e)})
+        except SearchTimeout as e:
+            self._send(503, {'error': str(e)})
+        except Exception as e:
+            self._send(500, {'error': '{}: {}'.format(type(e).__name__, e)})
+        else:
+            self._send(200, response)
+
+    def _send(self, status, response):
+        body = json.dumps(response).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # Unix socket clients have no address
+        return self.client_address[0] if self.client_address else 'unix'
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+class UnixScoringHandler(ScoringHandler):
+    # TCP_NODELAY can't be set on Unix sockets
+    disable_nagle_algorithm = False
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+
+def make_server(registry, host='127.0.0.1', port=8000, socket_path=None, verbose=False):
+    """ Returns a threaded HTTP server for registry, on socket_path if given, otherwise host:port """
+    if socket_path:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = ThreadingUnixHTTPServer(socket_path, UnixScoringHandler)
+    else:
+        server = ThreadingHTTPServer((host, port), ScoringHandler)
+    server.registry = registry
+    server.verbose = verbose
+    return server
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Serve language models over HTTP')
+    parser.add_argument(
+        'models',
+        nargs='+',
+        help="Models to load, as n:corpus:smoothing[:name=value,...] e.g. 3:unstemmed:laplace:k=1",
+    )
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--socket', help='Listen on this Unix socket instead of host:port')
+    parser.add_argument('--data_path', default='data')
+    parser.add_argument(
+        '--max_batch',
+        type=int,
+        default=1024,
+        help='Most sentences scored in one batch',
+    )
+    parser.add_argument(
+        '--max_wait',
+        type=float,
+        default=0.002,
+        help='Seconds to wait for more requests to batch together',
+    )
+    parser.add_argument(
+        '--timeout',
+        type=float,
+        default=10.0,
+        help='Most seconds spent unscrambling a sentence; requests may only lower it',
+    )
+    parser.add_argument(
+        '--max_expansions',
+        type=int,
+        default=10 ** 6,
+        help='Most probability lookups made unscrambling a sentence; requests may only lower it',
+    )
+    parser.add_argument('-v', '--verbose', action='store_true', help='Log every request')
+    args = parser.parse_args()
+
+    registry = ModelRegistry(
+        args.models,
+        args.data_path,
+        args.max_batch,
+        args.max_wait,
+        args.timeout,
+        args.max_expansions,
+    )
+    server = make_server(registry, args.host, args.port, args.socket, args.verbose)
+    for spec in sorted(registry.models):
+        print("Loaded {}: {}".format(spec, registry.models[spec]))
+    print("Listening on {}".format(args.socket or '{}:{}'.format(args.host, args.port)))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
@@ -0,0 +1,440 @@
+"""
+Sharded n-gram counts, so a model's counts can be spread over several
+processes or machines instead of every scoring process mapping all of them.
+
+Each order's n-grams are hash-partitioned by their history (all but the last
+word) across num_shards shard files, so all the continuations of a history
+live on one shard (unigrams are partitioned by word). Shard files are ordinary count stores, written next to
+the single store they are split from:
+    data/<n>gram_counts_<corpus>.shard<i>of<num_shards>.ngrams
+
+ShardedNGramCounts stands in for NGramCounts. It answers the count lookups
+of scoring by routing each batch of n-grams to the shards that hold them: the
+n-grams of every order of a batch go in one request per shard, sent to every
+shard before waiting on any. A
+shard is either read in this process (LocalShard) or served by another
+process, possibly on another machine (serve_shard and RemoteShard).
+
+Only count lookups and per-order totals are routed, which is all the count
+based models (raw, laplace, abs_dis) score with. Whatever needs a whole table
+(Kneser-Ney and Katz statistics, get_probabilities, sampling, to_frame) gets
+it merged from the shards the first time it asks for an order, so it holds
+that order's table in this process like unsharded counts would.
+
+    python sharding.py build -n 3 --shards 4
+    python sharding.py serve data/3gram_counts_unstemmed.shard0of4.ngrams --port 6000
+    python sharding.py test -n 3 --shards 4 --smoothing laplace
+"""
+import os
+import threading
+import time
+from multiprocessing import Pipe, Process
+from multiprocessing.connection import Client, Listener
+
+import numpy as np
+
+from artifacts import content_key
+from ngram import NGramCounts, NGramTable, _count_key
+from utils import PerOrder
+from store import read_counts, write_counts
+from vocabulary import WIDE_KEY, Vocabulary, history_keys, key_dtype
+
+# Multiplier of the (Fibonacci) hash of history keys
+HASH_MULTIPLIER = np.uint64(0x9E3779B97F4A7C15)
+AUTHKEY = b'ngram-shards'
+
+
+def shard_of(keys, n, bits, num_shards):
+    """
+    Returns the shard of each packed key of order n, from a hash of its
+    history. Unigrams have no history, so they go by the word itself
+    """
+    histories = history_keys(keys, n, bits) if n > 1 else np.asarray(keys, dtype=np.uint64)
+    if histories.dtype == WIDE_KEY:
+        # Folds the two halves of a wide history into one uint64 to hash
+        histories = histories['high'] * HASH_MULTIPLIER ^ histories['low']
+    hashes = (histories * HASH_MULTIPLIER) >> np.uint64(32)
+    return (hashes % np.uint64(num_shards)).astype(np.int64)
+
+
+def shard_filename(filename, shard, num_shards):
+    """ Returns the filename of one shard of the count store filename """
+    return '{}.shard{}of{}.ngrams'.format(os.path.splitext(filename)[0], shard, num_shards)
+
+
+def shard_key(corpus_builder, n, shard, num_shards):
+    """
+    Returns the artifact key of a shard (see artifacts.py): the keys of the
+    count stores of orders 1..n it is split from, and how they are split
+    """
+    corpus_key = corpus_builder.corpus_key()
+    if corpus_key is None:
+        return None
+    count_keys = [_count_key(corpus_key, k, corpus_builder.stemmed) for k in range(1, n + 1)]
+    return content_key('shard', count_keys, {'shard': shard, 'num_shards': num_shards})
+
+
+def build_shards(ngram_counts, num_shards, block_size=2 ** 20):
+    """
+    Splits the count store of ngram_counts into num_shards shard files. Each
+    shard is written in turn, reading the tables block_size n-grams at a
+    time, so at most one shard is held in memory
+    Returns the shard filenames
+    """
+    corpus_builder = ngram_counts.corpus_builder
+    bits = ngram_counts.vocabulary.bits
+    filenames = []
+    for shard in range(num_shards):
+        counts = {}
+        for n in range(1, ngram_counts.n + 1):
+            table = ngram_counts.get_table(n)
+            keys, values = [np.zeros(0, dtype=key_dtype(n, bits))], [np.zeros(0, dtype=np.int64)]
+            for start in range(0, len(table), block_size):
+                block = table.keys[start:start + block_size]
+                selected = shard_of(block, n, bits, num_shards) == shard
+                keys.append(np.asarray(block[selected]))
+                values.append(np.asarray(table.counts[start:start + block_size][selected]))
+            counts[n] = (np.concatenate(keys), np.concatenate(values))
+
+        filename = shard_filename(ngram_counts.filename(), shard, num_shards)
+        write_counts(filename, {'words': ngram_counts.vocabulary.words, 'counts': counts})
+        corpus_builder.artifacts.record({filename: shard_key(corpus_builder, ngram_counts.n, shard, num_shards)})
+        filenames.append(filename)
+    return filenames
+
+
+class LocalShard(object):
+    """ A shard read from its file in this process """
+
+    def __init__(self, filename):
+        data = read_counts(filename)
+        self.filename = filename
+        self.words = data['words']
+        bits = Vocabulary(self.words).bits
+        self.tables = {
+            n: NGramTable(n, bits, keys, counts)
+            for n, (keys, counts) in data['counts'].items()
+        }
+        self._result = None
+
+    def stats(self):
+        """ Returns {order: (number of n-grams, total count)} """
+        return {n: (len(table), table.total()) for n, table in self.tables.items()}
+
+    def lookup(self, requests):
+        """ Takes [(order, keys)], returns [counts of the keys] """
+        return [self.tables[n].counts_of(keys) for n, keys in requests]
+
+    def table(self, n):
+        """ Returns (keys, counts) of the shard's n-grams of order n, as in-memory arrays """
+        return np.array(self.tables[n].keys), np.array(self.tables[n].counts)
+
+    def submit(self, method, *args):
+        try:
+            self._result = getattr(self, method)(*args)
+        except Exception as e:
+            self._result = e
+
+    def result(self):
+        result, self._result = self._result, None
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+
+# What a shard server answers
+SHARD_METHODS = ('stats', 'lookup', 'table')
+
+
+def _serve_connection(shard, connection):
+    try:
+        while True:
+            method, args = connection.recv()
+            if method == 'words':
+                reply = shard.words
+            elif method in SHARD_METHODS:
+                try:
+                    reply = getattr(shard, method)(*args)
+                except Exception as e:
+                    # Sent back, so the client raises it and the connection stays usable
+                    reply = e
+            else:
+                reply = ValueError("Unknown shard method {!r}".format(method))
+            connection.send(reply)
+    except EOFError:
+        pass
+    finally:
+        connection.close()
+
+
+def serve_shard(filename, address=('localhost', 0), authkey=AUTHKEY, ready=None):
+    """
+    Serves a shard file at address (host, port) forever, each connection on
+    its own thread. If ready (a Connection) is given, the address actually
+    listened on is sent to it once the shard is loaded
+    """
+    shard = LocalShard(filename)
+    listener = Listener(address, authkey=authkey)
+    if ready is not None:
+        ready.send(listener.address)
+    while True:
+        connection = listener.accept()
+        thread = threading.Thread(target=_serve_connection, args=(shard, connection))
+        thread.daemon = True
+        thread.start()
+
+
+class RemoteShard(object):
+    """ A shard served by serve_shard in another process """
+
+    def __init__(self, address, authkey=AUTHKEY):
+        self.address = address
+        self.connection = Client(address, authkey=authkey)
+        self.words = self._call('words')
+
+    def _call(self, method, *args):
+        self.submit(method, *args)
+        return self.result()
+
+    def stats(self):
+        return self._call('stats')
+
+    def lookup(self, requests):
+        return self._call('lookup', requests)
+
+    def table(self, n):
+        return self._call('table', n)
+
+    def submit(self, method, *args):
+        self.connection.send((method, args))
+
+    def result(self):
+        try:
+            result = self.connection.recv()
+        except (EOFError, OSError):
+            # The server is gone: nothing more can be read from it
+            self.connection.close()
+            raise
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+
+def start_local_shards(filenames, authkey=AUTHKEY):
+    """
+    Test harness standing in for separate nodes: starts a shard server
+    process on localhost for every shard file
+    Returns (addresses, processes); stop them with stop_local_shards
+    """
+    addresses, processes = [], []
+    for filename in filenames:
+        parent, child = Pipe()
+        process = Process(target=serve_shard, args=(filename, ('localhost', 0), authkey, child))
+        process.daemon = True
+        process.start()
+        addresses.append(parent.recv())
+        processes.append(process)
+    return addresses, processes
+
+
+def stop_local_shards(processes):
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        process.join()
+
+
+class ShardedNGramCounts(NGramCounts):
+    """
+    NGramCounts whose tables are split across shards. With addresses, the
+    shards are the shard servers at those (host, port) addresses, in shard
+    order; otherwise the shard files are read in this process, and split
+    from the single count store (building that first if needed) whenever
+    they are missing or their artifact key is not that of the current
+    count stores.
+
+    count_batch, count_batches, total and size are answered by the shards.
+    get_table merges an order's table from every shard on first use.
+    """
+
+    def __init__(self, n, corpus_builder=None, num_shards=4, addresses=None, authkey=AUTHKEY):
+        if addresses is not None:
+            num_shards = len(addresses)
+        self.num_shards = num_shards
+        self.addresses = addresses
+        self.authkey = authkey
+        self.shards = []
+        self.shard_stats = {}
+        # Each shard connection carries one request at a time
+        self.lock = threading.Lock()
+        super().__init__(n, corpus_builder=corpus_builder)
+
+    def shard_filenames(self):
+        return [shard_filename(self.filename(), i, self.num_shards) for i in range(self.num_shards)]
+
+    def load_counts(self, update=False):
+        if self.addresses is not None:
+            self.shards = [RemoteShard(address, self.authkey) for address in self.addresses]
+        else:
+            filenames = self.shard_filenames()
+            artifacts = self.corpus_builder.artifacts
+            stale = [
+                f for i, f in enumerate(filenames)
+                if not artifacts.is_fresh(f, shard_key(self.corpus_builder, self.n, i, self.num_shards))
+            ]
+            if update or stale:
+                build_shards(NGramCounts(self.n, corpus_builder=self.corpus_builder), self.num_shards)
+            self.shards = [LocalShard(filename) for filename in filenames]
+
+        self.vocabulary = Vocabulary(self.shards[0].words)
+        # {order: (number of n-grams, total count)} over all shards
+        self.shard_stats = {}
+        for stats in self._call_shards('stats', [()] * len(self.shards)):
+            for n, (size, total) in stats.items():
+                previous_size, previous_total = self.shard_stats.get(n, (0, 0))
+                self.shard_stats[n] = (previous_size + size, previous_total + total)
+        self.tables = PerOrder(self._merge_table, orders=set(self.shard_stats))
+        self.generation += 1
+
+    def _call_shards(self, method, shard_args):
+        """
+        Calls method on every shard, with the arguments in shard_args, and
+        returns their replies. Every shard works on its call before any
+        reply is waited on, and every reply is read even if one raises, so
+        none is left on its connection for the next call to read
+        """
+        with self.lock:
+            submitted, error = [], None
+            for shard, args in zip(self.shards, shard_args):
+                try:
+                    shard.submit(method, *args)
+                except Exception as e:
+                    error = e
+                    break
+                submitted.append(shard)
+            replies = []
+            for shard in submitted:
+                try:
+                    replies.append(shard.result())
+                except Exception as e:
+                    if error is None:
+                        error = e
+            if error is not None:
+                raise error
+            return replies
+
+    def _merge_table(self, n):
+        """ Builds the table of order n from the n-grams of every shard """
+        parts = self._call_shards('table', [(n,)] * len(self.shards))
+        keys = np.concatenate([keys for keys, _ in parts])
+        counts = np.concatenate([counts for _, counts in parts])
+        # Shards hold disjoint n-grams, so sorting is all the merge needs
+        order = np.argsort(keys, kind='mergesort')
+        return NGramTable(n, self.vocabulary.bits, keys[order], counts[order])
+
+    def get_table(self, n=None):
+        if n is None:
+            n = self.n
+        return self.tables[n]
+
+    def count_batch(self, keys, n=None):
+        if n is None:
+            n = self.n
+        return self.count_batches([(n, keys)])[0]
+
+    def count_batches(self, requests):
+        """
+        Looks up [(order, packed keys)] with one request to each shard
+        Returns [counts], 0 for unseen n-grams
+        """
+        bits = self.vocabulary.bits
+        shard_requests = [[] for _ in self.shards]
+        placements = []
+        for n, keys in requests:
+            keys = np.asarray(keys, dtype=key_dtype(n, bits))
+            shards = shard_of(keys, n, bits, self.num_shards)
+            order = np.argsort(shards, kind='mergesort')
+            bounds = np.searchsorted(shards[order], np.arange(self.num_shards + 1))
+            for shard in range(self.num_shards):
+                shard_requests[shard].append((n, keys[order[bounds[shard]:bounds[shard + 1]]]))
+            placements.append((len(keys), order, bounds))
+
+        replies = self._call_shards('lookup', [(shard_request,) for shard_request in shard_requests])
+
+        results = []
+        for i, (size, order, bounds) in enumerate(placements):
+            counts = np.zeros(size, dtype=np.int64)
+            for shard, reply in enumerate(replies):
+                counts[order[bounds[shard]:bounds[shard + 1]]] = reply[i]
+            results.append(counts)
+        return results
+
+    def total(self, n=None):
+        return self.shard_stats[self.n if n is None else n][1]
+
+    def size(self, n=None):
+        return self.shard_stats[self.n if n is None else n][0]
+
+
+if __name__ == '__main__':
+    import argparse
+    from language_model import NGramLanguageModel
+    from preprocessing import CorpusBuilder
+    from probability import PROBABILITY_GENERATORS
+
+    parser = argparse.ArgumentParser(description='Build, serve and test sharded n-gram counts')
+    subparsers = parser.add_subparsers(dest='command')
+
+    build_parser = subparsers.add_parser('build', help='Split a count store into shard files')
+    serve_parser = subparsers.add_parser('serve', help='Serve one shard file')
+    test_parser = subparsers.add_parser(
+        'test',
+        help='Score with a local shard server per shard, against the unsharded counts',
+    )
+    for p in (build_parser, test_parser):
+        p.add_argument('-n', type=int, default=3)
+        p.add_argument('--shards', type=int, default=4, help='Number of shards to split the counts into')
+        p.add_argument('--stemmed', action='store_true')
+        p.add_argument('--data_path', default='data')
+    serve_parser.add_argument('filename')
+    serve_parser.add_argument('--host', default='localhost')
+    serve_parser.add_argument('--port', type=int, default=6000)
+    test_parser.add_argument('--smoothing', choices=sorted(set(PROBABILITY_GENERATORS) - {'compact'}), default='laplace')
+    test_parser.add_argument('--evaluate', default='TEST_CORPUS', help='File to compute the perplexity of')
+    args = parser.parse_args()
+
+    if args.command == 'serve':
+        print("Serving {} on {}:{}".format(args.filename, args.host, args.port))
+        serve_shard(args.filename, (args.host, args.port))
+
+    corpus_builder = CorpusBuilder(data_path=args.data_path, stemmed=args.stemmed)
+    ngram_counts = NGramCounts(args.n, corpus_builder=corpus_builder)
+    filenames = build_shards(ngram_counts, args.shards)
+    for filename in filenames:
+        print("Wrote {} ({:.1f} MB)".format(filename, os.path.getsize(filename) / 2 ** 20))
+    if args.command == 'build':
+        parser.exit()
+
+    addresses, processes = start_local_shards(filenames)
+    try:
+        results = []
+        for counts in (ngram_counts, ShardedNGramCounts(args.n, corpus_builder, addresses=addresses)):
+            language_model = NGramLanguageModel(
+                n=args.n,
+                probability_generator=PROBABILITY_GENERATORS[args.smoothing],
+                ngram_counts=counts,
+            )
+            text = language_model._load_test_text(args.evaluate)
+            start = time.time()
+            perplexity = language_model.perplexity(text)
+            results.append((perplexity, time.time() - start, text.lengths.sum()))
+
+        for name, (perplexity, seconds, tokens) in zip(['unsharded', 'sharded'], results):
+            print("{:<10} perplexity {:.4f} in {:.3f}s ({:.0f} tokens/s)".format(
+                name, perplexity, seconds, tokens / seconds))
+        for i, (address, filename) in enumerate(zip(addresses, filenames)):
+            stats = LocalShard(filename).stats()
+            print("shard {} at {}: {}".format(i, address, ', '.join(
+                '{}-grams {}'.format(n, size) for n, (size, _) in sorted(stats.items()))))
+    finally:
+        stop_local_shards(processes)
@@ -0,0 +1,165 @@
+"""
+Binary on-disk format for n-gram counts, designed to be memory-mapped:
+
+    header   magic 'NGRM', version, number of orders, bits per id (uint32 each),
+             vocabulary size, vocabulary bytes (uint64 each)
+    orders   n, number of n-grams, keys offset, counts offset (uint64 each)
+    vocab    utf-8 words separated by newlines (id 0 is the empty string)
+    arrays   sorted keys and int64 counts for each order, 8-byte aligned; keys
+             are uint64, or (high, low) uint64 pairs for orders whose ids
+             need more than 64 bits (see vocabulary.key_dtype)
+
+Counts are exchanged as the same dict that gets pickled:
+    {'words': [None, word1, ...], 'counts': {n: (keys, counts)}}
+
+Compact models (pruned and quantized probabilities, see compact.py) are
+stored separately as .npz archives by write_compact.
+"""
+import json
+import os
+import pickle
+import struct
+import numpy as np
+from vocabulary import Vocabulary, key_dtype, pack
+
+MAGIC = b'NGRM'
+VERSION = 1
+HEADER = struct.Struct('<4sIIIQQ')
+ORDER = struct.Struct('<QQQQ')
+
+
+def _align(offset):
+    return (offset + 7) // 8 * 8
+
+
+def _write_array(f, array, dtype, block_size=2 ** 20):
+    """ Writes array in blocks, so memory-mapped arrays are never fully loaded """
+    for i in range(0, len(array), block_size):
+        f.write(np.ascontiguousarray(array[i:i + block_size], dtype=dtype).tobytes())
+
+
+def write_counts(filename, data):
+    """ Writes counts data to filename, replacing it atomically """
+    words = data['words']
+    vocab = '\n'.join(w if w is not None else '' for w in words).encode('utf-8')
+    orders = sorted(data['counts'].items())
+    bits = max(1, (len(words) - 1).bit_length())
+
+    offset = _align(HEADER.size + ORDER.size * len(orders) + len(vocab))
+    entries = []
+    for n, (keys, counts) in orders:
+        keys_offset = offset
+        counts_offset = keys_offset + key_dtype(n, bits).itemsize * len(keys)
+        offset = counts_offset + 8 * len(counts)
+        entries.append((n, len(keys), keys_offset, counts_offset))
+
+    tmp_filename = filename + '.tmp'
+    with open(tmp_filename, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, len(orders), bits, len(words), len(vocab)))
+        for entry in entries:
+            f.write(ORDER.pack(*entry))
+        f.write(vocab)
+        for (n, (keys, counts)), (_, _, keys_offset, counts_offset) in zip(orders, entries):
+            f.write(b'\0' * (keys_offset - f.tell()))
+            _write_array(f, keys, key_dtype(n, bits))
+            _write_array(f, counts, '<i8')
+    os.replace(tmp_filename, filename)
+
+
+def read_counts(filename):
+    """
+    Reads counts data from filename. The key and count arrays are read-only
+    memory maps, so loading is close to instant and processes reading the
+    same file share its pages through the OS cache.
+    """
+    with open(filename, 'rb') as f:
+        magic, version, num_orders, bits, num_words, vocab_size = HEADER.unpack(f.read(HEADER.size))
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("{} is not a version {} n-gram store".format(filename, VERSION))
+        entries = [ORDER.unpack(f.read(ORDER.size)) for _ in range(num_orders)]
+        words = f.read(vocab_size).decode('utf-8').split('\n')
+
+    words[0] = None
+    counts = {}
+    for n, length, keys_offset, counts_offset in entries:
+        dtype = key_dtype(n, bits)
+        if length:
+            keys = np.memmap(filename, dtype=dtype, mode='r', offset=keys_offset, shape=(length,))
+            values = np.memmap(filename, dtype='<i8', mode='r', offset=counts_offset, shape=(length,))
+        else:
+            keys, values = np.zeros(0, dtype=dtype), np.zeros(0, dtype=np.int64)
+        counts[int(n)] = (keys, values)
+    return {'words': words, 'counts': counts}
+
+
+def frames_to_counts(frames):
+    """ Converts the old {n: | word1 | ... | wordn | count | DataFrame} format to counts data """
+    vocabulary = Vocabulary()
+    for word in frames[1]['word1'].values:
+        vocabulary.add(word)
+
+    counts = {}
+    for n, frame in frames.items():
+        ids = np.column_stack([
+            vocabulary.encode(frame['word' + str(i+1)].values, add=True)
+            for i in range(n)
+        ])
+        keys = pack(ids, vocabulary.bits)
+        order = np.argsort(keys)
+        counts[n] = (keys[order], frame['count'].values.astype(np.int64)[order])
+    return {'words': vocabulary.words, 'counts': counts}
+
+
+def load_pickle(filename):
+    """ Loads pickled counts data in either the old DataFrame or the packed format """
+    data = pickle.load(open(filename, 'rb'))
+    if 'words' not in data:
+        data = frames_to_counts(data)
+    return data
+
+
+def convert_pickle(pickle_filename):
+    """
+    Converts a <n>gram_counts_*.pickle file, which holds the counts of every
+    order up to n, to one store per order: <m>gram_counts_*.ngrams next to
+    it, for each order m that has no store yet.
+    Returns the filenames of the stores written
+    """
+    data = load_pickle(pickle_filename)
+    directory, name = os.path.split(os.path.splitext(pickle_filename)[0])
+    suffix = name.split('gram', 1)[1]
+    written = []
+    for n, counts in sorted(data['counts'].items()):
+        store_filename = os.path.join(directory, '{}gram{}.ngrams'.format(n, suffix))
+        if not os.path.exists(store_filename):
+            write_counts(store_filename, {'words': data['words'], 'counts': {n: counts}})
+            written.append(store_filename)
+    return written
+
+
+def write_compact(filename, data):
+    """
+    Writes a compact model (see compact.py) as an uncompressed .npz archive:
+    meta as a json string, and the arrays of each order as <name>_<order>
+    """
+    arrays = {'meta': np.array(json.dumps(data['meta']))}
+    for n, order in data['orders'].items():
+        for name, array in order.items():
+            if array is not None:
+                arrays['{}_{}'.format(name, n)] = array
+    with open(filename, 'wb') as f:
+        np.savez(f, **arrays)
+
+
+def read_compact(filename):
+    """ Reads a compact model written by write_compact """
+    with np.load(filename) as archive:
+        meta = json.loads(str(archive['meta']))
+        orders = {}
+        for name in archive.files:
+            if name == 'meta':
+                continue
+            array_name, n = name.rsplit('_', 1)
+            orders.setdefault(int(n), {})[array_name] = archive[name]
+    return {'meta': meta, 'orders': orders}
+
@@ -0,0 +1,103 @@
+"""
+Perplexity of evaluation files too large to load at once.
+
+The file is read chunk_size characters at a time and cut at the last
+sentence boundary ('.') of each chunk, carrying the rest over to the next
+one, so it is split into exactly the sentences evaluate would split it
+into. Each chunk is encoded and scored as soon as it is read, and only its
+log probability and token count are kept, so memory stays at a few chunks
+however large the file is. Chunks can be scored across a pool of worker
+processes, with at most two chunks per worker read ahead.
+"""
+import math
+import time
+from collections import deque
+from multiprocessing import cpu_count
+
+from language_model import NGramLanguageModel
+from utils import set_worker_state, worker_pool, worker_state
+
+
+def read_chunks(filename, chunk_size=2 ** 22):
+    """
+    Yields the text of filename in pieces of about chunk_size characters,
+    each ending just before a sentence boundary, so that splitting every
+    piece on '.' gives the sentences of the whole file
+    """
+    rest = ''
+    with open(filename, 'r') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            text = rest + chunk
+            cut = text.rfind('.')
+            if cut < 0:
+                rest = text
+                continue
+            yield text[:cut]
+            rest = text[cut + 1:]
+    # What follows the last boundary is a sentence too, as it is for evaluate
+    yield rest
+
+
+def _score_chunk(text):
+    """ Returns (log probability, number of tokens, number of sentences) of a chunk of text """
+    language_model = worker_state()
+    ngram_counts = language_model.ngram_counts
+    encoded = ngram_counts.corpus_builder.encode(text.split('.'), ngram_counts.vocabulary)
+    return float(language_model.score_batch(encoded).sum()), int(encoded.lengths.sum()), len(encoded.lengths)
+
+
+def stream_perplexity(language_model, filename, chunk_size=2 ** 22, processes=1):
+    """
+    Computes the perplexity of filename in one pass over it, without ever
+    holding more than a few chunks. Yields the running totals after every
+    chunk, in file order, as a dict of
+        chunks, characters, sentences, tokens, log_prob,
+        perplexity (of the text so far), seconds, tokens_per_second
+    so the last one yielded is the result for the whole file.
+    processes=1 scores in this process with language_model itself, otherwise
+    across a pool of processes (None for one per CPU) that each build a copy
+    """
+    progress = {
+        'chunks': 0,
+        'characters': 0,
+        'sentences': 0,
+        'tokens': 0,
+        'log_prob': 0.0,
+    }
+    start = time.time()
+
+    def update(characters, result):
+        log_prob, tokens, sentences = result
+        progress['chunks'] += 1
+        progress['characters'] += characters
+        progress['sentences'] += sentences
+        progress['tokens'] += tokens
+        progress['log_prob'] += log_prob
+        progress['seconds'] = time.time() - start
+        progress['perplexity'] = math.exp(- progress['log_prob'] / progress['tokens'])
+        progress['tokens_per_second'] = progress['tokens'] / max(progress['seconds'], 1e-9)
+        return dict(progress)
+
+    chunks = read_chunks(filename, chunk_size)
+    if processes == 1:
+        set_worker_state(language_model)
+        for text in chunks:
+            yield update(len(text), _score_chunk(text))
+        return
+
+    # Each worker builds its own copy of the model once
+    with worker_pool(processes, NGramLanguageModel, language_model.config) as pool:
+        # Chunks being scored, oldest first; reading stops while it is full
+        pending = deque()
+        read_ahead = 2 * (processes or cpu_count())
+        for text in chunks:
+            pending.append((len(text), pool.apply_async(_score_chunk, (text,))))
+            if len(pending) >= read_ahead:
+                characters, result = pending.popleft()
+                yield update(characters, result.get())
+        while pending:
+            characters, result = pending.popleft()
+            yield update(characters, result.get())
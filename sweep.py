@@ -0,0 +1,114 @@
+import csv
+import json
+import os
+
+from language_model import NGramLanguageModel
+from ngram import NGramCounts
+from preprocessing import CorpusBuilder
+from probability import PROBABILITY_GENERATORS
+from utils import parallel_map
+
+# Name of the smoothing parameter each probability model is swept over
+SWEEP_PARAMETERS = {
+    'raw': None,
+    'laplace': 'k',
+    'abs_dis': 'D',
+    'kneser_ney': 'D',
+    'katz': None,
+}
+
+FIELDS = ['n', 'stemmed', 'smoothing', 'parameter', 'value', 'perplexity']
+
+
+def _evaluate_config(config):
+    """
+    Evaluates every smoothing and parameter value for one (n, stemmed) model,
+    loading its counts and the test text only once
+    Returns a list of result rows
+    """
+    test_text_file, data_path, n, stemmed, smoothings, values = config
+
+    # Already running in a worker process, so build anything missing serially
+    corpus_builder = CorpusBuilder(data_path=data_path, stemmed=stemmed, processes=1)
+    ngram_counts = NGramCounts(n, corpus_builder=corpus_builder)
+
+    rows = []
+    text = None
+    for smoothing in smoothings:
+        parameter = SWEEP_PARAMETERS[smoothing]
+        kwargs = {parameter: values[parameter][0]} if parameter else {}
+        language_model = NGramLanguageModel(
+            n=n,
+            probability_generator=PROBABILITY_GENERATORS[smoothing],
+            ngram_counts=ngram_counts,
+            **kwargs
+        )
+        if text is None:
+            text = language_model._load_test_text(test_text_file)
+
+        if parameter:
+            perplexities = language_model.perplexity_sweep(text, **{parameter: values[parameter]})
+            parameter_values = values[parameter]
+        else:
+            perplexities = [language_model.perplexity(text)]
+            parameter_values = [None]
+
+        for value, perplexity in zip(parameter_values, perplexities):
+            # A perplexity below 1 means the model gave some word more than
+            # all the probability mass: recorded as NaN, not as a result
+            if not perplexity >= 1:
+                perplexity = float('nan')
+            rows.append({
+                'n': n,
+                'stemmed': stemmed,
+                'smoothing': smoothing,
+                'parameter': parameter,
+                'value': value,
+                'perplexity': float(perplexity),
+            })
+    return rows
+
+
+def sweep(test_text_file,
+          ns=(1, 2, 3),
+          smoothings=('abs_dis', 'katz', 'kneser_ney', 'laplace', 'raw'),
+          ks=(1, 2, 3, 4, 5),
+          Ds=(0.1, 0.2, 0.3, 0.4, 0.5),
+          corpora=('unstemmed',),
+          processes=None,
+          output='output_data/perplexity_sweep',
+          data_path='data'):
+    """
+    Evaluates the perplexity of every (n, corpus, smoothing, k/D) model in the
+    grid on test_text_file. Each (n, corpus) model is loaded once and
+    evaluated for all of its smoothings and parameter values, and the models
+    are evaluated in parallel across processes.
+    Writes the results to output.csv and output.json and returns them
+    """
+    # Build the shared corpus, stem map and counts up front, so workers don't
+    # race to; counting up to the highest n stores every order they load
+    for corpus in set(corpora):
+        corpus_builder = CorpusBuilder(data_path=data_path, stemmed=corpus == 'stemmed', processes=processes)
+        corpus_builder.load_test_corpus()
+        if corpus == 'stemmed':
+            corpus_builder.load_stem_map()
+        NGramCounts(max(ns), corpus_builder=corpus_builder)
+
+    values = {'k': list(ks), 'D': list(Ds)}
+    configs = [
+        (test_text_file, data_path, n, corpus == 'stemmed', list(smoothings), values)
+        for corpus in corpora
+        for n in ns
+    ]
+    rows = [row for rows in parallel_map(_evaluate_config, configs, processes) for row in rows]
+
+    output_dir = os.path.dirname(output)
+    if output_dir and not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    with open(output + '.csv', 'w') as f:
+        writer = csv.DictWriter(f, fieldnames=FIELDS)
+        writer.writeheader()
+        writer.writerows(rows)
+    with open(output + '.json', 'w') as f:
+        json.dump(rows, f, indent=2)
+    return rows
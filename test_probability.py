@@ -0,0 +1,50 @@
+"""
+Checks of the probability models against the corpus in data/wordLemPoS.
+Counts are built in a temporary directory, so data/ is left untouched:
+
+    python -m unittest test_probability
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from language_model import NGramLanguageModel
+from ngram import NGramCounts
+from preprocessing import CorpusBuilder
+from probability import PROBABILITY_GENERATORS
+
+TEXT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'wordLemPoS')
+
+
+class KatzBackoffTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.data_path = tempfile.mkdtemp()
+        os.symlink(TEXT_DIR, os.path.join(cls.data_path, 'wordLemPoS'))
+        cls.ngram_counts = NGramCounts(3, corpus_builder=CorpusBuilder(data_path=cls.data_path))
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.data_path)
+
+    def test_test_corpus_log_probabilities_are_finite(self):
+        # Every word, seen after its history or not, keeps some probability
+        for n in (2, 3):
+            language_model = NGramLanguageModel(
+                n=n,
+                probability_generator=PROBABILITY_GENERATORS['katz'],
+                ngram_counts=self.ngram_counts,
+            )
+            text = language_model._load_test_text('TEST_CORPUS')
+            for k, ends, ngrams in language_model._gather_ngrams(text):
+                log_probs = language_model.probability_generator.log_probability_batch(ngrams, k)
+                self.assertTrue(np.isfinite(log_probs).all(), "{}-grams of a {}-gram model".format(k, n))
+            self.assertTrue(np.isfinite(language_model.perplexity(text)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+import time
+
+from language_model import NGramLanguageModel
+from search import SearchTimeout
+from utils import set_worker_state, worker_pool, worker_state
+
+
+def _unscramble_line(task):
+    """
+    Unscrambles one sentence with the worker's model
+    Returns a dict describing the result; status is 'ok', 'timeout' or 'error'
+    """
+    index, text, search_kwargs = task
+    language_model = worker_state()
+    result = {'index': index, 'text': text, 'sentence': None, 'log_prob': None}
+    start = time.time()
+    try:
+        sentence, log_prob = language_model.unscramble(text, **search_kwargs)
+    except SearchTimeout:
+        result['status'] = 'timeout'
+    except Exception as e:
+        result['status'] = 'error'
+        result['error'] = '{}: {}'.format(type(e).__name__, e)
+    else:
+        result.update({
+            'status': 'ok',
+            'sentence': sentence,
+            'log_prob': log_prob,
+            'perplexity': language_model.perplexity(sentence),
+            'text_log_prob': language_model.text_log_prob(text),
+            'text_perplexity': language_model.perplexity(text),
+        })
+    result['seconds'] = time.time() - start
+    return result
+
+
+def unscramble_lines(language_model,
+                     lines,
+                     processes=None,
+                     beam_width=None,
+                     max_expansions=None,
+                     timeout=None):
+    """
+    Unscrambles each line of lines as a separate sentence, across a pool of
+    processes that each build a copy of language_model. Results are yielded
+    in the order of lines as soon as they (and every line before them) are
+    done. processes=1 unscrambles in this process, with language_model itself.
+
+    Each sentence is given at most timeout seconds and max_expansions
+    probability lookups (see search.order_words), so one long line can't hold
+    up the rest: a sentence that runs out of time is reported with status
+    'timeout' and the next one carries on.
+    """
+    search_kwargs = {
+        'beam_width': beam_width,
+        'max_expansions': max_expansions,
+        'timeout': timeout,
+    }
+    tasks = ((i, line, search_kwargs) for i, line in enumerate(lines))
+
+    if processes == 1:
+        set_worker_state(language_model)
+        for result in map(_unscramble_line, tasks):
+            yield result
+        return
+
+    # Each worker builds its own copy of the model once
+    with worker_pool(processes, NGramLanguageModel, language_model.config) as pool:
+        for result in pool.imap(_unscramble_line, tasks):
+            yield result
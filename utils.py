@@ -1,4 +1,6 @@
+from contextlib import contextmanager
 from itertools import tee
+from multiprocessing import Pool
 
 START_SYMBOL = '__START__'
 END_SYMBOL = '__END__'
@@ -21,3 +23,76 @@ def window(iterable, size, left_nulls=False):
         for each in iters[i:]:
             next(each, None)
     return zip(*iters)
+
+
+class PerOrder(dict):
+    """
+    {order: value} that builds the value of an order with build(order) the
+    first time it is looked up, so nothing is built for orders never used.
+    orders, if given, are the only orders that can be built
+    """
+
+    def __init__(self, build, orders=None):
+        super().__init__()
+        self.build = build
+        self.orders = orders
+
+    def __missing__(self, n):
+        if self.orders is not None and n not in self.orders:
+            raise KeyError(n)
+        value = self[n] = self.build(n)
+        return value
+
+
+def parallel_map(func, iterable, processes=None, initializer=None, initargs=()):
+    """
+    Returns list(map(func, iterable)), computed across a pool of processes.
+    processes=None uses one per CPU, processes=1 runs in this process.
+    Results are always in the order of iterable.
+    """
+    if processes == 1:
+        if initializer is not None:
+            initializer(*initargs)
+        return list(map(func, iterable))
+
+    pool = Pool(processes, initializer, initargs)
+    try:
+        return pool.map(func, iterable)
+    finally:
+        pool.close()
+        pool.join()
+
+
+# What the functions run by a worker_pool work with (e.g. a language model),
+# built once in each worker
+_worker_state = None
+
+
+def set_worker_state(state):
+    """ Sets what worker_state returns in this process, e.g. to run pool tasks without a pool """
+    global _worker_state
+    _worker_state = state
+
+
+def worker_state():
+    return _worker_state
+
+
+def _init_worker_state(factory, kwargs):
+    set_worker_state(factory(**kwargs))
+
+
+@contextmanager
+def worker_pool(processes, factory, kwargs):
+    """
+    Returns a Pool of processes (None for one per CPU) whose workers each
+    build factory(**kwargs) once, for their tasks to get with worker_state.
+    The workers are stopped on leaving the context, even if the caller
+    stopped reading their results early
+    """
+    pool = Pool(processes, _init_worker_state, (factory, kwargs))
+    try:
+        yield pool
+    finally:
+        pool.terminate()
+        pool.join()
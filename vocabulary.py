@@ -0,0 +1,190 @@
+import hashlib
+from collections import namedtuple
+from itertools import repeat
+import numpy as np
+from utils import START_SYMBOL, END_SYMBOL
+
+# Id 0 is reserved for words that are not in the vocabulary. No stored n-gram
+# ever contains it, so lookups of unknown words simply miss.
+UNKNOWN_ID = 0
+START_ID = 1
+END_ID = 2
+
+# Sentences as one flat int32 array of ids, each wrapped in START_ID/END_ID,
+# and the length of each sentence including those two
+EncodedText = namedtuple('EncodedText', ['ids', 'lengths'])
+
+
+class Vocabulary(object):
+    """
+    Bidirectional mapping between words and dense int32 ids.
+    START_SYMBOL and END_SYMBOL always get ids 1 and 2.
+    """
+
+    def __init__(self, words=None):
+        self.words = [None]
+        self.ids = {}
+        # (stem map, {word: id of its stem}) for the last stem map used
+        self._stem_lookup = (None, None)
+        if words is None:
+            words = [START_SYMBOL, END_SYMBOL]
+        for word in words:
+            if word is not None:
+                self.add(word)
+
+    def __len__(self):
+        """ Number of ids in use, including the reserved unknown id """
+        return len(self.words)
+
+    def __contains__(self, word):
+        return word in self.ids
+
+    @property
+    def bits(self):
+        """ Number of bits needed to store any id """
+        return max(1, (len(self.words) - 1).bit_length())
+
+    def add(self, word):
+        """ Returns the id of word, assigning it the next free id if it is new """
+        i = self.ids.get(word)
+        if i is None:
+            i = self.ids[word] = len(self.words)
+            self.words.append(word)
+        return i
+
+    def get(self, word):
+        """ Returns the id of word, or UNKNOWN_ID """
+        return self.ids.get(word, UNKNOWN_ID)
+
+    def encode(self, words, add=False):
+        """ Returns an int32 array of ids for a sequence of words """
+        lookup = self.add if add else self.get
+        return np.fromiter((lookup(w) for w in words), dtype=np.int32, count=len(words))
+
+    def stem_lookup(self, stem_map):
+        """
+        Returns {word: id} with stem_map folded in: a word in stem_map maps to
+        the id of its stem, as CorpusBuilder.stem would have stemmed it
+        """
+        if self._stem_lookup[0] is not stem_map:
+            lookup = dict(self.ids)
+            get = self.ids.get
+            for word, stem in stem_map.items():
+                lookup[word] = get(stem, UNKNOWN_ID)
+            self._stem_lookup = (stem_map, lookup)
+        return self._stem_lookup[1]
+
+    def encode_sentences(self, sentences, stem_map=None):
+        """
+        Maps sentences (strings of space separated words, or lists of words)
+        to ids in one pass, without building any intermediate strings. With
+        a stem_map, every word is looked up by its stem.
+        Returns an EncodedText
+        """
+        get = (self.ids if stem_map is None else self.stem_lookup(stem_map)).get
+        ids = []
+        lengths = []
+        for sentence in sentences:
+            words = sentence.split() if isinstance(sentence, str) else sentence
+            lengths.append(len(words) + 2)
+            ids.append(START_ID)
+            ids.extend(map(get, words, repeat(UNKNOWN_ID)))
+            ids.append(END_ID)
+        return EncodedText(np.array(ids, dtype=np.int32), np.array(lengths, dtype=np.int64))
+
+    def decode(self, ids):
+        """ Returns the list of words for a sequence of ids """
+        return [self.words[i] for i in ids]
+
+    def fingerprint(self):
+        """ Returns a hash of the id assignment, to check data packed with it matches """
+        return hashlib.sha1('\n'.join(self.words[1:]).encode('utf-8')).hexdigest()
+
+
+# Keys of n-grams too long to pack into one uint64: the first words are
+# packed into high and the last 64 // bits words into low, so sorting the
+# keys (by high, then low) still sorts the n-grams lexicographically by id
+WIDE_KEY = np.dtype([('high', '<u8'), ('low', '<u8')])
+
+
+class KeyWidthError(ValueError):
+    """ Raised when n-grams have too many words to pack into one key """
+
+
+def check_key_width(n, bits):
+    """ Raises KeyWidthError unless n words of bits bits each fit in a (wide) key """
+    if n > 2 * (64 // bits):
+        raise KeyWidthError(
+            "{}-grams over a vocabulary needing {} bits per word do not fit "
+            "in a 128 bit key: at most {}-grams can be counted".format(n, bits, 2 * (64 // bits))
+        )
+
+
+def key_dtype(n, bits):
+    """ Returns the dtype of the keys of n-grams: uint64 if they fit in one, else WIDE_KEY """
+    return np.dtype(np.uint64) if n * bits <= 64 else WIDE_KEY
+
+
+def _low_words(bits):
+    """ Number of words packed into the low half of a wide key """
+    return 64 // bits
+
+
+def pack(ids, bits):
+    """
+    Packs an (m, n) array of word ids into m keys, first word in the most
+    significant bits: uint64 keys while n * bits <= 64, WIDE_KEY ones
+    beyond. Sorting the keys sorts the n-grams lexicographically by id, so
+    all n-grams sharing a history are contiguous.
+    """
+    ids = np.asarray(ids)
+    n = ids.shape[1]
+    check_key_width(n, bits)
+    if n * bits > 64:
+        split = n - _low_words(bits)
+        keys = np.empty(ids.shape[0], dtype=WIDE_KEY)
+        keys['high'] = pack(ids[:, :split], bits)
+        keys['low'] = pack(ids[:, split:], bits)
+        return keys
+
+    keys = np.zeros(ids.shape[0], dtype=np.uint64)
+    shift = np.uint64(bits)
+    for j in range(n):
+        keys <<= shift
+        keys |= ids[:, j].astype(np.uint64)
+    return keys
+
+
+def unpack(keys, n, bits):
+    """ Inverse of pack: returns an (m, n) int32 array of word ids """
+    if n * bits > 64:
+        split = n - _low_words(bits)
+        return np.column_stack([unpack(keys['high'], split, bits), unpack(keys['low'], n - split, bits)])
+
+    keys = np.asarray(keys, dtype=np.uint64)
+    mask = np.uint64((1 << bits) - 1)
+    ids = np.empty((len(keys), n), dtype=np.int32)
+    for j in range(n):
+        ids[:, j] = (keys >> np.uint64(bits * (n - 1 - j))) & mask
+    return ids
+
+
+def history_keys(keys, n, bits):
+    """ Returns the keys of the first n - 1 words of n-grams with keys """
+    if n * bits > 64:
+        return pack(unpack(keys, n, bits)[:, :-1], bits)
+    return np.asarray(keys, dtype=np.uint64) >> np.uint64(bits)
+
+
+def suffix_keys(keys, n, bits):
+    """ Returns the keys of the last n - 1 words of n-grams with keys """
+    if n * bits > 64:
+        return pack(unpack(keys, n, bits)[:, 1:], bits)
+    return np.asarray(keys, dtype=np.uint64) & np.uint64((1 << (bits * (n - 1))) - 1)
+
+
+def last_ids(keys, n, bits):
+    """ Returns the id of the last word of n-grams with keys """
+    if n * bits > 64:
+        keys = keys['low']
+    return (np.asarray(keys, dtype=np.uint64) & np.uint64((1 << bits) - 1)).astype(np.int32)